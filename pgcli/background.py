@@ -0,0 +1,133 @@
+import threading
+from time import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class QueryProgress(object):
+    """Progress of the command that is running in the background."""
+
+    def __init__(self):
+        self.start = time()
+        self.rows = 0
+        self.statements = 0
+        # Set while reading a file, e.g. with \i or \copy
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.cancelled = False
+
+    @property
+    def elapsed(self):
+        return time() - self.start
+
+
+def run_in_background(func, on_tick=None, on_interrupt=None, interval=0.1):
+    """Call func on a worker thread and return its result.
+
+    While waiting, on_tick is called every `interval` seconds, so the caller
+    can show progress. When Ctrl+C is pressed on_interrupt is called, e.g. to
+    cancel the statement on the server, and waiting continues until func
+    finishes. A second Ctrl+C stops waiting by raising KeyboardInterrupt.
+
+    Exceptions raised by func are raised again in the calling thread.
+    """
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = func()
+        except BaseException as e:
+            outcome['error'] = e
+
+    worker = threading.Thread(target=target, name='query_worker')
+    worker.setDaemon(True)
+    worker.start()
+
+    interrupted = False
+    while worker.is_alive():
+        try:
+            worker.join(interval)
+            if on_tick and worker.is_alive():
+                on_tick()
+        except KeyboardInterrupt:
+            if interrupted or not on_interrupt:
+                raise
+            interrupted = True
+            on_interrupt()
+
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome.get('result')
+
+
+def background_iter(iterable, batch_size=100, queue_size=4, name=None,
+                    on_interrupt=None):
+    """Iterate over iterable on a worker thread, ahead of the caller.
+
+    Items are handed over in batches of `batch_size` through a queue of up to
+    `queue_size` batches, so the worker can't get too far ahead. This lets a
+    producer which waits for I/O (e.g. fetching rows from the server) or does
+    its own work (e.g. formatting them) run while the caller is busy with the
+    previous items. Exceptions raised by iterable are raised again in the
+    caller, after the items before them.
+
+    Closing the returned generator stops the worker, and waits for it to
+    finish the item it is working on. When Ctrl+C is pressed while waiting
+    for items, on_interrupt is called before that, e.g. to cancel the query
+    the worker is waiting for.
+    """
+    batches = queue.Queue(queue_size)
+    stop = threading.Event()
+
+    def put(batch, error=None, done=False):
+        while not stop.is_set():
+            try:
+                batches.put((batch, error, done), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        batch = []
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+        except BaseException as e:
+            put(batch, error=e, done=True)
+        else:
+            put(batch, done=True)
+
+    worker = threading.Thread(target=produce, name=name or 'background_iter')
+    worker.setDaemon(True)
+    worker.start()
+
+    try:
+        while True:
+            try:
+                # Waits with a timeout, which unlike a plain get() can be
+                # interrupted with Ctrl+C in Python 2.
+                batch, error, done = batches.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            for item in batch:
+                yield item
+            if error is not None:
+                raise error
+            if done:
+                return
+    except KeyboardInterrupt:
+        if on_interrupt:
+            on_interrupt()
+        raise
+    finally:
+        stop.set()
+        worker.join()
@@ -1,4 +1,16 @@
+import os
+import re
+import json
+import hashlib
+import logging
 import threading
+from time import time
+from collections import namedtuple
+import psycopg2
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 try:
     from collections import OrderedDict
 except ImportError:
@@ -6,17 +18,132 @@ except ImportError:
 
 from .pgcompleter import PGCompleter
 from .pgexecute import PGExecute
+from .config import ensure_dir_exists
+from .packages.sqlsplit import split
+from .packages.function_metadata import FunctionMetadata
+
+_logger = logging.getLogger(__name__)
+
+# What a DDL statement changed: the kind of objects ('relations', 'functions',
+# 'datatypes', 'schemata' or 'databases'), their schema (None if the names
+# weren't qualified) and their names.
+DDLChange = namedtuple('DDLChange', ['kind', 'schema', 'names'])
+
+
+class CompletionCache(object):
+    """The completions of earlier sessions, so they are available as soon as
+    pgcli starts instead of once the first refresh has finished.
+
+    If `directory` is set, the metadata read by each refresh is saved there,
+    one file per server, user and database, together with the catalog
+    fingerprint it was read at. The next refresh compares the fingerprint to
+    revalidate the loaded completions.
+    """
+
+    # Files saved by another version of this class are ignored.
+    version = 1
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def load(self, executor, special, lazy_columns=False):
+        """Returns a PGCompleter with the completions saved for the database
+        executor is connected to, and the fingerprint they were read at. Both
+        are None if nothing was saved, or if the saved completions were read
+        in another lazy_columns mode."""
+        filename = self._filename(executor)
+        if not filename:
+            return None, None
+        try:
+            with open(filename) as f:
+                state = json.load(f)
+            if (state.get('version') != self.version
+                    or state.get('lazy_columns') != lazy_columns):
+                return None, None
+            completer = PGCompleter(smart_completion=True, pgspecial=special)
+            completer.databases = state['databases']
+            completer.search_path = state['search_path']
+            completer.all_completions.update(state['all_completions'])
+            metadata = state['dbmetadata']
+            for funcs in metadata['functions'].values():
+                for name, overloads in funcs.items():
+                    funcs[name] = [FunctionMetadata(*f) for f in overloads]
+            completer.dbmetadata = metadata
+            return completer, tuple(state['fingerprint'])
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            _logger.debug('Completion cache not loaded: %r', e)
+            return None, None
+
+    def save(self, executor, completer, fingerprint):
+        filename = self._filename(executor)
+        if not filename:
+            return
+        metadata = dict(completer.dbmetadata)
+        metadata['functions'] = dict(
+            (schema, dict((name, [_function_fields(f) for f in overloads])
+                          for name, overloads in funcs.items()))
+            for schema, funcs in metadata['functions'].items())
+        state = {
+            'version': self.version,
+            'lazy_columns': completer.column_loader is not None,
+            'fingerprint': fingerprint,
+            'databases': completer.databases,
+            'search_path': completer.search_path,
+            'all_completions': sorted(completer.all_completions),
+            'dbmetadata': metadata,
+        }
+        try:
+            ensure_dir_exists(filename)
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError, TypeError) as e:
+            _logger.error('Failed to save the completion cache: %r', e)
+
+    def _filename(self, executor):
+        if not self.directory:
+            return None
+        key = '%s@%s:%s/%s' % (executor.user, executor.host, executor.port,
+                               executor.dbname)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(os.path.expanduser(self.directory),
+                            digest + '.json')
+
+
+def _function_fields(f):
+    return [f.schema_name, f.func_name, f.arg_list, f.return_type,
+            f.is_aggregate, f.is_window, f.is_set_returning]
 
 
 class CompletionRefresher(object):
 
     refreshers = OrderedDict()
 
-    def __init__(self):
+    # See CompletionCache. This one doesn't save anything; pass another one
+    # to the constructor to keep the completions between sessions.
+    cache = CompletionCache()
+
+    # Refresh what a DDLChange changed, by kind.
+    change_refreshers = {}
+
+    # Number of connections to run the refreshers over.
+    jobs = 3
+
+    def __init__(self, lazy_columns=False, cache=None):
+        if cache is not None:
+            self.cache = cache
+        # Only list the relations when refreshing, see ColumnLoader.
+        self.lazy_columns = lazy_columns
         self._completer_thread = None
         self._restart_refresh = threading.Event()
+        # Set when a forced refresh is asked for while one is running.
+        self._force_refresh = False
+        # The catalog_fingerprint of the database the last completed refresh
+        # read.
+        self.fingerprint = None
 
-    def refresh(self, executor, special, callbacks, history=None):
+    def refresh(self, executor, special, callbacks, history=None,
+                force=False):
         """
         Creates a PGCompleter object and populates it with the relevant
         completion suggestions in a background thread.
@@ -26,15 +153,20 @@ class CompletionRefresher(object):
         special - PGSpecial object used for creating a new completion object.
         callbacks - A function or a list of functions to call after the thread
                     has completed the refresh. The newly created completion
-                    object will be passed in as an argument to each callback.
+                    object will be passed in as an argument to each callback,
+                    or None if the refresh was skipped because nothing has
+                    changed since the last one, or failed.
+        force - Read the catalog even if its fingerprint hasn't changed since
+                the last refresh, e.g. for an explicit \\refresh.
         """
         if self.is_refreshing():
+            self._force_refresh = self._force_refresh or force
             self._restart_refresh.set()
             return [(None, None, None, 'Auto-completion refresh restarted.')]
         else:
             self._completer_thread = threading.Thread(
                 target=self._bg_refresh,
-                args=(executor, special, callbacks, history),
+                args=(executor, special, callbacks, history, force),
                 name='completion_refresh')
             self._completer_thread.setDaemon(True)
             self._completer_thread.start()
@@ -44,41 +176,324 @@ class CompletionRefresher(object):
     def is_refreshing(self):
         return self._completer_thread and self._completer_thread.is_alive()
 
-    def _bg_refresh(self, pgexecute, special, callbacks, history=None):
+    def is_current(self, executor):
+        """Returns True if the last refresh read the database executor is
+        connected to, and nothing has changed in it since."""
+        return (self.fingerprint is not None and not self.is_refreshing()
+                and executor.catalog_fingerprint() == self.fingerprint)
+
+    def load_cached(self, executor, special, history=None):
+        """Returns a PGCompleter with the cached completions for the database
+        executor is connected to, or None. The next refresh only reads the
+        catalog again if it has changed since they were saved."""
+        completer, fingerprint = self.cache.load(executor, special,
+                                                 self.lazy_columns)
+        if completer is None:
+            return None
+        if self.lazy_columns:
+            completer.column_loader = ColumnLoader(executor)
+        self.fingerprint = fingerprint
+        _load_history(completer, history)
+        return completer
+
+    def _bg_refresh(self, pgexecute, special, callbacks, history=None,
+                    force=False):
         completer = PGCompleter(smart_completion=True, pgspecial=special)
+        column_loader = ColumnLoader(pgexecute) if self.lazy_columns else None
+        completer.column_loader = column_loader
 
-        # Create a new pgexecute method to popoulate the completions.
+        # Create new pgexecute objects to populate the completions, so the
+        # catalog queries can run concurrently. Only one to begin with, for
+        # the probe below; the others once it's clear they're needed.
         e = pgexecute
-        executor = PGExecute(e.dbname, e.user, e.password, e.host, e.port, e.dsn)
+        new_executor = lambda: PGExecute(e.dbname, e.user, e.password, e.host,
+                                         e.port, e.dsn, e.type_oid_cache)
+        jobs = min(self.jobs, len(self.refreshers))
 
         # If callbacks is a single function then push it into a list.
         if callable(callbacks):
             callbacks = [callbacks]
 
-        while 1:
-            for refresher in self.refreshers.values():
-                refresher(completer, executor)
+        executors = []
+        try:
+            if jobs:
+                executors.append(new_executor())
+            while 1:
+                # A cheap probe first: skip everything if the catalog hasn't
+                # changed since the last refresh.
+                fingerprint = (executors[0].catalog_fingerprint()
+                               if executors else None)
+                if (not force and fingerprint is not None
+                        and fingerprint == self.fingerprint):
+                    recorded = None
+                else:
+                    while len(executors) < jobs:
+                        executors.append(new_executor())
+                    recorded = self._run_refreshers(executors, column_loader)
                 if self._restart_refresh.is_set():
+                    # Start over the refresh from the beginning.
                     self._restart_refresh.clear()
-                    break
-            else:
-                # Break out of while loop if the for loop finishes natually
-                # without hitting the break statement.
+                    force, self._force_refresh = (
+                        force or self._force_refresh, False)
+                    continue
                 break
+        except Exception as error:
+            # Raising it would only print a traceback over the prompt. The
+            # completions stay as they are until the next refresh.
+            _logger.error('Completion refresh failed: %r', error)
+            recorded = None
+        finally:
+            # Let the next refresh (or a switch to this database) reuse them.
+            for executor in executors:
+                executor.close()
+
+        if recorded is None:
+            for callback in callbacks:
+                callback(None)
+            return
 
-            # Start over the refresh from the beginning if the for loop hit the
-            # break statement.
-            continue
+        # Apply the results in the order of the refreshers, as if they had
+        # run one after another.
+        for name in self.refreshers:
+            recorded[name].replay(completer)
+        self.fingerprint = fingerprint
+        # Save it while nothing else is using it yet.
+        if fingerprint is not None:
+            self.cache.save(pgexecute, completer, fingerprint)
 
-        # Load history into pgcompleter so it can learn user preferences
-        n_recent = 100
-        if history:
-            for recent in history[-n_recent:]:
-                completer.extend_query_history(recent, is_init=True)
+        _load_history(completer, history)
 
         for callback in callbacks:
             callback(completer)
 
+    def refresh_changes(self, executor, changes, column_loader=None):
+        """Fetches the objects which changes (see ddl_changes) affected.
+
+        Returns a CompletionRecorder, to replay onto the completer: it drops
+        what the completer knows about those objects, then adds what the
+        database has now. column_loader is the completer's.
+        """
+        recorder = CompletionRecorder(column_loader)
+        search_path = None
+        for change in OrderedDict.fromkeys(changes):
+            if change.schema is not None:
+                schemas = [change.schema]
+            else:
+                # Unqualified names can only refer to objects created in the
+                # schemas on the search path.
+                if search_path is None:
+                    search_path = [s for s in executor.search_path()
+                                   if s not in _system_schemata]
+                schemas = search_path
+            self.change_refreshers[change.kind](recorder, executor, schemas,
+                                                change.names)
+        return recorder
+
+    def _run_refreshers(self, executors, column_loader=None):
+        """Runs the refreshers concurrently, one thread per executor, each
+        against its own CompletionRecorder. Returns the recorders by refresher
+        name. Stops early if the refresh is restarted.
+
+        If a refresher fails, the others are stopped and its exception is
+        raised here, in the calling thread.
+        """
+        pending = queue.Queue()
+        for name in self.refreshers:
+            pending.put(name)
+        recorded = {}
+        errors = []
+
+        def work(executor):
+            while not self._restart_refresh.is_set() and not errors:
+                try:
+                    name = pending.get_nowait()
+                except queue.Empty:
+                    return
+                recorder = CompletionRecorder(column_loader)
+                try:
+                    self.refreshers[name](recorder, executor)
+                except Exception as e:
+                    _logger.error('Refreshing %s failed: %r', name, e)
+                    errors.append(e)
+                    return
+                recorded[name] = recorder
+
+        threads = [threading.Thread(target=work, args=(executor,),
+                                    name='completion_refresh_%d' % i)
+                   for i, executor in enumerate(executors)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return recorded
+
+
+class ColumnLoader(object):
+    """Fetches the columns of a relation the first time the completer needs
+    them, for lazy_columns mode.
+
+    Listing every column of every relation takes a lot of time and memory on
+    databases with huge catalogs, so in this mode the refreshers only list the
+    relations. The columns are fetched over a side connection, which is kept
+    open until `close`, and those of the `cache_size` most recently used
+    relations are kept.
+
+    The completer waits at most `timeout` seconds for them, and not at all
+    while the side connection is being opened, which on a remote server can
+    take longer than that by itself. A fetch which takes longer goes on in
+    the background and its columns are there the next time they're asked
+    for. After a failure, the relation's columns aren't fetched again for
+    `retry_after` seconds.
+    """
+
+    timeout = 0.5
+    cache_size = 1000
+    retry_after = 10
+
+    def __init__(self, executor):
+        e = executor
+        self._params = (e.dbname, e.user, e.password, e.host, e.port, e.dsn,
+                        e.type_oid_cache)
+        self._cache = OrderedDict()
+        # When fetching the columns of a relation last failed, by key.
+        self._failed = {}
+        # The keys being fetched.
+        self._pending = set()
+        self._lock = threading.Lock()
+        # The side connection, which one fetch at a time uses.
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._closed = False
+
+    def columns(self, kind, schema, relname):
+        """Returns the column names of a table or view (kind is 'tables' or
+        'views'), or an empty list if they couldn't be fetched in time."""
+        key = (kind, schema, relname)
+        with self._lock:
+            columns = self._cache.pop(key, None)
+            if columns is not None:
+                # Now the most recently used
+                self._cache[key] = columns
+                return columns
+            if (key in self._pending or
+                    time() - self._failed.get(key, 0) < self.retry_after):
+                return []
+            self._pending.add(key)
+        thread = threading.Thread(target=self._load, args=(key,),
+                                  name='column_loader')
+        thread.setDaemon(True)
+        thread.start()
+        if self._executor is not None:
+            thread.join(self.timeout)
+        with self._lock:
+            return self._cache.get(key, [])
+
+    def close(self):
+        """Returns the side connection to the pool, e.g. when the completer is
+        replaced. A fetch which is still running does that once it's done."""
+        self._closed = True
+        if self._executor_lock.acquire(False):
+            try:
+                self._close_executor()
+            finally:
+                self._executor_lock.release()
+
+    def forget(self, schemas, names=None):
+        """Drops the cached columns of relations in schemas, or only of those
+        called names, e.g. after they have been altered."""
+        with self._lock:
+            for cached in (self._cache, self._failed):
+                for key in list(cached):
+                    if key[1] in schemas and (names is None or
+                                              key[2] in names):
+                        del cached[key]
+
+    def _load(self, key):
+        kind, schema, relname = key
+        columns = None
+        try:
+            columns = self._fetch(kind, schema, relname)
+        except psycopg2.Error as e:
+            _logger.error('Fetching the columns of %r.%r failed: %r',
+                          schema, relname, e)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+                if columns is None:
+                    self._failed[key] = time()
+                else:
+                    self._failed.pop(key, None)
+                    self._cache[key] = columns
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+
+    def _fetch(self, kind, schema, relname):
+        with self._executor_lock:
+            try:
+                if self._executor is None or self._executor.conn.closed:
+                    self._executor = PGExecute(*self._params)
+                executor = self._executor
+                columns = (executor.table_columns if kind == 'tables'
+                           else executor.view_columns)
+                with executor.conn.cursor() as cur:
+                    # SET LOCAL, so the timeout doesn't stay on the pooled
+                    # connection.
+                    cur.execute('BEGIN')
+                    try:
+                        cur.execute('SET LOCAL statement_timeout = %s',
+                                    [int(self.timeout * 1000)])
+                        return [column for _, _, column
+                                in columns([schema], [relname])]
+                    finally:
+                        cur.execute('ROLLBACK')
+            finally:
+                if self._closed:
+                    self._close_executor()
+
+    def _close_executor(self):
+        if self._executor is not None:
+            self._executor.close()
+            self._executor = None
+
+
+def _load_history(completer, history):
+    # Load history into pgcompleter so it can learn user preferences
+    n_recent = 100
+    if history:
+        for recent in history[-n_recent:]:
+            completer.extend_query_history(recent, is_init=True)
+
+
+class CompletionRecorder(object):
+    """Stands in for the PGCompleter in a refresher running on a worker
+    thread. Records the calls made to it, with any iterators passed to them
+    read to the end (still on the worker thread), so they can be replayed
+    onto the real completer later.
+
+    column_loader is the one the completer will have, for the refreshers to
+    check."""
+
+    def __init__(self, column_loader=None):
+        self.column_loader = column_loader
+        self.calls = []
+
+    def __getattr__(self, attr):
+        def record(*args, **kwargs):
+            args = [list(arg) if _is_iterator(arg) else arg for arg in args]
+            self.calls.append((attr, args, kwargs))
+        return record
+
+    def replay(self, completer):
+        for attr, args, kwargs in self.calls:
+            getattr(completer, attr)(*args, **kwargs)
+
+
+def _is_iterator(value):
+    return hasattr(value, '__iter__') and iter(value) is value
+
 
 def refresher(name, refreshers=CompletionRefresher.refreshers):
     """Decorator to populate the dictionary of refreshers with the current
@@ -97,12 +512,14 @@ def refresh_schemata(completer, executor):
 @refresher('tables')
 def refresh_tables(completer, executor):
     completer.extend_relations(executor.tables(), kind='tables')
-    completer.extend_columns(executor.table_columns(), kind='tables')
+    if completer.column_loader is None:
+        completer.extend_columns(executor.table_columns(), kind='tables')
 
 @refresher('views')
 def refresh_views(completer, executor):
     completer.extend_relations(executor.views(), kind='views')
-    completer.extend_columns(executor.view_columns(), kind='views')
+    if completer.column_loader is None:
+        completer.extend_columns(executor.view_columns(), kind='views')
 
 @refresher('functions')
 def refresh_functions(completer, executor):
@@ -115,3 +532,219 @@ def refresh_types(completer, executor):
 @refresher('databases')
 def refresh_databases(completer, executor):
     completer.extend_database_names(executor.databases())
+
+
+@refresher('relations', refreshers=CompletionRefresher.change_refreshers)
+def refresh_changed_relations(completer, executor, schemas, names):
+    for kind, relations, columns in (
+            ('tables', executor.tables, executor.table_columns),
+            ('views', executor.views, executor.view_columns)):
+        completer.drop_objects(kind, schemas, names)
+        found = list(relations(schemas, names))
+        # In case their schema is new to the completer too. Temporary tables
+        # aren't found at all: the pg_temp schema of the user's session can't
+        # be seen from the executor's connection.
+        completer.extend_schemata(set(schema for schema, _ in found))
+        completer.extend_relations(found, kind=kind)
+        if completer.column_loader is None:
+            completer.extend_columns(columns(schemas, names), kind=kind)
+    if completer.column_loader is not None:
+        completer.column_loader.forget(schemas, names)
+
+@refresher('functions', refreshers=CompletionRefresher.change_refreshers)
+def refresh_changed_functions(completer, executor, schemas, names):
+    completer.drop_objects('functions', schemas)
+    completer.extend_functions(executor.functions(schemas))
+
+@refresher('datatypes', refreshers=CompletionRefresher.change_refreshers)
+def refresh_changed_datatypes(completer, executor, schemas, names):
+    completer.drop_objects('datatypes', schemas)
+    completer.extend_datatypes(executor.datatypes(schemas))
+
+@refresher('schemata', refreshers=CompletionRefresher.change_refreshers)
+def refresh_changed_schemata(completer, executor, schemas, names):
+    completer.drop_schemata(names)
+    found = [schema for schema in executor.schemata() if schema in names]
+    if found:
+        # CREATE SCHEMA can create objects in it too.
+        completer.extend_schemata(found)
+        refresh_changed_relations(completer, executor, found, None)
+        refresh_changed_functions(completer, executor, found, None)
+        refresh_changed_datatypes(completer, executor, found, None)
+    completer.set_search_path(executor.search_path())
+
+@refresher('databases', refreshers=CompletionRefresher.change_refreshers)
+def refresh_changed_databases(completer, executor, schemas, names):
+    completer.drop_database_names()
+    completer.extend_database_names(executor.databases())
+
+
+_system_schemata = ('pg_catalog', 'information_schema')
+
+# Words, quoted identifiers and strings, and punctuation.
+_ddl_token_regex = re.compile(
+    r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|[\w$]+|\S""", re.UNICODE)
+
+# Words which can come between CREATE, ALTER or DROP and the kind of object.
+_ddl_modifiers = set(['or', 'replace', 'global', 'local', 'temp', 'temporary',
+                      'unlogged', 'recursive', 'unique', 'constraint',
+                      'trusted', 'procedural'])
+
+# The kind of change DDL on each type of object makes to the completions, or
+# None if the objects aren't completed.
+_ddl_objects = {
+    'table': 'relations', 'view': 'relations', 'materialized view': 'relations',
+    'foreign table': 'relations',
+    'function': 'functions', 'procedure': 'functions',
+    'aggregate': 'functions',
+    'type': 'datatypes', 'domain': 'datatypes',
+    'schema': 'schemata', 'database': 'databases',
+}
+for _object in ('index', 'sequence', 'trigger', 'role', 'user', 'group',
+                'policy', 'rule', 'statistics', 'publication', 'subscription',
+                'tablespace', 'event trigger', 'default privileges',
+                'operator', 'operator class', 'operator family', 'cast',
+                'collation', 'conversion', 'language', 'server',
+                'user mapping', 'foreign data wrapper', 'access method',
+                'transform', 'text search configuration',
+                'text search dictionary', 'text search parser',
+                'text search template', 'system'):
+    _ddl_objects[_object] = None
+
+
+def ddl_changes(sql):
+    """Works out what the DDL statements in sql change in the completions.
+
+    Returns a list of DDLChange tuples, which is empty if none of the objects
+    that are completed changed, or None if a statement isn't understood (or
+    may have changed other objects, e.g. DROP ... CASCADE) and everything
+    needs to be refreshed.
+    """
+    changes = []
+    for statement in split(sql):
+        statement_changes = _statement_ddl_changes(statement)
+        if statement_changes is None:
+            return None
+        changes.extend(statement_changes)
+    return changes
+
+
+def _statement_ddl_changes(statement):
+    tokens = _ddl_token_regex.findall(statement)
+    words = [token.lower() for token in tokens]
+    if not words or words[0] not in ('create', 'alter', 'drop'):
+        return []
+    action = words[0]
+    if 'cascade' in words:
+        return None
+
+    i = 1
+    while i < len(words) and words[i] in _ddl_modifiers:
+        i += 1
+    for length in (3, 2, 1):
+        obj = ' '.join(words[i:i + length])
+        if obj in _ddl_objects:
+            break
+    else:
+        return None
+    kind = _ddl_objects[obj]
+    if kind is None:
+        return []
+    if kind == 'databases':
+        return [DDLChange(kind, None, None)]
+    i += length
+    while i < len(words) and words[i] in ('if', 'not', 'exists', 'only'):
+        i += 1
+
+    # DROP can list several objects, the others name one.
+    names = []
+    while True:
+        name, i = _qualified_name(tokens, i)
+        if name is None:
+            return None
+        names.append(name)
+        if i < len(tokens) and tokens[i] == '(' and kind == 'functions':
+            i = _skip_parentheses(tokens, i)
+        if action != 'drop' or i >= len(tokens) or tokens[i] != ',':
+            break
+        i += 1
+
+    if action == 'alter':
+        rest = words[i:]
+        if _find(rest, ['set', 'schema']) >= 0:
+            return None
+        rename = _find(rest, ['rename', 'to'])
+        if rename >= 0:
+            new_name, _ = _qualified_name(tokens, i + rename + 2)
+            if new_name is None:
+                return None
+            names.append((names[0][0], new_name[1]))
+
+    if kind == 'schemata':
+        if names[0][1] == 'authorization':
+            return None
+        return [DDLChange(kind, None, tuple(name for _, name in names))]
+    if kind != 'relations':
+        # All the functions or types in the schema are refreshed.
+        names = [(schema, None) for schema, _ in names]
+    changes = []
+    for schema, name in names:
+        changes.append(DDLChange(kind, schema, name and (name,)))
+        if obj == 'type':
+            # e.g. the constructor functions of range types
+            changes.append(DDLChange('functions', schema, None))
+    return changes
+
+
+def _qualified_name(tokens, i):
+    """Returns the (schema, name) tuple of the possibly schema-qualified name
+    starting at tokens[i], with schema None if it isn't qualified, and the
+    index of the token after it. The tuple is None if there is no name."""
+    parts = []
+    while True:
+        part = _identifier(tokens[i]) if i < len(tokens) else None
+        if part is None:
+            return None, i
+        parts.append(part)
+        i += 1
+        if i >= len(tokens) or tokens[i] != '.':
+            break
+        i += 1
+    if len(parts) > 2:
+        # database.schema.name
+        parts = parts[-2:]
+    if len(parts) == 1:
+        parts.insert(0, None)
+    return tuple(parts), i
+
+
+def _identifier(token):
+    """Returns the name token refers to, or None if it isn't an identifier."""
+    if token.startswith('"'):
+        return token[1:-1].replace('""', '"')
+    if token.startswith("'") or not re.match(r'[\w$]', token, re.UNICODE):
+        return None
+    return token.lower()
+
+
+def _skip_parentheses(tokens, i):
+    """Returns the index of the token after the parenthesised group starting
+    at tokens[i]."""
+    depth = 0
+    for i in range(i, len(tokens)):
+        if tokens[i] == '(':
+            depth += 1
+        elif tokens[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return len(tokens)
+
+
+def _find(words, sequence):
+    """Returns the index of the first occurrence of sequence in words, or -1.
+    """
+    for i in range(len(words)):
+        if words[i:i + len(sequence)] == sequence:
+            return i
+    return -1
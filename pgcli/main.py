@@ -2,17 +2,20 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+import io
 import os
 import re
 import sys
+import codecs
 import traceback
 import logging
 import threading
 import shutil
 import functools
+from decimal import Decimal
 import humanize
 from time import time
-from codecs import open
+from itertools import chain, islice
 
 
 import click
@@ -30,19 +33,25 @@ from prompt_toolkit.layout.lexers import PygmentsLexer
 from prompt_toolkit.layout.processors import (ConditionalProcessor,
                                         HighlightMatchingBracketProcessor)
 from prompt_toolkit.history import FileHistory
+from prompt_toolkit.renderer import print_tokens as renderer_print_tokens
 from pygments.lexers.sql import PostgresLexer
 from pygments.token import Token
 
-from .packages.tabulate import tabulate
-from .packages.expanded import expanded_table
+from .packages.tabulate import tabulate, tabulate_iter
+from .packages.expanded import expanded_table, expanded_records
+from .packages.sqlsplit import split_stream
 from pgspecial.main import (PGSpecial, NO_QUERY, content_exceeds_width)
 import pgspecial as special
 from .pgcompleter import PGCompleter
-from .pgtoolbar import create_toolbar_tokens_func
+from .pgtoolbar import create_toolbar_tokens_func, create_progress_tokens_func
 from .pgstyle import style_factory
-from .pgexecute import PGExecute
+from .pgexecute import PGExecute, TypeOidCache
 from .pgbuffer import PGBuffer
-from .completion_refresher import CompletionRefresher
+from .completion_refresher import (CompletionRefresher, CompletionCache,
+                                   ddl_changes)
+from .output_sink import PagerSink, FileSink, PipeSink
+from .background import QueryProgress, run_in_background, background_iter
+from . import pgcopy
 from .config import (
     write_default_config, load_config, config_location, ensure_dir_exists,
 )
@@ -58,6 +67,7 @@ except ImportError:
     from urllib.parse import urlparse, unquote
 
 from getpass import getuser
+import psycopg2
 from psycopg2 import OperationalError
 
 from collections import namedtuple
@@ -73,8 +83,51 @@ MetaQuery = namedtuple(
         'db_changed',       # True if any subquery changed the database
         'path_changed',     # True if any subquery changed the search path
         'mutated',          # True if any subquery executed insert/update/delete
+        'meta_changes',     # What create/alter/drop changed, see ddl_changes
     ])
-MetaQuery.__new__.__defaults__ = ('', False, 0, False, False, False, False)
+MetaQuery.__new__.__defaults__ = ('', False, 0, False, False, False, False,
+                                  None)
+
+# The rest of a paged result, waiting for \next or \all
+PendingResult = namedtuple(
+    'PendingResult',
+    [
+        'cursor',           # The cursor the rows come from
+        'rows',             # Iterator over the rows after next_row
+        'next_row',         # The first row which hasn't been shown yet
+        'headers',          # Column names
+        'status',           # Status of the statement that produced the rows
+        'shown',            # Number of rows shown so far
+    ])
+
+# Results with more rows than this are rendered as a stream, with the column
+# widths fixed from this many rows.
+TABLE_SAMPLE_SIZE = 1000
+
+# Commands that take longer than this many seconds show a progress line.
+PROGRESS_DELAY = 0.5
+
+# Scripts run with \i are read this many bytes at a time.
+SCRIPT_CHUNK_SIZE = 1024 * 1024
+
+# With \i -b, up to this many statements are sent to the server at once.
+SCRIPT_BATCH_SIZE = 100
+
+# Large results are fetched and formatted on separate threads, which hand
+# over this many rows and lines at a time.
+FETCH_BATCH_SIZE = 500
+FORMAT_BATCH_SIZE = 100
+
+# Values which are cut short for display end with this.
+truncation_marker_regex = re.compile(r'\.\.\. \(\d+ characters\)\Z')
+text_types = (type(''), bytes)
+
+# How columns are formatted and aligned, by type OID: integers (int8, int2,
+# int4 and oid), floats (float4 and float8) and numeric, which is shown
+# exactly as it is. Columns of other types are formatted as text.
+COLUMN_TYPES = {20: int, 21: int, 23: int, 26: int, 700: float, 701: float,
+                1700: Decimal}
+
 
 class PGCli(object):
 
@@ -114,7 +167,7 @@ class PGCli(object):
         self.initialize_logging()
 
         self.set_default_pager(c)
-        self.output_file = None
+        self.output_sink = None
         self.pgspecial = PGSpecial()
 
         self.multi_line = c['main'].as_bool('multi_line')
@@ -128,7 +181,25 @@ class PGCli(object):
 
         self.on_error = c['main']['on_error'].upper()
 
-        self.completion_refresher = CompletionRefresher()
+        self.server_side_cursors = c['main']['server_side_cursors'].lower()
+        self.cursor_itersize = c['main'].as_int('cursor_itersize')
+        self.cursor_threshold = c['main'].as_int('cursor_threshold')
+        self.text_typecasting = c['main'].as_bool('text_typecasting')
+        self.max_cell_length = c['main'].as_int('max_cell_length')
+        self.server_side_previews = c['main'].as_bool('server_side_previews')
+        self.result_page_size = c['main'].as_int('result_page_size')
+        self.copy_jobs = c['main'].as_int('copy_jobs')
+        self.pending_result = None
+
+        # Remember the completions between sessions, to have them as soon as
+        # pgcli starts.
+        self.completion_refresher = CompletionRefresher(
+            lazy_columns=c['main'].as_bool('lazy_columns'),
+            cache=CompletionCache(config_location() + 'completions'))
+
+        # And type oids, to save round trips on connect.
+        self.type_oid_cache = TypeOidCache(config_location() + 'type_oids.json')
+        PGExecute.pool.idle_timeout = c['main'].as_int('pool_idle_timeout')
 
         self.query_history = []
 
@@ -137,10 +208,19 @@ class PGCli(object):
         completer = PGCompleter(smart_completion, pgspecial=self.pgspecial)
         self.completer = completer
         self._completer_lock = threading.Lock()
+        self._update_lock = threading.Lock()
         self.register_special_commands()
 
         self.eventloop = create_eventloop()
         self.cli = None
+        self.progress = None
+        self._progress_shown = False
+        self._pager_running = False
+        self.get_progress_tokens = create_progress_tokens_func(
+            lambda: self.progress)
+
+        if self.pgexecute:
+            self._configure_executor(self.pgexecute)
 
     def register_special_commands(self):
 
@@ -148,17 +228,42 @@ class PGCli(object):
             self.change_db, '\\c', '\\c[onnect] database_name',
             'Change to a new database.', aliases=('use', '\\connect', 'USE'))
 
+        # An explicit refresh reads the catalog again even if its fingerprint
+        # says nothing has changed.
         refresh_callback = lambda: self.refresh_completions(
-            persist_priorities='all')
+            persist_priorities='all', force=True)
 
         self.pgspecial.register(refresh_callback, '\\#', '\\#',
                                 'Refresh auto-completions.', arg_type=NO_QUERY)
         self.pgspecial.register(refresh_callback, '\\refresh', '\\refresh',
                                 'Refresh auto-completions.', arg_type=NO_QUERY)
-        self.pgspecial.register(self.execute_from_file, '\\i', '\\i filename',
-                                'Execute commands from file.')
+        self.pgspecial.register(self.execute_from_file, '\\i',
+                                '\\i [-1] [-b] filename',
+                                'Execute commands from file. -1 runs them in '
+                                'a single transaction, -b sends them to the '
+                                'server in batches.')
         self.pgspecial.register(self.write_to_file, '\\o', '\\o [filename]',
                                 'Send all query results to file.')
+        self.pgspecial.register(self.copy_file, '\\copy',
+                                '\\copy table|(query) from|to file [options]',
+                                'Copy data between a table and a local file.')
+        self.pgspecial.register(self.export_table, '\\export',
+                                pgcopy.EXPORT_USAGE,
+                                'Copy a table to a local file over several '
+                                'connections. -p writes numbered part files.')
+        self.pgspecial.register(self.import_file, '\\import',
+                                pgcopy.IMPORT_USAGE,
+                                'Copy a local file to a table over several '
+                                'connections. -1 commits only if all of it '
+                                'was copied. CSV files with custom QUOTE or '
+                                'ESCAPE characters are copied over one '
+                                'connection.')
+        self.pgspecial.register(self.show_next_page, '\\next', '\\next',
+                                'Show the next page of the last result.',
+                                arg_type=NO_QUERY)
+        self.pgspecial.register(self.show_all_rows, '\\all', '\\all',
+                                'Show all remaining rows of the last result.',
+                                arg_type=NO_QUERY)
 
     def change_db(self, pattern, **_):
         if pattern:
@@ -170,36 +275,174 @@ class PGCli(object):
         yield (None, None, None, 'You are now connected to database "%s" as '
                 'user "%s"' % (self.pgexecute.dbname, self.pgexecute.user))
 
+    def _needs_paging(self, cur, status, sql):
+        """Returns true if a result might have more rows than fit on a page.
+
+        Only results shown on the terminal are paged: output going to a file
+        or command (\\o), or to a stdout that isn't a terminal, is written in
+        full.
+        """
+        if (self.result_page_size <= 0 or not cur or not is_select(status)
+                or isinstance(cur, list) or is_page_command(sql)
+                or self.output_sink or not sys.stdout.isatty()):
+            return False
+        rowcount = getattr(cur, 'rowcount', -1)
+        return rowcount < 0 or rowcount > self.result_page_size
+
+    def _first_page(self, cur, headers, status):
+        """Returns the first page of rows of a result, and the status to show
+        with it. The rest of the rows are kept for \\next and \\all."""
+        self.discard_pending_result()
+        rows = iter(cur)
+        page = list(islice(rows, self.result_page_size))
+        next_row = next(rows, None)
+        if next_row is None:
+            if hasattr(cur, 'close'):
+                cur.close()
+            return page, status
+
+        # There are more rows than fit on a page.
+        pending = PendingResult(cur, rows, next_row, headers, status,
+                                len(page))
+        self.pending_result = pending
+        return page, self._page_status(pending, 1, len(page))
+
+    def _page_status(self, pending, first, last):
+        total = getattr(pending.cursor, 'rowcount', -1)
+        message = 'Rows %d-%d' % (first, last)
+        if total >= 0:
+            message += ' of %d' % total
+        if self.pending_result:
+            message += '. Use \\next for the next page, \\all for all rows.'
+        return '%s\n%s' % (pending.status, message)
+
+    def discard_pending_result(self):
+        """Forget the rest of a paged result and close its cursor."""
+        pending, self.pending_result = self.pending_result, None
+        if pending and hasattr(pending.cursor, 'close'):
+            pending.cursor.close()
+
+    def show_next_page(self):
+        pending = self.pending_result
+        if not pending:
+            return [(None, None, None, 'There are no more rows to show.')]
+
+        page = [pending.next_row]
+        page.extend(islice(pending.rows, self.result_page_size - 1))
+        first, last = pending.shown + 1, pending.shown + len(page)
+        next_row = next(pending.rows, None)
+        if next_row is None:
+            self.discard_pending_result()
+        else:
+            self.pending_result = pending._replace(next_row=next_row,
+                                                   shown=last)
+        return [(None, page, pending.headers,
+                 self._page_status(pending, first, last))]
+
+    def show_all_rows(self):
+        pending, self.pending_result = self.pending_result, None
+        if not pending:
+            return [(None, None, None, 'There are no more rows to show.')]
+
+        def remaining_rows():
+            try:
+                yield pending.next_row
+                for row in pending.rows:
+                    yield row
+            finally:
+                if hasattr(pending.cursor, 'close'):
+                    pending.cursor.close()
+
+        return [(None, remaining_rows(), pending.headers, pending.status)]
+
     def execute_from_file(self, pattern, **_):
+        single_transaction = batch = False
+        while pattern.split(None, 1)[0:1] in (['-1'], ['-b']):
+            option, _, pattern = pattern.partition(' ')
+            pattern = pattern.strip()
+            if option == '-1':
+                single_transaction = True
+            else:
+                batch = True
         if not pattern:
             message = '\\i: missing required argument'
             return [(None, None, None, message, '', False)]
+        filename = os.path.expanduser(pattern)
         try:
-            with open(os.path.expanduser(pattern), encoding='utf-8') as f:
-                query = f.read()
+            f = io.open(filename, 'rb')
         except IOError as e:
             return [(None, None, None, str(e), '', False)]
 
+        # The file is read in chunks and each statement runs as soon as it
+        # has been read, so scripts of any size can be run.
+        progress = self.progress or QueryProgress()
+        progress.bytes_total = os.path.getsize(filename)
+        statements = split_stream(read_chunks(f, progress))
+
         on_error_resume = (self.on_error == 'RESUME')
-        return self.pgexecute.run(
-            query, self.pgspecial, on_error_resume=on_error_resume
+        return self.pgexecute.run_statements(
+            statements, self.pgspecial, exception_formatter,
+            on_error_resume=on_error_resume,
+            single_transaction=single_transaction,
+            batch_size=SCRIPT_BATCH_SIZE if batch else 1,
+            statement_savepoints=True
         )
 
+    def copy_file(self, cur, pattern, **_):
+        progress = self.progress or QueryProgress()
+        try:
+            status = pgcopy.copy(cur, pattern, progress)
+        except (ValueError, IOError, OSError) as e:
+            return [(None, None, None, str(e), '', False)]
+        return [(None, None, None, status, '', True)]
+
+    def export_table(self, pattern, **_):
+        progress = self.progress or QueryProgress()
+        try:
+            command = pgcopy.parse_export_command(pattern, self.copy_jobs)
+            export = pgcopy.ParallelExport(self.pgexecute, command, progress)
+            status = export.run()
+        except (ValueError, IOError, OSError) as e:
+            return [(None, None, None, str(e), '', False)]
+        return [(None, None, None, status, '', True)]
+
+    def import_file(self, pattern, **_):
+        progress = self.progress or QueryProgress()
+        try:
+            command = pgcopy.parse_import_command(pattern, self.copy_jobs)
+            importer = pgcopy.ParallelImport(self.pgexecute, command, progress)
+            status = importer.run()
+        except (ValueError, IOError, OSError) as e:
+            return [(None, None, None, str(e), '', False)]
+        except psycopg2.Error as e:
+            message = exception_formatter(e)
+            if importer.failed_line:
+                message += ('\nThe error is at line %d of the file.'
+                            % importer.failed_line)
+            return [(None, None, None, message, '', False)]
+        return [(None, None, None, status, '', True)]
+
     def write_to_file(self, pattern, **_):
+        if self.output_sink:
+            self.output_sink.close()
+            self.output_sink = None
         if not pattern:
-            self.output_file = None
             message = 'File output disabled'
             return [(None, None, None, message, '', True)]
-        filename = os.path.abspath(os.path.expanduser(pattern))
-        if not os.path.isfile(filename):
-            try:
-                open(filename, 'w').close()
-            except IOError as e:
-                self.output_file = None
-                message = str(e) + '\nFile output disabled'
-                return [(None, None, None, message, '', False)]
-        self.output_file = filename
-        message = 'Writing to file "%s"' % self.output_file
+        try:
+            if pattern.startswith('|'):
+                command = pattern[1:].strip()
+                if not command:
+                    raise IOError('\\o: missing command after |')
+                self.output_sink = PipeSink(command)
+                message = 'Writing to command "%s"' % command
+            else:
+                filename = os.path.abspath(os.path.expanduser(pattern))
+                self.output_sink = FileSink(filename)
+                message = 'Writing to file "%s"' % filename
+        except (IOError, OSError) as e:
+            message = str(e) + '\nFile output disabled'
+            return [(None, None, None, message, '', False)]
         return [(None, None, None, message, '', True)]
 
     def initialize_logging(self):
@@ -277,14 +520,15 @@ class PGCli(object):
         # a password (no -w flag), prompt for a passwd and try again.
         try:
             try:
-                pgexecute = PGExecute(database, user, passwd, host, port, dsn)
+                pgexecute = PGExecute(database, user, passwd, host, port, dsn,
+                                      self.type_oid_cache)
             except OperationalError as e:
                 if ('no password supplied' in utf8tounicode(e.args[0]) and
                         auto_passwd_prompt):
                     passwd = click.prompt('Password', hide_input=True,
                                           show_default=False, type=str)
                     pgexecute = PGExecute(database, user, passwd, host, port,
-                                          dsn)
+                                          dsn, self.type_oid_cache)
                 else:
                     raise e
 
@@ -294,8 +538,18 @@ class PGCli(object):
             click.secho(str(e), err=True, fg='red')
             exit(1)
 
+        self._configure_executor(pgexecute)
         self.pgexecute = pgexecute
 
+    def _configure_executor(self, pgexecute):
+        """Apply the settings from the config file to a PGExecute object"""
+        pgexecute.server_side_cursors = self.server_side_cursors
+        pgexecute.cursor_itersize = self.cursor_itersize
+        pgexecute.cursor_threshold = self.cursor_threshold
+        pgexecute.text_typecasting = self.text_typecasting
+        if self.server_side_previews:
+            pgexecute.preview_length = self.max_cell_length
+
     def handle_editor_command(self, cli, document):
         """
         Editor command is any query that is prefixed or suffixed
@@ -328,8 +582,14 @@ class PGCli(object):
         if history_file == 'default':
             history_file = config_location() + 'history'
         history = FileHistory(os.path.expanduser(history_file))
+        # Start with the completions saved by an earlier session, if any,
+        # while the refresh checks whether they are still current.
+        cached = self.completion_refresher.load_cached(
+            self.pgexecute, self.pgspecial, history)
+        if cached:
+            self._swap_completer_objects(cached, persist_priorities='none')
         self.refresh_completions(history=history,
-                                 persist_priorities='none')
+                                 persist_priorities='all' if cached else 'none')
 
         self.cli = self._build_cli(history)
 
@@ -361,10 +621,15 @@ class PGCli(object):
                 query = MetaQuery(query=document.text, successful=False)
 
                 try:
-                    output, query = self._evaluate_command(document.text)
+                    summary = {}
+                    output = self._evaluate_command(document.text, summary)
+                    self._write_output(document.text, output)
+                    query = summary['query']
                 except KeyboardInterrupt:
-                    # Restart connection to the database
-                    self.pgexecute.connect()
+                    # Cancel the statement on the server, but keep the
+                    # session. The worker thread may still be waiting for it,
+                    # so only the cancel request is sent from here.
+                    self.pgexecute.cancel()
                     logger.debug("cancelled query, sql: %r", document.text)
                     click.secho("cancelled query", err=True, fg='red')
                 except NotImplementedError:
@@ -382,20 +647,6 @@ class PGCli(object):
                     logger.error("traceback: %r", traceback.format_exc())
                     click.secho(str(e), err=True, fg='red')
                 else:
-                    try:
-                        if self.output_file and not document.text.startswith(('\\o ', '\\? ')):
-                            try:
-                                with open(self.output_file, 'a', encoding='utf-8') as f:
-                                    click.echo(document.text, file=f)
-                                    click.echo('\n'.join(output), file=f)
-                                    click.echo('', file=f) # extra newline
-                            except IOError as e:
-                                click.secho(str(e), err=True, fg='red')
-                        else:
-                            click.echo_via_pager('\n'.join(output))
-                    except KeyboardInterrupt:
-                        pass
-
                     if self.pgspecial.timing_enabled:
                         # Only add humanized time display if > 1 second
                         if query.total_time > 1:
@@ -407,11 +658,13 @@ class PGCli(object):
                     # Check if we need to update completions, in order of most
                     # to least drastic changes
                     if query.db_changed:
-                        with self._completer_lock:
-                            self.completer.reset_completions()
-                        self.refresh_completions(persist_priorities='keywords')
+                        if not self._completions_are_current():
+                            with self._completer_lock:
+                                self.completer.reset_completions()
+                            self.refresh_completions(
+                                persist_priorities='keywords')
                     elif query.meta_changed:
-                        self.refresh_completions(persist_priorities='all')
+                        self.update_completions(query.meta_changes)
                     elif query.path_changed:
                         logger.debug('Refreshing search path')
                         with self._completer_lock:
@@ -428,6 +681,9 @@ class PGCli(object):
 
         except EOFError:
             print ('Goodbye!')
+        finally:
+            if self.output_sink:
+                self.output_sink.close()
 
     def _build_cli(self, history):
 
@@ -487,69 +743,193 @@ class PGCli(object):
 
             return cli
 
-    def _evaluate_command(self, text):
+    def _write_output(self, text, output):
+        """Write the output of a command to the output file or the pager, as
+        it is produced.
+
+        output is an iterable of the formatted output of each statement. If
+        the user quits the pager early, the remaining statements still run
+        but their output isn't formatted.
+        """
+        try:
+            sink = self.output_sink
+            if sink and not text.startswith(('\\o', '\\? ')):
+                try:
+                    sink.write(text)
+                    for formatted in output:
+                        if sink.closed:
+                            continue
+                        for line in formatted:
+                            if not sink.write(line):
+                                break
+                    sink.write('')  # extra newline
+                    sink.flush()
+                except IOError as e:
+                    # e.g. the disk is full. The remaining statements still
+                    # run, so their results are complete.
+                    click.secho(str(e), err=True, fg='red')
+                    try:
+                        sink.close()
+                    except IOError:
+                        pass
+                    for formatted in output:
+                        pass
+                if sink.closed:
+                    click.secho('Output to "%s" has stopped, output '
+                                'disabled' % sink.name, err=True, fg='red')
+                    self.output_sink = None
+            else:
+                sink = PagerSink()
+                # The progress line would be drawn over the pager.
+                self._pager_running = True
+                try:
+                    for formatted in output:
+                        if sink.closed:
+                            continue
+                        for line in formatted:
+                            if not sink.write(line):
+                                break
+                finally:
+                    sink.close()
+                    self._pager_running = False
+        except KeyboardInterrupt:
+            # Cancel the FETCH that may be running first, or stopping the
+            # thread fetching the result below would wait for it to finish.
+            self.pgexecute.cancel()
+            raise
+        finally:
+            # e.g. after Ctrl+C, stop the threads fetching and formatting the
+            # result.
+            if hasattr(output, 'close'):
+                output.close()
+
+    def _evaluate_command(self, text, summary):
         """Used to run a command entered by the user during CLI operation
         (Puts the E in REPL)
 
-        returns (results, MetaQuery)
+        Yields the formatted output of each statement, which is a generator
+        of lines. The statements only run as the output is consumed; once it
+        has been exhausted summary['query'] is set to the MetaQuery.
         """
         logger = self.logger
         logger.debug('sql: %r', text)
 
         all_success = True
         meta_changed = False  # CREATE, ALTER, DROP, etc
+        meta_changes = []  # What they changed, None if it isn't known
         mutated = False  # INSERT, DELETE, etc
         db_changed = False
         path_changed = False
-        output = []
         total = 0
 
-        # Run the query.
-        start = time()
+        if not is_page_command(text):
+            self.discard_pending_result()
+
+        # Run the query. Each statement is executed on a worker thread, so
+        # progress can be shown and Ctrl+C cancels the statement.
         on_error_resume = self.on_error == 'RESUME'
-        res = self.pgexecute.run(text, self.pgspecial,
-                                 exception_formatter, on_error_resume)
+        # Pages shown by \next and \all are formatted like the first one.
+        page_types = None
+        if self.pending_result and is_page_command(text):
+            page_types = column_types(self.pending_result.cursor,
+                                      self.pgexecute.text_typecasting)
+
+        res = iter(self.pgexecute.run(text, self.pgspecial,
+                                      exception_formatter, on_error_resume))
+        self.progress = QueryProgress()
+
+        while True:
+            start = time()
+            result = self._run_in_background(lambda: next(res, None))
+            if result is None:
+                break
+            title, cur, headers, status, sql, success = result
+            total += time() - start
+            self.progress.statements += 1
 
-        for title, cur, headers, status, sql, success in res:
             logger.debug("headers: %r", headers)
             logger.debug("rows: %r", cur)
             logger.debug("status: %r", status)
-            threshold = 1000
-            if (is_select(status) and
-                    cur and cur.rowcount > threshold):
-                click.secho('The result set has more than %s rows.'
-                            % threshold, fg='red')
-                if not click.confirm('Do you want to continue?'):
-                    click.secho("Aborted!", err=True, fg='red')
-                    break
+            coltypes = column_types(cur, self.pgexecute.text_typecasting)
+            if is_page_command(sql):
+                coltypes = page_types
+            if self._needs_paging(cur, status, sql):
+                # Only fetch and show the first page; the cursor stays open
+                # for \next and \all.
+                cur, status = self._first_page(cur, headers, status)
 
             if self.pgspecial.auto_expand:
                 max_width = self.cli.output.get_size().columns
             else:
                 max_width = None
 
-            formatted = format_output(
+            output = format_output(
                 title, cur, headers, status, self.table_format,
-                self.pgspecial.expanded_output, max_width)
-
-            output.extend(formatted)
-            end = time()
-            total += end - start
+                self.pgspecial.expanded_output, max_width, coltypes=coltypes,
+                max_cell_length=self.max_cell_length, concurrent=True,
+                on_interrupt=self.pgexecute.cancel)
+            try:
+                yield output
+            finally:
+                # Stop fetching and release the rows (and any server-side
+                # cursor) as soon as they have been written out.
+                output.close()
+                if hasattr(cur, 'close'):
+                    cur.close()
 
             # Keep track of whether any of the queries are mutating or changing
             # the database
             if success:
                 mutated = mutated or is_mutating(status)
                 db_changed = db_changed or has_change_db_cmd(sql)
-                meta_changed = meta_changed or has_meta_cmd(sql)
+                if has_meta_cmd(sql):
+                    meta_changed = True
+                    changes = ddl_changes(sql)
+                    if changes is None or meta_changes is None:
+                        meta_changes = None
+                    else:
+                        meta_changes.extend(changes)
                 path_changed = path_changed or has_change_path_cmd(sql)
             else:
                 all_success = False
 
-        meta_query = MetaQuery(text, all_success, total, meta_changed,
-                               db_changed, path_changed, mutated)
+        summary['query'] = MetaQuery(text, all_success, total, meta_changed,
+                                     db_changed, path_changed, mutated,
+                                     meta_changes)
 
-        return output, meta_query
+    def _run_in_background(self, func):
+        """Calls func on a worker thread and shows the progress of the
+        command until it returns."""
+        try:
+            return run_in_background(func, on_tick=self._show_progress,
+                                     on_interrupt=self._cancel_statement)
+        finally:
+            self._hide_progress()
+
+    def _cancel_statement(self):
+        self.progress.cancelled = True
+        self._show_progress()
+        self.pgexecute.cancel()
+
+    def _show_progress(self):
+        if (not self.cli or not sys.stdout.isatty() or self._pager_running
+                or self.progress.elapsed < PROGRESS_DELAY):
+            return
+        output = self.cli.output
+        output.write_raw('\r')
+        renderer_print_tokens(output, self.get_progress_tokens(self.cli),
+                              self.cli.application.style)
+        output.erase_end_of_line()
+        output.flush()
+        self._progress_shown = True
+
+    def _hide_progress(self):
+        if self._progress_shown:
+            output = self.cli.output
+            output.write_raw('\r')
+            output.erase_end_of_line()
+            output.flush()
+            self._progress_shown = False
 
     def _handle_server_closed_connection(self):
         """Used during CLI execution"""
@@ -563,24 +943,81 @@ class PGCli(object):
             except OperationalError as e:
                 click.secho(str(e), err=True, fg='red')
 
-    def refresh_completions(self, history=None, persist_priorities='all'):
+    def refresh_completions(self, history=None, persist_priorities='all',
+                            force=False):
         """ Refresh outdated completions
 
         :param history: A prompt_toolkit.history.FileHistory object. Used to
                         load keyword and identifier preferences
 
         :param persist_priorities: 'all' or 'keywords'
+
+        :param force: Refresh even if the catalog hasn't changed since the
+                      last refresh.
         """
 
         callback = functools.partial(self._on_completions_refreshed,
                                      persist_priorities=persist_priorities)
         self.completion_refresher.refresh(
-            self.pgexecute, self.pgspecial, callback, history=history)
+            self.pgexecute, self.pgspecial, callback, history=history,
+            force=force)
         return [(None, None, None,
                 'Auto-completion refresh started in the background.')]
 
+    def update_completions(self, changes):
+        """Updates the completions with what DDL statements changed (see
+        ddl_changes), refetching only the objects they affected.
+
+        Everything is refreshed if the changes aren't known, if they haven't
+        been committed yet (the objects are fetched over another connection)
+        or if a refresh is already running, which would replace the updated
+        completer.
+
+        Like a refresh, the objects are fetched in a background thread.
+        """
+        if (changes is None or self.pgexecute.in_transaction()
+                or self.completion_refresher.is_refreshing()):
+            return self.refresh_completions(persist_priorities='all')
+        if not changes:
+            return
+        thread = threading.Thread(target=self._bg_update_completions,
+                                  args=(self.pgexecute.spawn, changes),
+                                  name='completion_update')
+        thread.setDaemon(True)
+        thread.start()
+
+    def _bg_update_completions(self, spawn, changes):
+        # One update at a time: as each one reads the objects when it runs,
+        # the last one to be replayed has the latest state.
+        with self._update_lock:
+            try:
+                executor = spawn()
+                try:
+                    recorder = self.completion_refresher.refresh_changes(
+                        executor, changes, self.completer.column_loader)
+                finally:
+                    executor.close()
+            except psycopg2.Error as e:
+                self.logger.error('Updating completions failed: %r', e)
+                self.refresh_completions(persist_priorities='all')
+                return
+            with self._completer_lock:
+                recorder.replay(self.completer)
+
+    def _completions_are_current(self):
+        """Returns True if the completions were read from the database pgcli
+        is connected to now, and it hasn't changed since (e.g. after \\c to
+        the same database)."""
+        try:
+            return self.completion_refresher.is_current(self.pgexecute)
+        except psycopg2.Error as e:
+            self.logger.error('Catalog fingerprint failed: %r', e)
+            return False
+
     def _on_completions_refreshed(self, new_completer, persist_priorities):
-        self._swap_completer_objects(new_completer, persist_priorities)
+        # new_completer is None if the catalog hadn't changed.
+        if new_completer is not None:
+            self._swap_completer_objects(new_completer, persist_priorities)
 
         if self.cli:
             # After refreshing, redraw the CLI to clear the statusbar
@@ -604,6 +1041,8 @@ class PGCli(object):
         with self._completer_lock:
             old_completer = self.completer
             self.completer = new_completer
+            if old_completer.column_loader is not None:
+                old_completer.column_loader.close()
 
             if persist_priorities == 'all':
                 # Just swap over the entire prioritizer
@@ -719,26 +1158,150 @@ def obfuscate_process_password():
 
     setproctitle.setproctitle(process_title)
 
-def format_output(title, cur, headers, status, table_format, expanded=False, max_width=None):
-    output = []
+def format_output(title, cur, headers, status, table_format, expanded=False,
+                  max_width=None, sample_size=TABLE_SAMPLE_SIZE,
+                  coltypes=None, max_cell_length=None, concurrent=False,
+                  on_interrupt=None):
+    """Yields the formatted title, result table and status of a statement.
+
+    Results with more than `sample_size` rows, or an unknown number of rows
+    (e.g. from a server-side cursor), are rendered one line at a time, with
+    column widths fixed from their first `sample_size` rows.
+
+    The columns are formatted according to `coltypes` (see column_types),
+    which are taken from cur's description if they aren't given. Values
+    longer than `max_cell_length` characters are cut short.
+
+    With `concurrent`, the rows of large results are fetched on one thread
+    and formatted on another, while the caller writes out the lines. Close
+    the returned generator to stop them if it isn't exhausted. If Ctrl+C is
+    pressed while waiting for them, on_interrupt is called before they are
+    stopped, e.g. to cancel the query they are fetching the rows of.
+    """
     if title:  # Only print the title if it's not None.
-        output.append(title)
+        yield title
     if cur:
         headers = [utf8tounicode(x) for x in headers]
-        if expanded and headers:
-            output.append(expanded_table(cur, headers))
+        coltypes = coltypes or column_types(cur)
+        large = is_large_result(cur, sample_size)
+        rows = fetched = cur
+        if large and concurrent:
+            rows = fetched = background_iter(cur, FETCH_BATCH_SIZE,
+                                             name='fetch_rows',
+                                             on_interrupt=on_interrupt)
+        if max_cell_length:
+            rows = truncate_cells(rows, max_cell_length)
+            if not large:
+                rows = list(rows)
+        if large:
+            lines = format_streamed_rows(rows, headers, table_format,
+                                         expanded, max_width, sample_size,
+                                         coltypes)
+            if concurrent:
+                lines = background_iter(lines, FORMAT_BATCH_SIZE,
+                                        name='format_rows',
+                                        on_interrupt=on_interrupt)
+            try:
+                for line in lines:
+                    yield line
+            finally:
+                # Stop the formatting thread before the fetching one, which
+                # it takes the rows from.
+                lines.close()
+                if fetched is not cur:
+                    fetched.close()
+        elif expanded and headers:
+            yield expanded_table(rows, headers)
         else:
-            tabulated, rows = tabulate(cur, headers, tablefmt=table_format,
-                missingval='<null>')
+            tabulated, rows = tabulate(rows, headers, tablefmt=table_format,
+                missingval='<null>', coltypes=coltypes)
             if (max_width and rows and
                     content_exceeds_width(rows[0], max_width) and
                     headers):
-                output.append(expanded_table(rows, headers))
+                yield expanded_table(rows, headers)
             else:
-                output.append(tabulated)
+                yield tabulated
     if status:  # Only print the status if it's not None.
-        output.append(status)
-    return output
+        if status == 'SELECT' and getattr(cur, 'rowcount', -1) >= 0:
+            # e.g. rows from a server-side cursor, which are counted as they
+            # are fetched.
+            status = cur.statusmessage
+        yield status
+
+
+def format_streamed_rows(rows, headers, table_format, expanded, max_width,
+                         sample_size, coltypes=None):
+    """Yields the rendered rows without holding more than `sample_size` of
+    them in memory."""
+    rows = iter(rows)
+    sample = list(islice(rows, sample_size))
+
+    if headers and not expanded and max_width and sample:
+        # Decide on auto expansion the same way as for regular results.
+        _, sample_rows = tabulate(sample, headers, tablefmt=table_format,
+                                  missingval='<null>', coltypes=coltypes)
+        expanded = content_exceeds_width(sample_rows[0], max_width)
+
+    if expanded and headers:
+        for record in expanded_records(chain(sample, rows), headers):
+            yield record
+        # expanded_table ends each record with a newline
+        yield ''
+    else:
+        for line in tabulate_iter(chain(sample, rows), headers,
+                                  tablefmt=table_format, missingval='<null>',
+                                  sample_size=sample_size, coltypes=coltypes):
+            yield line
+
+
+def truncate_cells(rows, max_length):
+    """Yields rows with text values longer than max_length characters cut
+    short, and a note of their full length added, before they are copied
+    around while being formatted."""
+    for row in rows:
+        if any(isinstance(value, text_types) and len(value) > max_length
+               for value in row):
+            row = tuple(truncate_value(value, max_length)
+                        if isinstance(value, text_types) else value
+                        for value in row)
+        yield row
+
+
+def truncate_value(value, max_length):
+    if len(value) <= max_length:
+        return value
+    # e.g. bytea values, which the (text) regex can't search.
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    match = truncation_marker_regex.search(value, max_length)
+    if match and match.start() == max_length:
+        # Cut short by the server already (see PGExecute.preview_sql)
+        return value
+    return '%s... (%d characters)' % (value[:max_length], len(value))
+
+
+def column_types(cur, text_typecasting=False):
+    """Returns the types to format the columns of cur as, known from the type
+    OIDs in its description, or None if it has no description.
+
+    With text_typecasting, floats are the text the server sent, so they're
+    shown as they are, like numeric, instead of being parsed again."""
+    description = getattr(cur, 'description', None)
+    if not description:
+        return None
+    types = [COLUMN_TYPES.get(column[1], str) for column in description]
+    if text_typecasting:
+        types = [Decimal if t is float else t for t in types]
+    return types
+
+
+def is_large_result(cur, sample_size):
+    """Returns true if a result has more than sample_size rows, or if its
+    size is unknown."""
+    if isinstance(cur, (list, tuple)):
+        return len(cur) > sample_size
+    rowcount = getattr(cur, 'rowcount', -1)
+    return rowcount < 0 or rowcount > sample_size
 
 
 def has_meta_cmd(query):
@@ -788,6 +1351,26 @@ def is_select(status):
     return status.split(None, 1)[0].lower() == 'select'
 
 
+def read_chunks(f, progress, size=SCRIPT_CHUNK_SIZE):
+    """Yields the contents of a utf-8 file in chunks of text, counting the
+    bytes read in progress. Closes the file at the end."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    with f:
+        while True:
+            data = f.read(size)
+            progress.bytes_done += len(data)
+            text = decoder.decode(data, final=not data)
+            if text:
+                yield text
+            if not data:
+                break
+
+
+def is_page_command(text):
+    """Returns true if text asks for more rows of a paged result."""
+    return text.strip() in ('\\next', '\\all')
+
+
 def quit_command(sql):
     return (sql.strip().lower() == 'exit'
             or sql.strip().lower() == 'quit'
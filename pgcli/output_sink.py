@@ -0,0 +1,186 @@
+import io
+import os
+import sys
+import platform
+import subprocess
+from time import time
+
+import click
+
+
+class PagerSink(object):
+    """Send output to the pager line by line, as it is being produced.
+
+    The pager is started when the first line is written and every line is
+    piped to it straight away, so the first screen shows up while the rest of
+    the output is still being fetched and formatted. Writes block while the
+    pager isn't reading (e.g. the user is looking at the first screen), and
+    once the pager has been quit `write` returns False so the producer can
+    stop early.
+
+    When stdout isn't a terminal the output is echoed directly, and on
+    Windows it is collected and handed to click.echo_via_pager.
+    """
+
+    # Send buffered output to the pager at least this often, in seconds.
+    flush_interval = 0.1
+
+    def __init__(self, pager=None):
+        self.pager = pager
+        self.closed = False
+        self.process = None
+        self._mode = None
+        self._lines = []
+        self._last_flush = 0
+
+    def write(self, text):
+        """Write one line of output.
+
+        Returns False if the output is no longer wanted."""
+        if self.closed:
+            return False
+        if self._mode is None:
+            self._open()
+
+        if self._mode == 'pipe':
+            try:
+                stdin = self.process.stdin
+                stdin.write(text.encode(self.encoding, 'replace') + b'\n')
+                if time() - self._last_flush > self.flush_interval:
+                    stdin.flush()
+                    self._last_flush = time()
+            except (IOError, OSError, KeyboardInterrupt):
+                # The pager was quit (broken pipe), or the user hit Ctrl+C
+                # in it.
+                self.closed = True
+                return False
+        elif self._mode == 'collect':
+            self._lines.append(text)
+        else:
+            click.echo(text)
+        return True
+
+    def close(self):
+        """Finish the output and wait for the user to leave the pager."""
+        mode, self._mode = self._mode, None
+        self.closed = True
+        if mode == 'collect':
+            click.echo_via_pager('\n'.join(self._lines))
+            self._lines = []
+        elif mode == 'pipe':
+            try:
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            # less catches Ctrl+C for its own use, so keep waiting for it.
+            while True:
+                try:
+                    self.process.wait()
+                except KeyboardInterrupt:
+                    pass
+                else:
+                    break
+
+    def _open(self):
+        if not sys.stdout.isatty() or not sys.stdin.isatty():
+            self._mode = 'echo'
+        elif platform.system() == 'Windows':
+            self._mode = 'collect'
+        else:
+            cmd = self.pager or os.environ.get('PAGER', '').strip()
+            if not cmd:
+                if os.environ.get('TERM') in ('dumb', 'emacs'):
+                    self._mode = 'echo'
+                    return
+                cmd = 'less' if os.system('(less) 2>/dev/null') == 0 else 'more'
+            self.encoding = getattr(sys.stdout, 'encoding', None) or 'utf-8'
+            self.process = subprocess.Popen(cmd, shell=True, bufsize=-1,
+                                            stdin=subprocess.PIPE)
+            self._last_flush = time()
+            self._mode = 'pipe'
+
+
+class FileSink(object):
+    """Send output to a file, for \\o filename.
+
+    The file is kept open, with a large buffer, from one command to the next.
+    Lines are written as they are produced, and `flush` is called once each
+    command's output is complete.
+    """
+
+    buffer_size = 1024 * 1024
+
+    def __init__(self, filename):
+        self.name = filename
+        self.closed = False
+        self.file = io.open(filename, 'a', encoding='utf-8',
+                            buffering=self.buffer_size)
+
+    def write(self, text):
+        """Write one line of output.
+
+        Returns False if the output is no longer wanted."""
+        if self.closed:
+            return False
+        self.file.write(text + '\n')
+        return True
+
+    def flush(self):
+        if not self.closed:
+            self.file.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.file.close()
+
+
+class PipeSink(object):
+    """Send output to a shell command, for \\o |command.
+
+    The command is started once and keeps running, reading the output of
+    every command, until the output is switched elsewhere. When it exits
+    `write` returns False.
+    """
+
+    def __init__(self, command):
+        self.name = command
+        self.closed = False
+        # Keep Ctrl+C, which cancels queries, from killing the command.
+        preexec_fn = os.setpgrp if hasattr(os, 'setpgrp') else None
+        self.process = subprocess.Popen(command, shell=True, bufsize=-1,
+                                        stdin=subprocess.PIPE,
+                                        preexec_fn=preexec_fn)
+
+    def write(self, text):
+        """Write one line of output.
+
+        Returns False if the output is no longer wanted."""
+        if self.closed:
+            return False
+        try:
+            self.process.stdin.write(text.encode('utf-8') + b'\n')
+        except (IOError, OSError):
+            # The command has exited (broken pipe)
+            self.close()
+            return False
+        return True
+
+    def flush(self):
+        if self.closed:
+            return
+        try:
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            self.close()
+
+    def close(self):
+        """Finish the output and wait for the command to exit."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
@@ -0,0 +1,267 @@
+"""Splits SQL scripts into statements without parsing them.
+
+sqlparse.split tokenizes and groups all of its input before returning, which
+takes minutes for a large script. StatementSplitter only looks for the things
+that decide where a statement ends: quoted strings and identifiers, dollar
+quotes, comments, parentheses and backslash commands. Text can be fed to it
+in chunks, and each statement is returned as soon as it is complete.
+"""
+from __future__ import unicode_literals
+import re
+
+# Things which need attention outside of strings and comments. Complete
+# strings, quoted identifiers and line comments are matched as a whole, which
+# is a lot faster than going through the scanner's states for each of them.
+_special_regex = re.compile(
+    r"""'[^']*'(?=[^'])|"[^"]*"|--[^\n]*\n|[;'"$()\\]|--|/\*""")
+_dollar_tag_regex = re.compile(r'\$([A-Za-z_\x80-\uffff][\w\x80-\uffff]*)?\$')
+_dollar_tag_prefix_regex = re.compile(
+    r'\$([A-Za-z_\x80-\uffff][\w\x80-\uffff]*)?\Z')
+_escape_string_regex = re.compile(r"\\[\s\S]|'")
+_block_comment_regex = re.compile(r'/\*|\*/')
+_meta_command_end_regex = re.compile(r'[;\n]')
+_identifier_chars = re.compile(r'[\w$\x80-\uffff]')
+
+# Scanner states
+NORMAL, QUOTE, ESCAPE_QUOTE, IDENTIFIER, DOLLAR, LINE_COMMENT, \
+    BLOCK_COMMENT, META_COMMAND = range(8)
+
+
+class StatementSplitter(object):
+    """Splits text, fed to it in chunks, into statements.
+
+    >>> splitter = StatementSplitter()
+    >>> list(splitter.feed("select 1; select ';"))
+    ['select 1;']
+    >>> list(splitter.feed("';"))
+    ["select ';';"]
+
+    Statements are returned stripped of surrounding whitespace and leading
+    comments, with their terminating semicolon. Backslash commands end at the
+    end of the line or at a semicolon.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._reset(0)
+
+    def _reset(self, pos):
+        self._pos = pos         # Where scanning continues
+        self._start = None      # Where the statement's content starts
+        self._state = NORMAL
+        self._parens = 0        # Nesting of parentheses
+        self._comments = 0      # Nesting of block comments
+        self._tag = None        # The closing dollar quote
+
+    def feed(self, text):
+        """Adds text to the input and yields the statements completed by it."""
+        # Drop what has been scanned already, except for a couple of
+        # characters which are looked back at, e.g. the E of E'...'.
+        done = self._pos if self._start is None else min(self._start,
+                                                          self._pos)
+        done = max(0, done - 2)
+        self._buffer = self._buffer[done:] + text
+        self._pos -= done
+        if self._start is not None:
+            self._start -= done
+        return self._scan(final=False)
+
+    def close(self):
+        """Yields what is left of the input as a final statement, even if it
+        isn't terminated."""
+        for statement in self._scan(final=True):
+            yield statement
+        if self._start is not None:
+            statement = self._buffer[self._start:].strip()
+            if statement:
+                yield statement
+        self._buffer = ''
+        self._reset(0)
+
+    def _scan(self, final):
+        while True:
+            end = self._advance(final)
+            if end is None:
+                return
+            start = self._start
+            self._reset(end)
+            # Skip empty statements, e.g. a lone semicolon.
+            if start is not None:
+                yield self._buffer[start:end].strip()
+
+    def _advance(self, final):
+        """Scans the buffer until the end of a statement, and returns the
+        position after it. Returns None if more input is needed."""
+        # The scanner's state is kept in local variables while scanning,
+        # because attribute lookups would double the time this takes.
+        buf = self._buffer
+        size = len(buf)
+        pos, start, state = self._pos, self._start, self._state
+        parens, comments, tag = self._parens, self._comments, self._tag
+        end = None
+
+        while True:
+            if state == NORMAL:
+                match = _special_regex.search(buf, pos)
+                if match:
+                    text_end = match.start()
+                elif final:
+                    text_end = size
+                else:
+                    # A trailing '-' or '/' might start a comment.
+                    text_end = max(pos, size - 1)
+                if start is None:
+                    text = buf[pos:text_end]
+                    if text.strip():
+                        start = pos + len(text) - len(text.lstrip())
+                if not match:
+                    pos = text_end
+                    break
+
+                token = match.group()
+                token_start = match.start()
+                pos = match.end()
+                first = token[0]
+                if first == "'":
+                    if start is None:
+                        start = token_start
+                    if self._is_escape_string(token_start):
+                        pos = token_start + 1
+                        state = ESCAPE_QUOTE
+                    elif len(token) == 1:
+                        state = QUOTE
+                elif first == '"':
+                    if start is None:
+                        start = token_start
+                    if len(token) == 1:
+                        state = IDENTIFIER
+                elif first == '-':
+                    if len(token) == 2:
+                        state = LINE_COMMENT
+                elif token == ';':
+                    # Semicolons in parentheses, e.g. in CREATE RULE, don't
+                    # end the statement.
+                    if parens == 0:
+                        end = pos
+                        break
+                elif token == '(':
+                    parens += 1
+                elif token == ')':
+                    parens = max(0, parens - 1)
+                elif token == '/*':
+                    state = BLOCK_COMMENT
+                    comments = 1
+                elif token == '\\' and start is None:
+                    start = token_start
+                    state = META_COMMAND
+                elif token == '$':
+                    if start is None:
+                        start = token_start
+                    if (token_start > 0 and
+                            _identifier_chars.match(buf[token_start - 1])):
+                        # e.g. the $ in foo$bar isn't a dollar quote
+                        continue
+                    match = _dollar_tag_regex.match(buf, token_start)
+                    if match:
+                        tag = match.group()
+                        pos = match.end()
+                        state = DOLLAR
+                    elif not final and _dollar_tag_prefix_regex.match(
+                            buf, token_start):
+                        # The tag might continue in the next chunk.
+                        pos = token_start
+                        break
+                elif start is None:
+                    start = token_start
+
+            elif state == QUOTE:
+                quote = buf.find("'", pos)
+                if quote == -1 or (quote == size - 1 and not final):
+                    # A quote at the end might be the first half of ''.
+                    pos = size if quote == -1 else quote
+                    break
+                if buf.startswith("''", quote):
+                    pos = quote + 2
+                else:
+                    pos = quote + 1
+                    state = NORMAL
+
+            elif state == ESCAPE_QUOTE:
+                match = _escape_string_regex.search(buf, pos)
+                if not match or (match.end() == size and not final):
+                    pos = match.start() if match else max(pos, size - 1)
+                    break
+                pos = match.end()
+                if match.group() == "'":
+                    if buf.startswith("'", pos):
+                        pos += 1
+                    else:
+                        state = NORMAL
+
+            elif state == IDENTIFIER:
+                quote = buf.find('"', pos)
+                if quote == -1:
+                    pos = size
+                    break
+                pos = quote + 1
+                state = NORMAL
+
+            elif state == DOLLAR:
+                found = buf.find(tag, pos)
+                if found == -1:
+                    # The closing tag might be split between chunks.
+                    pos = max(pos, size - len(tag) + 1)
+                    break
+                pos = found + len(tag)
+                state = NORMAL
+
+            elif state == LINE_COMMENT:
+                newline = buf.find('\n', pos)
+                if newline == -1:
+                    pos = size
+                    break
+                pos = newline + 1
+                state = NORMAL
+
+            elif state == BLOCK_COMMENT:
+                match = _block_comment_regex.search(buf, pos)
+                if not match:
+                    pos = max(pos, size - 1)
+                    break
+                pos = match.end()
+                comments += 1 if match.group() == '/*' else -1
+                if comments == 0:
+                    state = NORMAL
+
+            elif state == META_COMMAND:
+                match = _meta_command_end_regex.search(buf, pos)
+                if not match:
+                    pos = size
+                    break
+                end = pos = match.end()
+                break
+
+        self._pos, self._start, self._state = pos, start, state
+        self._parens, self._comments, self._tag = parens, comments, tag
+        return end
+
+    def _is_escape_string(self, quote):
+        """Returns true if the quote at this position starts an E'' string."""
+        buf = self._buffer
+        return (quote > 0 and buf[quote - 1] in 'eE' and
+                (quote == 1 or not _identifier_chars.match(buf[quote - 2])))
+
+
+def split(text):
+    """Returns a list of the statements in text, like sqlparse.split."""
+    return list(split_stream([text]))
+
+
+def split_stream(chunks):
+    """Yields the statements in an iterable of text chunks, e.g. a file."""
+    splitter = StatementSplitter()
+    for chunk in chunks:
+        for statement in splitter.feed(chunk):
+            yield statement
+    for statement in splitter.close():
+        yield statement
@@ -6,6 +6,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from collections import namedtuple
 from decimal import Decimal
+from itertools import islice
 from platform import python_version_tuple
 from wcwidth import wcswidth
 from ..encodingutils import utf8tounicode
@@ -40,7 +41,8 @@ else:
         return isinstance(f, io.IOBase)
 
 
-__all__ = ["tabulate", "tabulate_formats", "simple_separated_format"]
+__all__ = ["tabulate", "tabulate_iter", "tabulate_formats",
+           "simple_separated_format"]
 __version__ = "0.7.4"
 
 
@@ -497,6 +499,32 @@ def _column_type(strings, has_invisible=True):
     return reduce(_more_generic, types, int)
 
 
+def _known_column_types(coltypes, numalign, stralign):
+    """Types and alignments of columns whose types are known in advance, e.g.
+    from a database cursor, so they don't have to be guessed from every value.
+
+    `coltypes` has int, float, Decimal or, for text, any other type for each
+    column. Decimal values are shown as they are but aligned like numbers, and
+    integers, which have no decimal point, are simply aligned to the right.
+
+    >>> _known_column_types([int, Decimal, str], "decimal", "left")[1]
+    ['right', 'decimal', 'left']
+
+    """
+    types, aligns = [], []
+    for ct in coltypes:
+        if ct is int:
+            types.append(int)
+            aligns.append("right" if numalign == "decimal" else numalign)
+        elif ct is float:
+            types.append(float)
+            aligns.append(numalign)
+        else:
+            types.append(_text_type)
+            aligns.append(numalign if ct is Decimal else stralign)
+    return types, aligns
+
+
 def _format(val, valtype, floatfmt, missingval=""):
     """Format a value accoding to its type.
 
@@ -649,7 +677,7 @@ def _normalize_tabular_data(tabular_data, headers):
 
 def tabulate(tabular_data, headers=[], tablefmt="simple",
              floatfmt="g", numalign="decimal", stralign="left",
-             missingval=""):
+             missingval="", coltypes=None):
     """Format a fixed width table for pretty printing.
 
     >>> print(tabulate([[1, 2.34], [-56, "8.999"], ["2", "10001"]]))
@@ -706,6 +734,9 @@ def tabulate(tabular_data, headers=[], tablefmt="simple",
     `floatfmt` is a format specification used for columns which
     contain numeric data with a decimal point.
 
+    The type of each column is guessed from its values, unless the types are
+    given as `coltypes` (see `_known_column_types`).
+
     `None` values are replaced with a `missingval` string:
 
     >>> print(tabulate([["spam", 1, None],
@@ -897,12 +928,15 @@ def tabulate(tabular_data, headers=[], tablefmt="simple",
 
     # format rows and columns, convert numeric values to strings
     cols = list(zip(*list_of_lists))
-    coltypes = list(map(_column_type, cols))
+    if coltypes and cols and len(coltypes) == len(cols):
+        coltypes, aligns = _known_column_types(coltypes, numalign, stralign)
+    else:
+        coltypes = list(map(_column_type, cols))
+        aligns = [numalign if ct in [int,float] else stralign for ct in coltypes]
     cols = [[_format(v, ct, floatfmt, missingval) for v in c]
              for c,ct in zip(cols, coltypes)]
 
     # align columns
-    aligns = [numalign if ct in [int,float] else stralign for ct in coltypes]
     minwidths = [width_fn(h) + MIN_PADDING for h in headers] if headers else [0]*len(cols)
     cols = [_align_column(c, a, minw, has_invisible)
             for c, a, minw in zip(cols, aligns, minwidths)]
@@ -925,6 +959,114 @@ def tabulate(tabular_data, headers=[], tablefmt="simple",
     return _format_table(tablefmt, headers, rows, minwidths, aligns), rows
 
 
+def tabulate_iter(tabular_data, headers=[], tablefmt="simple",
+                  floatfmt="g", numalign="decimal", stralign="left",
+                  missingval="", sample_size=1000, coltypes=None):
+    """Format a fixed width table like `tabulate`, one line at a time.
+
+    `tabular_data` must be an iterable of rows (sequences) and `headers` a
+    list of column names. Column types and widths are fixed from the first
+    `sample_size` rows, so an arbitrarily long iterable is rendered with
+    constant memory. Up to `sample_size` rows the output is identical to
+    `tabulate`; wider cells further down are not truncated, they just push
+    the rest of their row to the right.
+
+    >>> lines = tabulate_iter(iter([["spam", 41.9999], ["eggs", "451.0"]]),
+    ...                       ["strings", "numbers"], "psql", sample_size=1)
+    >>> print("\\n".join(lines))
+    +-----------+-----------+
+    | strings   |   numbers |
+    |-----------+-----------|
+    | spam      |   41.9999 |
+    | eggs      |  451      |
+    +-----------+-----------+
+
+    """
+    rows = iter(tabular_data if tabular_data is not None else [])
+    sample = [list(row) for row in islice(rows, sample_size)]
+    headers = list(map(_text_type, headers))
+    if headers and sample and len(headers) < len(sample[0]):
+        headers = [""] * (len(sample[0]) - len(headers)) + headers
+
+    _text_type_encode = lambda x: _text_type(utf8tounicode(x))
+    plain_text = '\n'.join(['\t'.join(map(_text_type_encode, headers))] + \
+                            ['\t'.join(map(_text_type_encode, row)) for row in sample])
+    has_invisible = re.search(_invisible_codes, plain_text)
+    if has_invisible:
+        width_fn = _visible_width
+    else:
+        width_fn = wcswidth
+
+    # fix the type, alignment, width and decimal places of each column
+    cols = list(zip(*sample))
+    if coltypes and cols and len(coltypes) == len(cols):
+        coltypes, aligns = _known_column_types(coltypes, numalign, stralign)
+    else:
+        coltypes = list(map(_column_type, cols))
+        aligns = [numalign if ct in [int,float] else stralign for ct in coltypes]
+    minwidths = [width_fn(h) + MIN_PADDING for h in headers] if headers else [0]*len(cols)
+    decimals = [max(map(_afterpoint, [_format(v, ct, floatfmt, missingval) for v in c]))
+                if a == "decimal" else 0
+                for c, ct, a in zip(cols, coltypes, aligns)]
+
+    def format_row(row):
+        cells = []
+        for v, ct, a, dec in zip(row, coltypes, aligns, decimals):
+            try:
+                s = _format(v, ct, floatfmt, missingval)
+            except ValueError:
+                # e.g. a string further down a column of floats
+                s = "{0}".format(v)
+            if a == "decimal":
+                s = s + max(dec - _afterpoint(s), 0) * " "
+            cells.append(s)
+        return cells
+
+    sample = [format_row(row) for row in sample]
+    colwidths = [max([width_fn(c) for c in col] + [minw])
+                 for col, minw in zip(zip(*sample), minwidths)]
+    if not sample:
+        colwidths = [max(minw, width_fn("")) for minw in minwidths]
+
+    padfns = [_cell_padder(a) for a in aligns]
+
+    def align_row(cells):
+        return [padfn(w, c, has_invisible) if padfn else c
+                for c, padfn, w in zip(cells, padfns, colwidths)]
+
+    if headers:
+        t_aligns = aligns or [stralign] * len(headers)
+        headers = [_align_header(h, a, w)
+                   for h, a, w in zip(headers, t_aligns, colwidths)]
+
+    if not isinstance(tablefmt, TableFormat):
+        tablefmt = _table_formats.get(tablefmt, _table_formats["simple"])
+
+    formatted_rows = (align_row(format_row(row)) for row in rows)
+    for line in _format_table_iter(tablefmt, headers,
+                                   _chain_rows(map(align_row, sample), formatted_rows),
+                                   colwidths, aligns):
+        yield line
+
+
+def _cell_padder(alignment):
+    "Return the padding function used by `_align_column` for an alignment."
+    if alignment in ["right", "decimal"]:
+        return _padleft
+    elif alignment == "center":
+        return _padboth
+    elif not alignment:
+        return None
+    else:
+        return _padright
+
+
+def _chain_rows(*iterables):
+    for rows in iterables:
+        for row in rows:
+            yield row
+
+
 def _build_simple_row(padded_cells, rowfmt):
     "Format row according to DataRow format without padding."
     begin, sep, end = rowfmt
@@ -964,38 +1106,43 @@ def _pad_row(cells, padding):
 
 def _format_table(fmt, headers, rows, colwidths, colaligns):
     """Produce a plain-text representation of the table."""
-    lines = []
+    return "\n".join(_format_table_iter(fmt, headers, rows, colwidths, colaligns))
+
+
+def _format_table_iter(fmt, headers, rows, colwidths, colaligns):
+    """Produce a plain-text representation of the table, line by line.
+
+    `rows` can be any iterable of already aligned rows; it is only consumed
+    as lines are generated."""
     hidden = fmt.with_header_hide if (headers and fmt.with_header_hide) else []
     pad = fmt.padding
     headerrow = fmt.headerrow
 
     padded_widths = [(w + 2*pad) for w in colwidths]
     padded_headers = _pad_row(headers, pad)
-    padded_rows = [_pad_row(row, pad) for row in rows]
+    padded_rows = (_pad_row(row, pad) for row in rows)
 
     if fmt.lineabove and "lineabove" not in hidden:
-        lines.append(_build_line(padded_widths, colaligns, fmt.lineabove))
+        yield _build_line(padded_widths, colaligns, fmt.lineabove)
 
     if padded_headers:
-        lines.append(_build_row(padded_headers, padded_widths, colaligns, headerrow))
+        yield _build_row(padded_headers, padded_widths, colaligns, headerrow)
         if fmt.linebelowheader and "linebelowheader" not in hidden:
-            lines.append(_build_line(padded_widths, colaligns, fmt.linebelowheader))
-
-    if padded_rows and fmt.linebetweenrows and "linebetweenrows" not in hidden:
-        # initial rows with a line below
-        for row in padded_rows[:-1]:
-            lines.append(_build_row(row, padded_widths, colaligns, fmt.datarow))
-            lines.append(_build_line(padded_widths, colaligns, fmt.linebetweenrows))
-        # the last row without a line below
-        lines.append(_build_row(padded_rows[-1], padded_widths, colaligns, fmt.datarow))
+            yield _build_line(padded_widths, colaligns, fmt.linebelowheader)
+
+    if fmt.linebetweenrows and "linebetweenrows" not in hidden:
+        # every row but the last one gets a line below
+        between = _build_line(padded_widths, colaligns, fmt.linebetweenrows)
+        for i, row in enumerate(padded_rows):
+            if i:
+                yield between
+            yield _build_row(row, padded_widths, colaligns, fmt.datarow)
     else:
         for row in padded_rows:
-            lines.append(_build_row(row, padded_widths, colaligns, fmt.datarow))
+            yield _build_row(row, padded_widths, colaligns, fmt.datarow)
 
     if fmt.linebelow and "linebelow" not in hidden:
-        lines.append(_build_line(padded_widths, colaligns, fmt.linebelow))
-
-    return "\n".join(lines)
+        yield _build_line(padded_widths, colaligns, fmt.linebelow)
 
 
 def _main():
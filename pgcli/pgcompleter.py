@@ -56,6 +56,8 @@ class PGCompleter(Completer):
         self.dbmetadata = {'tables': {}, 'views': {}, 'functions': {},
                            'datatypes': {}}
         self.search_path = []
+        # Set in lazy_columns mode, see completion_refresher.ColumnLoader.
+        self.column_loader = None
 
         self.all_completions = set(self.keywords + self.functions)
 
@@ -81,6 +83,9 @@ class PGCompleter(Completer):
         databases = self.escaped_names(databases)
         self.databases.extend(databases)
 
+    def drop_database_names(self):
+        self.databases = []
+
     def extend_keywords(self, additional_keywords):
         self.keywords.extend(additional_keywords)
         self.all_completions.update(additional_keywords)
@@ -89,17 +94,72 @@ class PGCompleter(Completer):
 
         # schemata is a list of schema names
         schemata = self.escaped_names(schemata)
-        metadata = self.dbmetadata['tables']
-        for schema in schemata:
-            metadata[schema] = {}
 
-        # dbmetadata.values() are the 'tables' and 'functions' dicts
+        # dbmetadata.values() are the 'tables' and 'functions' dicts. Keep
+        # what is already known about a schema.
         for metadata in self.dbmetadata.values():
             for schema in schemata:
-                metadata[schema] = {}
+                metadata.setdefault(schema, {})
 
         self.all_completions.update(schemata)
 
+    def drop_schemata(self, schemata):
+        """ Forget about schemata and everything in them """
+        dropped = set()
+        for schema in self.escaped_names(schemata):
+            dropped.add(schema)
+            for kind, metadata in self.dbmetadata.items():
+                dropped.update(self._names(kind, metadata.pop(schema, {})))
+        self._drop_completions(dropped)
+
+    def drop_objects(self, kind, schemata, names=None):
+        """ Forget about some objects, e.g. before adding what the database
+        now has in their place
+
+        :param kind: 'tables', 'views', 'functions' or 'datatypes'
+        :param schemata: list of schema names
+        :param names: list of object names, or None for all the objects of
+                      that kind in the schemata
+        :return:
+        """
+        metadata = self.dbmetadata[kind]
+        dropped = set()
+        for schema in self.escaped_names(schemata):
+            objects = metadata.get(schema)
+            if objects is None:
+                continue
+            if names is None:
+                dropped.update(self._names(kind, objects))
+                objects.clear()
+            else:
+                for name in self.escaped_names(names):
+                    if name in objects:
+                        dropped.update(self._names(
+                            kind, {name: objects.pop(name)}))
+        self._drop_completions(dropped)
+
+    @staticmethod
+    def _names(kind, objects):
+        """ The names of objects, a dict of one schema's objects of a kind,
+        and of the columns of tables and views """
+        names = set(objects)
+        if kind in ('tables', 'views'):
+            for columns in objects.values():
+                names.update(columns)
+        return names
+
+    def _drop_completions(self, names):
+        """ Remove names from all_completions, except the ones which are still
+        known, e.g. a table of the same name in another schema """
+        if not names:
+            return
+        known = set(self.keywords + self.functions)
+        for kind, metadata in self.dbmetadata.items():
+            known.update(metadata)
+            for objects in metadata.values():
+                known.update(self._names(kind, objects))
+        self.all_completions.difference_update(names - known)
+
     def extend_relations(self, data, kind):
         """ extend metadata for tables or views
 
@@ -184,6 +244,7 @@ class PGCompleter(Completer):
         self.search_path = []
         self.dbmetadata = {'tables': {}, 'views': {}, 'functions': {},
                            'datatypes': {}}
+        self.column_loader = None
         self.all_completions = set(self.keywords + self.functions)
 
     def find_matches(self, text, collection, mode='fuzzy',
@@ -487,6 +548,12 @@ class PGCompleter(Completer):
                 else:
                     for reltype in ('tables', 'views'):
                         cols = meta[reltype].get(schema, {}).get(relname)
+                        if cols == ['*'] and self.column_loader:
+                            # Only the relation is known so far.
+                            cols = cols + self.escaped_names(
+                                self.column_loader.columns(
+                                    reltype, self.unescape_name(schema),
+                                    self.unescape_name(relname)))
                         if cols:
                             addcols(schema, relname, tbl.alias, reltype, cols)
                             break
@@ -0,0 +1,711 @@
+"""Client-side COPY: \\copy streams data between local files and the server.
+
+The data never goes through Python objects bigger than a chunk, so files of
+any size are copied at COPY speed with flat memory use. Large input files are
+memory-mapped rather than read, which saves copying them into read buffers.
+"""
+import io
+import os
+import re
+import mmap
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+from collections import namedtuple
+
+import click
+
+_logger = logging.getLogger(__name__)
+
+# Data is passed to and from psycopg2 in chunks of this many bytes.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Input files larger than this are memory-mapped.
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+_token_regex = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|[()]|[^\s()'"]+""")
+
+CopyCommand = namedtuple('CopyCommand', ['sql', 'direction', 'filename'])
+
+
+def parse_copy_command(pattern):
+    """Parses the arguments of \\copy, which are the same as for psql:
+
+        { table [ ( column_list ) ] | ( query ) } { from | to }
+        { 'filename' | stdin | stdout | pstdin | pstdout } [ [ with ] ... ]
+
+    Returns a CopyCommand with the COPY statement to run on the server, the
+    direction ('from' or 'to') and the local file name, which is None for
+    stdin and stdout. Raises ValueError if pattern can't be parsed.
+    """
+    depth = 0
+    tokens = iter(_token_regex.finditer(pattern))
+    for token in tokens:
+        text = token.group()
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            depth -= 1
+        elif (depth == 0 and token.start() > 0 and
+                text.lower() in ('from', 'to')):
+            direction = text.lower()
+            source = pattern[:token.start()].strip()
+            break
+    else:
+        raise ValueError('\\copy: arguments required, e.g. '
+                         '\\copy table from \'filename\'')
+
+    target = next(tokens, None)
+    if target is None:
+        raise ValueError('\\copy: missing file name after %s' % direction)
+    options = pattern[target.end():].strip()
+    target = target.group()
+
+    if target.startswith("'"):
+        filename = target[1:-1].replace("''", "'")
+    elif target.lower() in ('stdin', 'stdout', 'pstdin', 'pstdout'):
+        filename = None
+    elif target.lower() == 'program':
+        raise ValueError('\\copy: program is not supported')
+    else:
+        filename = target
+
+    sql = 'COPY %s %s %s %s' % (
+        source, direction.upper(), 'STDIN' if direction == 'from' else
+        'STDOUT', options)
+    return CopyCommand(sql.strip(), direction, filename)
+
+
+class CopyReader(object):
+    """File-like object for copy_expert to read COPY FROM data from, which
+    counts the bytes and lines read in progress."""
+
+    def __init__(self, f, progress, use_mmap=None):
+        self.f = f
+        self.progress = progress
+        self._map = None
+        self._pos = 0
+        if use_mmap is None:
+            try:
+                use_mmap = os.fstat(f.fileno()).st_size > MMAP_THRESHOLD
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                use_mmap = False
+        if use_mmap:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, size=COPY_CHUNK_SIZE):
+        if self._map is not None:
+            data = self._map[self._pos:self._pos + size]
+            self._pos += len(data)
+        else:
+            data = self.f.read(size)
+        self.progress.bytes_done += len(data)
+        self.progress.rows += data.count(b'\n')
+        return data
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self.f.close()
+
+
+class CopyWriter(object):
+    """File-like object for copy_expert to write COPY TO data to, which
+    counts the bytes and rows written in progress.
+
+    If skip_header is set the first row, which is the header line with the
+    HEADER option, is dropped.
+    """
+
+    def __init__(self, f, progress, skip_header=False):
+        self.f = f
+        self.progress = progress
+        self.skip_header = skip_header
+
+    def write(self, data):
+        # psycopg2 writes one row at a time.
+        if self.skip_header:
+            self.skip_header = False
+            return
+        self.f.write(data)
+        self.progress.bytes_done += len(data)
+        self.progress.rows += 1
+
+    def close(self):
+        self.f.close()
+
+
+def copy(cur, pattern, progress):
+    """Runs \\copy on the connection of cur and returns its status."""
+    command = parse_copy_command(pattern)
+    _logger.debug('\\copy: %r', command)
+
+    if command.direction == 'from':
+        if command.filename is None:
+            f = click.get_binary_stream('stdin')
+        else:
+            f = io.open(os.path.expanduser(command.filename), 'rb')
+            progress.bytes_total = os.fstat(f.fileno()).st_size
+        stream = CopyReader(f, progress)
+    else:
+        if command.filename is None:
+            f = click.get_binary_stream('stdout')
+        else:
+            f = io.open(os.path.expanduser(command.filename), 'wb',
+                        buffering=COPY_CHUNK_SIZE)
+        stream = CopyWriter(f, progress)
+
+    try:
+        cur.copy_expert(command.sql, stream, size=COPY_CHUNK_SIZE)
+    finally:
+        if command.filename is not None:
+            stream.close()
+        else:
+            stream.f.flush()
+    return 'COPY %d' % cur.rowcount
+
+
+# \export and \import split their work into this many chunks per connection,
+# so that connections which finish early can take over some of the work.
+CHUNKS_PER_JOB = 4
+
+EXPORT_USAGE = '\\export [-j jobs] [-p] table filename [copy options]'
+IMPORT_USAGE = ('\\import [-j jobs] [-1] table [(column_list)] filename '
+                '[copy options]')
+
+ExportCommand = namedtuple('ExportCommand', ['table', 'filename', 'options',
+                                             'jobs', 'parts'])
+ImportCommand = namedtuple('ImportCommand', ['table', 'filename', 'options',
+                                             'jobs', 'single_transaction'])
+
+# COPY skips the first line of each stream if the options contain this.
+_header_regex = re.compile(r'\bheader\b(?!\s+(false|off|0)\b)', re.I)
+# CSV values can have newlines in them, and with these options other quote
+# and escape characters than '"'.
+_csv_regex = re.compile(r'\bcsv\b', re.I)
+_csv_quoting_regex = re.compile(r'\b(quote|escape)\b', re.I)
+_copy_line_regex = re.compile(r'^COPY [^\n]*?, line (\d+)', re.M)
+
+
+def _parse_parallel_command(pattern, usage, flag, jobs):
+    """Parses `[-j jobs] [flag] table [(column_list)] filename [options]`.
+
+    Returns (table, filename, options, jobs, flag_given), where table
+    includes the column list. Raises ValueError if pattern can't be parsed.
+    """
+    name = usage.split()[0]
+    tokens = list(_token_regex.finditer(pattern))
+    flag_given = False
+    while tokens and tokens[0].group() in ('-j', flag):
+        option = tokens.pop(0).group()
+        if option == flag:
+            flag_given = True
+            continue
+        try:
+            jobs = int(tokens.pop(0).group())
+        except (IndexError, ValueError):
+            jobs = 0
+        if jobs < 1:
+            raise ValueError('%s: -j requires a number of jobs' % name)
+
+    # The table name may be qualified, e.g. "My Schema".foo
+    table = []
+    while tokens and (not table or table[-1].group().endswith('.') or
+                      tokens[0].group().startswith('.')):
+        table.append(tokens.pop(0))
+    if table and tokens and tokens[0].group() == '(':
+        while tokens and tokens[0].group() != ')':
+            table.append(tokens.pop(0))
+        if tokens:
+            table.append(tokens.pop(0))
+    if not table or not tokens:
+        raise ValueError('usage: ' + usage)
+    table = pattern[table[0].start():table[-1].end()]
+
+    target = tokens[0]
+    filename = target.group()
+    if filename.startswith("'"):
+        filename = filename[1:-1].replace("''", "'")
+    options = pattern[target.end():].strip()
+    return table, os.path.expanduser(filename), options, jobs, flag_given
+
+
+def parse_export_command(pattern, jobs=4):
+    """Parses the arguments of \\export (see EXPORT_USAGE). Raises ValueError
+    if pattern can't be parsed."""
+    command = ExportCommand(*_parse_parallel_command(pattern, EXPORT_USAGE,
+                                                     '-p', jobs))
+    if '(' in command.table:
+        raise ValueError('\\export: column lists are not supported')
+    return command
+
+
+def parse_import_command(pattern, jobs=4):
+    """Parses the arguments of \\import (see IMPORT_USAGE). Raises ValueError
+    if pattern can't be parsed."""
+    return ImportCommand(*_parse_parallel_command(pattern, IMPORT_USAGE,
+                                                  '-1', jobs))
+
+
+class ParallelCopy(object):
+    """Runs COPY commands for a list of chunks over several side connections.
+
+    Each worker thread takes a connection from the pool and copies chunks
+    until there are none left. The first error stops all of them, and so
+    does cancelling the progress, which also cancels the running COPYs.
+    Subclasses implement _begin and _copy_chunk.
+
+    With two_phase, the workers' transactions are committed with two-phase
+    commit, so they are either all committed or none of them are.
+    """
+
+    two_phase = False
+
+    def __init__(self, executor, command, progress):
+        self.executor = executor
+        self.command = command
+        self.progress = progress
+        self._chunks = []
+        self._error = None
+        self._threads = []
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def _start(self, chunks, *args):
+        """Starts copying chunks on up to command.jobs connections. args are
+        passed on to _begin."""
+        self._chunks = list(enumerate(chunks))
+        self._threads = [
+            threading.Thread(target=self._work, args=args,
+                             name='copy_worker')
+            for _ in range(min(self.command.jobs, len(chunks)))]
+        for thread in self._threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def _wait(self, done=None):
+        """Waits until the workers have finished, or until done is set.
+        Cancels the workers if the progress is cancelled meanwhile."""
+        while any(t.is_alive() for t in self._threads):
+            if done is not None and done.wait(0.1):
+                return
+            elif done is None:
+                self._threads[0].join(0.1)
+            if self.progress.cancelled:
+                self._cancel()
+
+    def _finish(self, commit=False):
+        """Waits for the workers and ends their transactions, committing
+        them if commit is set and no worker has failed. Raises the first
+        worker error."""
+        self._wait()
+        commit = commit and not self._error and not self.progress.cancelled
+        prepared = []
+        gid = 'pgcli_%s' % uuid.uuid4().hex
+        for i, executor in enumerate(self._workers):
+            if executor.conn.closed or not executor.in_transaction():
+                continue
+            try:
+                if not commit:
+                    executor._rollback()
+                elif self.two_phase:
+                    executor.conn.cursor().execute(
+                        'PREPARE TRANSACTION %s', ('%s_%d' % (gid, i),))
+                    prepared.append((executor, '%s_%d' % (gid, i)))
+                else:
+                    executor.conn.cursor().execute('COMMIT')
+            except Exception as e:
+                # A failed PREPARE TRANSACTION rolls back, so the prepared
+                # ones have to be too.
+                self._fail(e)
+                commit = False
+        for executor, xid in prepared:
+            try:
+                executor.conn.cursor().execute(
+                    '%s PREPARED %%s' % ('COMMIT' if commit else 'ROLLBACK'),
+                    (xid,))
+            except Exception as e:
+                _logger.error('Ending prepared transaction %s failed: %r',
+                              xid, e)
+                self._fail(e)
+        for executor in self._workers:
+            executor.close()
+        if self._error:
+            raise self._error
+
+    def _next_chunk(self):
+        with self._lock:
+            if self._chunks and not self._error and not self.progress.cancelled:
+                return self._chunks.pop(0)
+        return None
+
+    def _work(self, *args):
+        try:
+            executor = self.executor.spawn()
+        except Exception as e:
+            return self._fail(e)
+        with self._lock:
+            self._workers.append(executor)
+        try:
+            with executor.conn.cursor() as cur:
+                self._begin(cur, *args)
+                while True:
+                    chunk = self._next_chunk()
+                    if chunk is None:
+                        break
+                    self._copy_chunk(cur, *chunk)
+        except Exception as e:
+            self._fail(e)
+
+    def _begin(self, cur, *args):
+        """Prepares a worker's connection before it copies chunks."""
+
+    def _copy_chunk(self, cur, index, chunk):
+        raise NotImplementedError
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+
+    def _cancel(self):
+        with self._lock:
+            workers = list(self._workers)
+        for executor in workers:
+            try:
+                executor.conn.cancel()
+            except Exception as e:
+                _logger.error('cancel failed, error: %r', e)
+
+
+class ParallelExport(ParallelCopy):
+    """Exports a table over several connections at once.
+
+    The table is split into ranges of pages (using ctid range scans, which
+    are new in PostgreSQL 14) or of an integer primary key, and each range is
+    copied with COPY ... TO STDOUT by whichever connection is free. All of
+    them use the same snapshot, so the export is as consistent as a single
+    COPY would be. The ranges are written to one file in order, or each to
+    its own numbered part file.
+    """
+
+    def __init__(self, executor, command, progress):
+        super(ParallelExport, self).__init__(executor, command, progress)
+        self._done = []
+        self._results = []
+
+    def run(self):
+        """Runs the export and returns its status, e.g. 'COPY 1000'."""
+        command = self.command
+        holder = self.executor.spawn()
+        try:
+            with holder.conn.cursor() as cur:
+                cur.execute('BEGIN ISOLATION LEVEL REPEATABLE READ')
+                cur.execute('SELECT pg_catalog.pg_export_snapshot()')
+                snapshot = cur.fetchone()[0]
+                ranges = self._ranges(cur, command.table,
+                                      command.jobs * CHUNKS_PER_JOB)
+            self._done = [None] * len(ranges)
+            self._results = [threading.Event() for _ in ranges]
+            out = None
+            if not command.parts:
+                out = io.open(command.filename, 'wb')
+            self._start(ranges, snapshot)
+            try:
+                rows = self._collect(out)
+            finally:
+                self._finish()
+        finally:
+            holder._rollback()
+            holder.close()
+
+        if None in self._done:
+            raise ValueError('\\export: cancelled')
+        return 'COPY %d' % rows
+
+    def _ranges(self, cur, table, count):
+        """Returns a list of WHERE clauses which split table into about count
+        ranges. Returns a single clause selecting everything if the table
+        can't be split."""
+        if count > 1 and cur.connection.server_version >= 140000:
+            cur.execute('SELECT relpages FROM pg_catalog.pg_class '
+                        'WHERE oid = %s::regclass', (table,))
+            pages = cur.fetchone()[0]
+            if pages > count:
+                bounds = [pages * i // count for i in range(1, count)]
+                return self._where('ctid', bounds,
+                                   lambda page: "'(%d,0)'" % page)
+
+        if count > 1:
+            key = self._integer_key(cur, table)
+            if key:
+                cur.execute('SELECT min(%s), max(%s) FROM %s' % (
+                    key, key, table))
+                low, high = cur.fetchone()
+                if low is not None and high - low > count:
+                    bounds = [low + (high - low) * i // count
+                              for i in range(1, count)]
+                    return self._where(key, bounds, str)
+
+        return ['true']
+
+    def _where(self, column, bounds, literal):
+        """Returns the WHERE clauses of the ranges of column between bounds.
+        The first and last range are open-ended, so that no rows are missed
+        if the bounds are out of date."""
+        ranges = []
+        for start, end in zip([None] + bounds, bounds + [None]):
+            conditions = []
+            if start is not None:
+                conditions.append('%s >= %s' % (column, literal(start)))
+            if end is not None:
+                conditions.append('%s < %s' % (column, literal(end)))
+            ranges.append(' AND '.join(conditions))
+        return ranges
+
+    def _integer_key(self, cur, table):
+        """Returns the quoted name of table's primary key if it's a single
+        integer column, otherwise None."""
+        cur.execute('''
+            SELECT pg_catalog.quote_ident(a.attname)
+            FROM   pg_catalog.pg_index i
+                   JOIN pg_catalog.pg_attribute a
+                        ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE  i.indrelid = %s::regclass AND i.indisprimary
+                   AND i.indnatts = 1
+                   AND a.atttypid IN ('int2'::regtype, 'int4'::regtype,
+                                      'int8'::regtype)''', (table,))
+        row = cur.fetchone()
+        return row and row[0]
+
+    def _begin(self, cur, snapshot):
+        cur.execute('BEGIN ISOLATION LEVEL REPEATABLE READ')
+        cur.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+
+    def _copy_chunk(self, cur, index, where):
+        if self.command.parts:
+            f = io.open('%s.%03d' % (self.command.filename, index), 'wb',
+                        buffering=COPY_CHUNK_SIZE)
+        else:
+            # Kept until the chunks before it have been written.
+            f = tempfile.TemporaryFile()
+        sql = ('COPY (SELECT * FROM %s WHERE %s) TO STDOUT %s' % (
+            self.command.table, where, self.command.options)).strip()
+        # Every chunk is copied with the HEADER option, if given, but only
+        # the first one's header goes into a single output file. Part files
+        # each keep theirs, so they can be imported on their own.
+        skip_header = bool(index > 0 and not self.command.parts
+                           and _header_regex.search(self.command.options))
+        try:
+            cur.copy_expert(sql, CopyWriter(f, self.progress, skip_header),
+                            size=COPY_CHUNK_SIZE)
+        except Exception:
+            f.close()
+            raise
+        # psycopg2 leaves statusmessage empty after copy_expert.
+        rows = cur.rowcount
+        if self.command.parts:
+            f.close()
+            f = None
+        self._done[index] = (rows, f)
+        self._results[index].set()
+
+    def _fail(self, error):
+        super(ParallelExport, self)._fail(error)
+        # Wake up _collect
+        for event in self._results:
+            event.set()
+
+    def _collect(self, out):
+        """Waits for the chunks in order, appends them to out unless they are
+        written to part files, and returns the total number of rows."""
+        rows = 0
+        try:
+            for index, event in enumerate(self._results):
+                self._wait(event)
+                if self._error or self._done[index] is None:
+                    break
+                chunk_rows, f = self._done[index]
+                rows += chunk_rows
+                if f:
+                    f.seek(0)
+                    shutil.copyfileobj(f, out, COPY_CHUNK_SIZE)
+                    f.close()
+        finally:
+            if out:
+                out.close()
+            for done in self._done:
+                if done and done[1] and not done[1].closed:
+                    done[1].close()
+        return rows
+
+
+class MappedRangeReader(object):
+    """File-like object for copy_expert to read a range of a memory-mapped
+    file from, after an optional header line."""
+
+    def __init__(self, mapping, start, end, progress, header=b''):
+        self.mapping = mapping
+        self.pos = start
+        self.end = end
+        self.progress = progress
+        self.header = header
+
+    def read(self, size=COPY_CHUNK_SIZE):
+        if self.header:
+            data, self.header = self.header, b''
+            return data
+        data = self.mapping[self.pos:min(self.pos + size, self.end)]
+        self.pos += len(data)
+        self.progress.bytes_done += len(data)
+        self.progress.rows += data.count(b'\n')
+        return data
+
+
+def split_lines(mapping, count, start=0, quote=None):
+    """Returns the (start, end) offsets of up to count pieces of mapping,
+    which are about the same size and end at line boundaries.
+
+    If quote is given, e.g. b'"' for CSV, pieces only end at newlines outside
+    quoted values: those with an even number of quote characters between
+    them and start. Doubled quotes inside quoted values count twice, so
+    that's right as long as quote is also the escape character.
+    """
+    size = len(mapping)
+    pieces = []
+    # How far quote characters have been counted, and if that's inside a
+    # quoted value.
+    scanned, quoted = start, False
+    for i in range(1, count + 1):
+        end = start + (size - start) // (count - i + 1)
+        if i < count:
+            while True:
+                newline = mapping.find(b'\n', max(end, scanned))
+                if newline == -1 or quote is None:
+                    break
+                quoted ^= _count(mapping, quote, scanned, newline) % 2 == 1
+                scanned = newline
+                if not quoted:
+                    break
+                end = newline + 1
+            end = size if newline == -1 else newline + 1
+        else:
+            end = size
+        if end > start:
+            pieces.append((start, end))
+        start = end
+    return pieces
+
+
+def _count(mapping, byte, start, end):
+    """Counts byte in mapping[start:end], without copying all of it at
+    once."""
+    return sum(mapping[i:min(i + COPY_CHUNK_SIZE, end)].count(byte)
+               for i in range(start, end, COPY_CHUNK_SIZE))
+
+
+class ParallelImport(ParallelCopy):
+    """Imports a file over several connections at once.
+
+    The file is memory-mapped and split into pieces at line boundaries, and
+    each piece is copied with COPY ... FROM STDIN by whichever connection is
+    free. For CSV, the pieces only end at newlines outside quoted values, or
+    with custom QUOTE or ESCAPE characters, the file is copied in one piece.
+
+    With single_transaction, each connection copies all of its pieces in one
+    transaction, and they are only committed once every piece has been
+    copied, with two-phase commit. If the server doesn't allow enough
+    prepared transactions (max_prepared_transactions), the file is copied
+    over a single connection instead.
+    """
+
+    def __init__(self, executor, command, progress):
+        super(ParallelImport, self).__init__(executor, command, progress)
+        self.failed_line = None
+        self._mapping = None
+        self._pieces = []
+        self._header = b''
+        self._rows = 0
+
+    def run(self):
+        """Runs the import and returns its status, e.g. 'COPY 1000'."""
+        command = self.command
+        if command.single_transaction and command.jobs > 1:
+            self.two_phase = self._can_prepare(command.jobs)
+            if not self.two_phase:
+                command = self.command = command._replace(jobs=1)
+        with io.open(command.filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.progress.bytes_total = size
+            if size == 0:
+                return 'COPY 0'
+            self._mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header = b''
+            if _header_regex.search(command.options):
+                # Each piece is sent after the header, which COPY skips.
+                newline = self._mapping.find(b'\n')
+                header = self._mapping[:newline + 1 if newline != -1 else size]
+            count, quote = command.jobs * CHUNKS_PER_JOB, None
+            if _csv_regex.search(command.options):
+                if _csv_quoting_regex.search(command.options):
+                    # Where quoted values end can't be told without parsing
+                    count = 1
+                quote = b'"'
+            self._pieces = split_lines(self._mapping, count, len(header),
+                                       quote)
+            self._header = header
+            self._start(self._pieces)
+            self._finish(commit=command.single_transaction)
+        finally:
+            self._mapping.close()
+
+        if self.progress.cancelled:
+            raise ValueError('\\import: cancelled')
+        return 'COPY %d' % self._rows
+
+    def _can_prepare(self, count):
+        """Returns true if count transactions can be prepared at once."""
+        executor = self.executor.spawn()
+        try:
+            with executor.conn.cursor() as cur:
+                cur.execute('SHOW max_prepared_transactions')
+                return int(cur.fetchone()[0]) >= count
+        finally:
+            executor.close()
+
+    def _begin(self, cur):
+        if self.command.single_transaction:
+            cur.execute('BEGIN')
+
+    def _copy_chunk(self, cur, index, piece):
+        start, end = piece
+        sql = ('COPY %s FROM STDIN %s' % (self.command.table,
+                                         self.command.options)).strip()
+        reader = MappedRangeReader(self._mapping, start, end, self.progress,
+                                   self._header)
+        try:
+            cur.copy_expert(sql, reader, size=COPY_CHUNK_SIZE)
+        except Exception as e:
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+                    self.failed_line = self._failed_line(e, start)
+            raise
+        with self._lock:
+            # psycopg2 leaves statusmessage empty after copy_expert.
+            self._rows += cur.rowcount
+
+    def _failed_line(self, error, start):
+        """Returns the line of the file error happened at, or the first line
+        of the piece at start if COPY didn't say."""
+        line = 1 + _count(self._mapping, b'\n', 0, start)
+        # The line numbers in COPY's error context, e.g. "COPY foo, line 3",
+        # are counted from the start of the piece, including the header.
+        diag = getattr(error, 'diag', None)
+        match = _copy_line_regex.search(getattr(diag, 'context', None) or '')
+        if match:
+            line += max(int(match.group(1)) - 1 - bool(self._header), 0)
+        return line
@@ -1,12 +1,18 @@
+import os
+import re
+import json
+import threading
 import traceback
+from time import time
 import logging
 import itertools
+from collections import OrderedDict
 import psycopg2
 import psycopg2.extras
 import psycopg2.extensions as ext
-import sqlparse
 import pgspecial as special
 from .packages.function_metadata import FunctionMetadata
+from .packages import sqlsplit
 from .encodingutils import unicode2utf8, PY2
 
 
@@ -25,31 +31,37 @@ ext.register_type(ext.new_type((2249,), "RECORD", ext.UNICODE))
 # Postgres 9+ and as escaped binary in earlier versions.
 ext.register_type(ext.new_type((17,), 'BYTEA_TEXT', psycopg2.STRING))
 
-# When running a query, make pressing CTRL+C raise a KeyboardInterrupt
-# See http://initd.org/psycopg/articles/2014/07/20/cancelling-postgresql-statements-python/
-ext.set_wait_callback(psycopg2.extras.wait_select)
+# No wait callback is installed to make CTRL+C interrupt queries: statements
+# run on a worker thread and are cancelled with conn.cancel() (see
+# PGCli._cancel_statement), and copy_expert, used by \copy, \export and
+# \import, can't be used with one.
 
 
-def register_date_typecasters(connection):
+def register_date_typecasters(connection, oids=None):
     """
     Casts date and timestamp values to string, resolves issues with out of
     range dates (e.g. BC) which psycopg2 can't handle
+
+    Returns the OIDs of the date, timestamp and timestamptz types. They are
+    only looked up if `oids` isn't given.
     """
     def cast_date(value, cursor):
         return value
-    cursor = connection.cursor()
-    cursor.execute('SELECT NULL::date')
-    date_oid = cursor.description[0][1]
-    cursor.execute('SELECT NULL::timestamp')
-    timestamp_oid = cursor.description[0][1]
-    cursor.execute('SELECT NULL::timestamptz')
-    timestamptz_oid = cursor.description[0][1]
-    oids = (date_oid, timestamp_oid, timestamptz_oid)
-    new_type = psycopg2.extensions.new_type(oids, 'DATE', cast_date)
+    if not oids:
+        cursor = connection.cursor()
+        cursor.execute('SELECT NULL::date')
+        date_oid = cursor.description[0][1]
+        cursor.execute('SELECT NULL::timestamp')
+        timestamp_oid = cursor.description[0][1]
+        cursor.execute('SELECT NULL::timestamptz')
+        timestamptz_oid = cursor.description[0][1]
+        oids = (date_oid, timestamp_oid, timestamptz_oid)
+    new_type = psycopg2.extensions.new_type(tuple(oids), 'DATE', cast_date)
     psycopg2.extensions.register_type(new_type)
+    return oids
 
 
-def register_json_typecasters(conn, loads_fn):
+def register_json_typecasters(conn, loads_fn, oids=None):
     """Set the function for converting JSON data for a connection.
 
     Use the supplied function to decode JSON data returned from the database
@@ -61,39 +73,293 @@ def register_json_typecasters(conn, loads_fn):
     This function attempts to register the typecaster for both JSON and JSONB
     types.
 
-    Returns a set that is a subset of {'json', 'jsonb'} indicating which types
-    (if any) were successfully registered.
+    Returns a dict whose keys are a subset of {'json', 'jsonb'}, indicating
+    which types (if any) were successfully registered, and whose values are
+    the (oid, array_oid) of each type. When such a dict is passed in as
+    `oids`, the types aren't looked up in the database.
     """
-    available = set()
+    if oids is not None:
+        for name, (oid, array_oid) in oids.items():
+            psycopg2.extras.register_json(conn, loads=loads_fn, oid=oid,
+                                          array_oid=array_oid, name=name)
+        return oids
+
+    available = {}
 
     for name in ['json', 'jsonb']:
         try:
-            psycopg2.extras.register_json(conn, loads=loads_fn, name=name)
-            available.add(name)
+            json_type, array_type = psycopg2.extras.register_json(
+                conn, loads=loads_fn, name=name)
+            available[name] = (json_type.values[0],
+                               array_type and array_type.values[0])
         except psycopg2.ProgrammingError:
             pass
 
     return available
 
 
-def register_hstore_typecaster(conn):
+def register_hstore_typecaster(conn, oid=None):
     """
     Instead of using register_hstore() which converts hstore into a python
     dict, we query the 'oid' of hstore which will be different for each
     database and register a type caster that converts it to unicode.
     http://initd.org/psycopg/docs/extras.html#psycopg2.extras.register_hstore
+
+    Returns the oid, or None if hstore isn't installed in the database.
+    """
+    if oid is None:
+        with conn.cursor() as cur:
+            try:
+                cur.execute("SELECT 'hstore'::regtype::oid")
+                oid = cur.fetchone()[0]
+            except Exception:
+                return None
+    ext.register_type(ext.new_type((oid,), "HSTORE", ext.UNICODE))
+    return oid
+
+
+class TypeOidCache(object):
+    """OIDs of the types pgcli registers typecasters for, per server.
+
+    Looking them up costs several round trips on every connect, but they only
+    change when the server is upgraded or, for hstore, when the extension is
+    reinstalled. So they are kept in memory and, if `filename` is set, on
+    disk, and later connections register the typecasters without querying.
     """
-    with conn.cursor() as cur:
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._load().get(key)
+
+    def set(self, key, oids):
+        with self._lock:
+            entries = self._load()
+            entries[key] = oids
+            self._save(entries)
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = {}
+            if self.filename:
+                try:
+                    with open(os.path.expanduser(self.filename)) as f:
+                        self._entries = json.load(f)
+                except (IOError, ValueError) as e:
+                    _logger.debug('Type oid cache not loaded: %r', e)
+        return self._entries
+
+    def _save(self, entries):
+        if not self.filename:
+            return
+        filename = os.path.expanduser(self.filename)
         try:
-            cur.execute("SELECT 'hstore'::regtype::oid")
-            oid = cur.fetchone()[0]
-            ext.register_type(ext.new_type((oid,), "HSTORE", ext.UNICODE))
-        except Exception:
-            pass
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(entries, f)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            _logger.error('Failed to save the type oid cache: %r', e)
+
+
+class ServerCursorRows(object):
+    """Rows of a query result, fetched lazily from a server-side cursor.
+
+    psycopg2 only fills in the description of a named cursor after the first
+    FETCH, so the first batch of rows is read eagerly. The remaining rows are
+    fetched `itersize` at a time while iterating, and the cursor is closed as
+    soon as all of them have been consumed or `close` is called.
+
+    Like a cursor's, `rowcount` and `statusmessage` give the number of rows,
+    but only once all of them have been consumed.
+    """
+
+    # The number of rows is unknown until the cursor has been exhausted.
+    rowcount = -1
+    statusmessage = 'SELECT'
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self._first_batch = cursor.fetchmany(cursor.itersize)
+        self.description = cursor.description
+
+    def __iter__(self):
+        try:
+            count = 0
+            first_batch, self._first_batch = self._first_batch, []
+            for row in first_batch:
+                count += 1
+                yield row
+            if len(first_batch) == self.cursor.itersize:
+                for row in self.cursor:
+                    count += 1
+                    yield row
+            self.rowcount = count
+            self.statusmessage = 'SELECT %d' % count
+        finally:
+            self.close()
+
+    def close(self):
+        if self.cursor.closed:
+            return
+        try:
+            self.cursor.close()
+        except psycopg2.Error as e:
+            _logger.error('Failed to close server-side cursor: %r', e)
+
+
+class ConnectionPool(object):
+    """Idle connections, kept so they can be reused instead of connecting
+    again, e.g. when switching back to a database or refreshing completions.
+
+    Connections are looked up by a key describing their connection parameters
+    and are stored along with whatever the caller needs to know about them.
+    Connections which have been idle for more than `idle_timeout` seconds
+    are closed, by a timer thread if the pool isn't used by then.
+    """
+
+    idle_timeout = 300
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def get(self, key):
+        """Returns a (connection, info) tuple, or None if there's no idle
+        connection for key."""
+        with self._lock:
+            self._close_expired()
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, info, _ = idle.pop()
+                if self._is_usable(conn):
+                    return conn, info
+                conn.close()
+        return None
+
+    def put(self, key, conn, info=None):
+        """Keeps conn for reuse, or closes it if it can't be reused."""
+        if not self._is_usable(conn) or self.idle_timeout <= 0:
+            conn.close()
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append((conn, info, time()))
+            self._close_expired()
+            self._schedule_reaper()
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, _, _ in idle:
+                    conn.close()
+            self._idle.clear()
+            if self._reaper:
+                self._reaper.cancel()
+                self._reaper = None
+
+    def _is_usable(self, conn):
+        return (not conn.closed and conn.get_transaction_status() ==
+                ext.TRANSACTION_STATUS_IDLE)
+
+    def _close_expired(self):
+        deadline = time() - self.idle_timeout
+        for key, idle in list(self._idle.items()):
+            for conn, _, since in idle:
+                if since <= deadline:
+                    conn.close()
+            idle[:] = [c for c in idle if c[2] > deadline]
+            if not idle:
+                del self._idle[key]
+
+    def _schedule_reaper(self):
+        """Starts a timer to close the oldest idle connection once it
+        expires, unless one is running already. Must hold the lock."""
+        if self._reaper or not self._idle:
+            return
+        oldest = min(since for idle in self._idle.values()
+                     for _, _, since in idle)
+        delay = max(oldest + self.idle_timeout - time(), 0)
+        self._reaper = threading.Timer(delay, self._reap)
+        self._reaper.name = 'connection_reaper'
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def _reap(self):
+        with self._lock:
+            self._reaper = None
+            self._close_expired()
+            self._schedule_reaper()
 
 
 class PGExecute(object):
 
+    # Server-side cursors keep large results out of memory by fetching them in
+    # batches of `cursor_itersize` rows. Possible modes are 'never', 'always'
+    # (every statement that can be declared as a cursor) and 'auto' (only when
+    # the planner estimates more than `cursor_threshold` rows).
+    # The cursors are declared WITH HOLD, outside of a transaction, so the
+    # server computes the whole result into a temporary store before the
+    # first rows are fetched: it's the client's memory that's saved, not
+    # the time to the first row.
+    server_side_cursors = 'never'
+    cursor_itersize = 2000
+    cursor_threshold = 100000
+
+    cursor_statement_regex = re.compile(r'^\s*(select|values|table|with)\b',
+                                        re.IGNORECASE)
+    # Statements which may not be declared as a cursor (SELECT INTO, data
+    # modifying WITH, FOR UPDATE/SHARE), erring on the safe side: they run
+    # with a client-side cursor. Falling back after DECLARE has failed could
+    # run the statement twice.
+    no_cursor_regex = re.compile(
+        r'\b(into|insert|update|delete|merge|share)\b', re.IGNORECASE)
+    plan_rows_regex = re.compile(r'\brows=(\d+)')
+
+    # Statements which run on their own rather than in a batch, because they
+    # (may) return rows, control transactions or can't run inside a
+    # transaction. Only the last result of a batch is seen, so anything
+    # with a RETURNING clause is kept out of batches too.
+    unbatchable_statement_regex = re.compile(
+        r'^\s*(select|values|table|with|show|explain|fetch|copy|call|execute'
+        r'|begin|start|commit|end|rollback|abort|savepoint|release|prepare'
+        r'|vacuum)\b',
+        re.IGNORECASE)
+    returning_regex = re.compile(r'\breturning\b', re.IGNORECASE)
+    max_batch_bytes = 1024 * 1024
+
+    cursor_names = ('pgcli_cursor_%d' % i for i in itertools.count(1))
+
+    # Results are only displayed, so converting their values to Python objects
+    # (Decimal, datetime, lists, ...) just to turn them back into text is
+    # wasted work. When this is set, query results keep the text the server
+    # sent, except for the types in `converted_type_oids`.
+    text_typecasting = False
+    converted_type_oids = (16, 1000)  # bool and bool[]
+
+    # When set, the server cuts values of the types in `preview_type_oids`
+    # (text, varchar, char, json, jsonb, xml and bytea) short to this many
+    # characters, so large values aren't transferred just to be cut short
+    # for display. See preview_sql.
+    preview_length = 0
+    preview_type_oids = (25, 1043, 1042, 114, 3802, 142, 17)
+    preview_expression = (
+        "CASE WHEN length({0}::text) > {1} "
+        "THEN left({0}::text, {1}) || '... (' || length({0}::text) "
+        "|| ' characters)' ELSE {0}::text END")
+
+    # See TypeOidCache. This one is only kept in memory; pass another one to
+    # the constructor to save the oids somewhere.
+    type_oid_cache = TypeOidCache()
+
+    # Shared by all executors, so they can pick up each other's connections
+    # once they're done with them.
+    pool = ConnectionPool()
+
     # The boolean argument to the current_schemas function indicates whether
     # implicit schemas, e.g. pg_catalog
     search_path_query = '''
@@ -111,6 +377,8 @@ class PGExecute(object):
                 LEFT JOIN pg_catalog.pg_namespace n
                     ON n.oid = c.relnamespace
         WHERE   c.relkind = ANY(%s)
+                AND n.nspname = ANY(COALESCE(%s::name[], ARRAY[n.nspname]))
+                AND c.relname = ANY(COALESCE(%s::name[], ARRAY[c.relname]))
         ORDER BY 1,2;'''
 
     columns_query = '''
@@ -123,16 +391,51 @@ class PGExecute(object):
                 INNER JOIN pg_catalog.pg_namespace nsp
                     ON cls.relnamespace = nsp.oid
         WHERE   cls.relkind = ANY(%s)
+                AND nsp.nspname = ANY(COALESCE(%s::name[], ARRAY[nsp.nspname]))
+                AND cls.relname = ANY(COALESCE(%s::name[], ARRAY[cls.relname]))
                 AND NOT att.attisdropped
                 AND att.attnum  > 0
         ORDER BY 1, 2, 3'''
 
+    # Changes whenever objects are created, dropped, renamed or altered, but
+    # only takes a scan of the smaller catalogs (not pg_attribute).
+    catalog_fingerprint_query = '''
+        SELECT  current_database(),
+                inet_server_addr(),
+                inet_server_port(),
+                (SELECT count(*) || ' ' || max(xmin::text::bigint)
+                 FROM pg_catalog.pg_namespace),
+                (SELECT count(*) || ' ' || max(xmin::text::bigint)
+                 FROM pg_catalog.pg_class),
+                (SELECT count(*) || ' ' || max(xmin::text::bigint)
+                 FROM pg_catalog.pg_proc),
+                (SELECT count(*) || ' ' || max(xmin::text::bigint)
+                 FROM pg_catalog.pg_type),
+                (SELECT count(*) || ' ' || max(xmin::text::bigint)
+                 FROM pg_catalog.pg_database)'''
+
     databases_query = '''
         SELECT d.datname
         FROM pg_catalog.pg_database d
         ORDER BY 1'''
 
-    def __init__(self, database, user, password, host, port, dsn):
+    # Everything connect needs to know, in a single round trip. The types are
+    # returned as 'name oid array_oid' strings.
+    introspection_query = '''
+        SELECT  current_database(),
+                current_user,
+                host(inet_server_addr()),
+                inet_server_port(),
+                ARRAY(SELECT t.typname || ' ' || t.oid || ' ' || t.typarray
+                      FROM   pg_catalog.pg_type t
+                      WHERE  t.typname IN ('date', 'timestamp', 'timestamptz',
+                                           'json', 'jsonb', 'hstore')
+                             AND pg_catalog.pg_type_is_visible(t.oid))'''
+
+    def __init__(self, database, user, password, host, port, dsn,
+                 type_oid_cache=None):
+        if type_oid_cache is not None:
+            self.type_oid_cache = type_oid_cache
         self.dbname = database
         self.user = user
         self.password = password
@@ -153,45 +456,148 @@ class PGExecute(object):
         if dsn:
             if password:
                 dsn = "{0} password={1}".format(dsn, password)
-            conn = psycopg2.connect(dsn=unicode2utf8(dsn))
-            cursor = conn.cursor()
-            # When we connect using a DSN, we don't really know what db,
-            # user, etc. we connected to. Let's read it.
-            db = self._select_one(cursor, 'select current_database()')
-            user = self._select_one(cursor, 'select current_user')
-            host = self._select_one(cursor, 'select inet_server_addr()')
-            port = self._select_one(cursor, 'select inet_server_port()')
+            pool_key = ('dsn', dsn)
         else:
-            conn = psycopg2.connect(
-                    database=unicode2utf8(db),
-                    user=unicode2utf8(user),
-                    password=unicode2utf8(password),
-                    host=unicode2utf8(host),
-                    port=unicode2utf8(port))
-        conn.set_client_encoding('utf8')
-        if hasattr(self, 'conn'):
-            self.conn.close()
-        self.conn = conn
-        self.conn.autocommit = True
+            pool_key = (db, user, password, host, port)
+
+        pooled = self.pool.get(pool_key)
+        if pooled:
+            # The typecasters are still registered on pooled connections.
+            conn, (db, user, host, port) = pooled
+            self._replace_connection(conn, pool_key)
+        else:
+            if dsn:
+                conn = psycopg2.connect(dsn=unicode2utf8(dsn))
+            else:
+                conn = psycopg2.connect(
+                        database=unicode2utf8(db),
+                        user=unicode2utf8(user),
+                        password=unicode2utf8(password),
+                        host=unicode2utf8(host),
+                        port=unicode2utf8(port),
+                        client_encoding='utf8')
+            # Doesn't need a round trip if the encoding is utf8 already.
+            conn.set_client_encoding('utf8')
+            conn.autocommit = True
+            self._replace_connection(conn, pool_key)
+
+            cache_key = self._type_cache_key()
+            cached = self.type_oid_cache.get(cache_key) or {}
+            found = None
+            if (dsn or 'date' not in cached
+                    or (db or '') not in cached.get('hstore', {})):
+                # When we connect using a DSN, we don't really know what db,
+                # user, etc. we connected to. Read it, together with the type
+                # oids which aren't cached yet, in a single round trip.
+                identity, found = self._introspect()
+                if dsn:
+                    db, user, host, port = identity
+
         self.dbname = db
         self.user = user
         self.password = password
         self.host = host
         self.port = port
 
-        register_date_typecasters(conn)
-        register_json_typecasters(self.conn, self._json_typecaster)
-        register_hstore_typecaster(self.conn)
+        if not pooled:
+            self._register_typecasters(cache_key, cached, found)
+        self._text_typecaster = self._new_text_typecaster()
 
-    def _select_one(self, cur, sql):
+    def spawn(self):
+        """Returns a new executor connected with the same parameters, e.g. to
+        run something on a side connection. The connection is taken from the
+        pool if there's an idle one; close() the executor to return it."""
+        return PGExecute(self.dbname, self.user, self.password, self.host,
+                         self.port, self.dsn, self.type_oid_cache)
+
+    def _replace_connection(self, conn, pool_key):
+        """Switches to conn, returning the current connection to the pool.
+
+        This is the user's session, e.g. on \\c, so whatever they set up in it
+        (temporary tables, settings, roles, locks, LISTENs...) is discarded
+        first: it mustn't leak into whoever picks the connection up next.
         """
-        Helper method to run a select and retrieve a single field value
-        :param cur: cursor
-        :param sql: string
-        :return: string
+        if hasattr(self, 'conn'):
+            self.close(discard=True)
+        self.conn = conn
+        self._pool_key = pool_key
+
+    def close(self, discard=False):
+        """Returns the connection to the pool, for other executors (or a
+        later connect) to reuse.
+
+        With discard, the session state is reset with DISCARD ALL first, and
+        the connection is closed instead if that fails.
+        """
+        conn = self.conn
+        del self.conn
+        # Connections in a transaction aren't pooled anyway.
+        if (discard and not conn.closed and conn.get_transaction_status() ==
+                ext.TRANSACTION_STATUS_IDLE):
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('DISCARD ALL')
+                    # RESET ALL sets client_encoding back to its value at
+                    # connect time, which psycopg2 doesn't notice.
+                    cur.execute("SET client_encoding TO 'utf8'")
+            except psycopg2.Error as e:
+                _logger.debug('Not pooling connection, error: %r', e)
+                conn.close()
+                return
+        self.pool.put(self._pool_key, conn,
+                      (self.dbname, self.user, self.host, self.port))
+
+    def _type_cache_key(self):
+        # get_dsn_parameters is new in psycopg2 2.7
+        params = (self.conn.get_dsn_parameters()
+                  if hasattr(self.conn, 'get_dsn_parameters') else {})
+        return '%s@%s:%s:%s' % (params.get('user', self.user),
+                                params.get('host', self.host),
+                                params.get('port', self.port),
+                                self.conn.server_version)
+
+    def _introspect(self):
+        """Returns the (database, user, host, port) of the connection, and a
+        dict with the (oid, array_oid) of the types we register typecasters
+        for, by name."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.introspection_query)
+            db, user, host, port, types = cur.fetchone()
+
+        found = {}
+        for typ in types:
+            name, oid, array_oid = typ.split()
+            found[name] = (int(oid), int(array_oid) or None)
+        return (db, user, host, port), found
+
+    def _register_typecasters(self, cache_key, cached, found=None):
+        """Registers the date, json and hstore typecasters.
+
+        The type oids come from the cache, or from `found` (see _introspect)
+        for the ones that aren't cached yet, in which case the cache is
+        updated.
         """
-        cur.execute(sql)
-        return cur.fetchone()
+        oids = dict(cached)
+        oids['hstore'] = dict(cached.get('hstore', {}))
+        if found is not None:
+            oids['date'] = [found[name][0]
+                            for name in ('date', 'timestamp', 'timestamptz')]
+            oids['json'] = dict((name, found[name])
+                                for name in ('json', 'jsonb') if name in found)
+            # hstore is an extension, so its oid differs between databases.
+            oids['hstore'][self.dbname or ''] = found.get('hstore', (None,))[0]
+
+        register_date_typecasters(self.conn, oids['date'])
+        register_json_typecasters(self.conn, self._json_typecaster,
+                                  oids['json'])
+        hstore_oid = oids['hstore'][self.dbname or '']
+        if hstore_oid:
+            register_hstore_typecaster(self.conn, hstore_oid)
+
+        # Round trip through json, so tuples compare equal to cached lists.
+        oids = json.loads(json.dumps(oids))
+        if oids != cached:
+            self.type_oid_cache.set(cache_key, oids)
 
     def _json_typecaster(self, json_data):
         """Interpret incoming JSON data as a string.
@@ -207,6 +613,19 @@ class PGExecute(object):
         else:
             return json_data
 
+    def cancel(self):
+        """Cancel the statement that is running, keeping the session.
+
+        Unlike reconnecting, this keeps temporary tables, SET values etc. It
+        only sends a cancel request to the server, so it can be called from
+        any thread while the statement runs on another one, which then gets a
+        QueryCanceledError.
+        """
+        try:
+            self.conn.cancel()
+        except psycopg2.Error as e:
+            _logger.error('cancel failed, error: %r', e)
+
     def run(self, statement, pgspecial=None, exception_formatter=None,
             on_error_resume=False):
         """Execute the sql in the database and return the results.
@@ -231,48 +650,247 @@ class PGExecute(object):
             yield (None, None, None, None, statement, False)
 
         # Split the sql into separate queries and run each one.
-        for sql in sqlparse.split(statement):
-            # Remove spaces, eol and semi-colons.
-            sql = sql.rstrip(';')
-
-            try:
-                if pgspecial:
-                    # First try to run each query as special
-                    _logger.debug('Trying a pgspecial command. sql: %r', sql)
-                    cur = self.conn.cursor()
+        for result in self.run_statements(sqlsplit.split_stream([statement]),
+                                          pgspecial, exception_formatter,
+                                          on_error_resume):
+            yield result
+
+    def run_statements(self, statements, pgspecial=None,
+                       exception_formatter=None, on_error_resume=False,
+                       single_transaction=False, batch_size=1,
+                       statement_savepoints=False):
+        """Execute sql statements one by one, and return the results.
+
+        :param statements: An iterable of single sql statements, e.g. from
+               sqlsplit.split_stream. It's consumed lazily, so the first
+               statement runs before the rest have been read.
+        :param single_transaction: Bool. If true, all the statements run in a
+               single transaction, like psql -1. It's committed if they all
+               succeed, or if on_error_resume is true, in which case failing
+               statements are rolled back to a savepoint.
+        :param batch_size: Up to this many consecutive statements are sent to
+               the server in one round trip, as long as they are plain sql
+               which doesn't return rows (see `can_batch`). If a batch fails
+               inside a transaction, it's rolled back to a savepoint and its
+               statements are run again one by one, so the error is reported
+               for the statement that caused it. Outside a transaction the
+               error is reported for the whole batch, since statements with
+               effects that aren't rolled back (e.g. nextval) would otherwise
+               run twice.
+        :param statement_savepoints: Bool. If true and on_error_resume is
+               true, statements run inside a transaction are each wrapped in
+               a savepoint, so a failing one doesn't abort the transaction.
+               This is meant for scripts (\\i); interactively a failed
+               statement aborts the transaction, as it does in psql.
+
+        The other parameters and the return value are the same as for `run`.
+        If single_transaction is true and a transaction is already open, the
+        statements run in a savepoint instead, so the transaction is left
+        open either way.
+        """
+        nested = single_transaction and self.in_transaction()
+        if nested:
+            self.conn.cursor().execute('SAVEPOINT pgcli_script')
+        elif single_transaction:
+            self.conn.cursor().execute('BEGIN')
+        committed = failed = False
+        statement_savepoints = on_error_resume and (single_transaction or
+                                                    statement_savepoints)
+        try:
+            for batch in self._statement_batches(statements, pgspecial,
+                                                 batch_size):
+                if len(batch) > 1:
+                    sql = ';\n'.join(batch)
                     try:
-                        for result in pgspecial.execute(cur, sql):
-                            # e.g. execute_from_file already appends these
-                            if len(result) < 6:
-                                yield result + (sql, True)
-                            else:
-                                yield result
+                        result = self.execute_batch(batch)
+                    except psycopg2.DatabaseError as e:
+                        if not exception_formatter:
+                            raise
+                        yield (None, None, None, exception_formatter(e), sql,
+                               False)
+                        if not on_error_resume:
+                            failed = True
+                            break
+                        continue
+                    if result:
+                        yield result + (sql, True)
                         continue
-                    except special.CommandNotFound:
-                        pass
-
-                # Not a special command, so execute as normal sql
-                yield self.execute_normal_sql(sql) + (sql, True)
-            except psycopg2.DatabaseError as e:
-                _logger.error("sql: %r, error: %r", sql, e)
-                _logger.error("traceback: %r", traceback.format_exc())
-
-                if (isinstance(e, psycopg2.OperationalError)
-                        or not exception_formatter):
-                    # Always raise operational errors, regardless of on_error
-                    # specification
-                    raise
-
-                yield None, None, None, exception_formatter(e), sql, False
 
-                if not on_error_resume:
+                for sql in batch:
+                    savepoint = (statement_savepoints and
+                                 self.in_transaction())
+                    try:
+                        if savepoint:
+                            self.conn.cursor().execute(
+                                'SAVEPOINT pgcli_statement')
+                        for result in self._execute_one(sql, pgspecial):
+                            yield result
+                        # COMMIT or ROLLBACK end the transaction, and the
+                        # savepoint with it.
+                        if savepoint and self.in_transaction():
+                            self.conn.cursor().execute(
+                                'RELEASE SAVEPOINT pgcli_statement')
+                    except psycopg2.DatabaseError as e:
+                        _logger.error("sql: %r, error: %r", sql, e)
+                        _logger.error("traceback: %r", traceback.format_exc())
+
+                        if (isinstance(e, psycopg2.OperationalError)
+                                or not exception_formatter):
+                            # Always raise operational errors, regardless of
+                            # on_error specification
+                            raise
+
+                        if savepoint and self.in_transaction():
+                            self.conn.cursor().execute(
+                                'ROLLBACK TO SAVEPOINT pgcli_statement')
+                        yield (None, None, None, exception_formatter(e), sql,
+                               False)
+
+                        if not on_error_resume:
+                            failed = True
+                            break
+                if failed:
                     break
 
+            if nested and not failed:
+                # A COMMIT or ROLLBACK in the script ends the savepoint too.
+                if self.in_transaction():
+                    self.conn.cursor().execute(
+                        'RELEASE SAVEPOINT pgcli_script')
+                committed = True
+            elif single_transaction and not failed:
+                self.conn.cursor().execute('COMMIT')
+                committed = True
+        finally:
+            if nested and not committed:
+                self._rollback('pgcli_script')
+            elif single_transaction and not committed:
+                self._rollback()
+
+    def _execute_one(self, sql, pgspecial):
+        """Yields the results of a single statement."""
+        if pgspecial:
+            # First try to run each query as special
+            _logger.debug('Trying a pgspecial command. sql: %r', sql)
+            cur = self.conn.cursor()
+            try:
+                for result in pgspecial.execute(cur, sql):
+                    # e.g. execute_from_file already appends these
+                    if len(result) < 6:
+                        yield result + (sql, True)
+                    else:
+                        yield result
+                return
+            except special.CommandNotFound:
+                pass
+
+        # Not a special command, so execute as normal sql
+        yield self.execute_normal_sql(sql) + (sql, True)
+
+    def _statement_batches(self, statements, pgspecial, batch_size):
+        """Groups consecutive statements which can be batched into lists of
+        up to batch_size. Other statements come in lists of their own."""
+        batch = []
+        batch_bytes = 0
+        for sql in statements:
+            # Remove spaces, eol and semi-colons.
+            sql = sql.rstrip(';')
+            if batch_size > 1 and self.can_batch(sql, pgspecial):
+                batch.append(sql)
+                batch_bytes += len(sql)
+                if (len(batch) >= batch_size
+                        or batch_bytes >= self.max_batch_bytes):
+                    yield batch
+                    batch, batch_bytes = [], 0
+            else:
+                if batch:
+                    yield batch
+                    batch, batch_bytes = [], 0
+                yield [sql]
+        if batch:
+            yield batch
+
+    def can_batch(self, sql, pgspecial=None):
+        """Returns true if sql can be sent to the server together with other
+        statements: it's not a special command, and neither returns rows nor
+        controls transactions."""
+        if (self.unbatchable_statement_regex.match(sql) or
+                self.returning_regex.search(sql)):
+            return False
+        if pgspecial:
+            command = special.parse_special_command(sql)[0]
+            if (command in pgspecial.commands or
+                    command.lower() in pgspecial.commands):
+                return False
+        return True
+
+    def execute_batch(self, batch):
+        """Runs several statements in one round trip.
+
+        Returns a (title, rows, headers, status) tuple. If one of the
+        statements fails inside a transaction, the batch is rolled back to a
+        savepoint and None is returned, so it can be run again statement by
+        statement. Outside a transaction the error is raised: the batch's
+        implicit transaction was rolled back, but effects like nextval()
+        weren't, so running it again isn't safe.
+        """
+        sql = ';\n'.join(batch)
+        # A multi-statement query runs in an implicit transaction, so it's
+        # all or nothing. Inside a transaction a savepoint is needed for that.
+        savepoint = self.in_transaction()
+        if savepoint:
+            sql = ('SAVEPOINT pgcli_batch;\n%s;\nRELEASE SAVEPOINT pgcli_batch'
+                   % sql)
+        _logger.debug('Batch of %d statements.', len(batch))
+        cur = self.conn.cursor()
+        try:
+            cur.execute(sql)
+        except psycopg2.OperationalError:
+            raise
+        except psycopg2.DatabaseError as e:
+            _logger.debug('Batch failed, error: %r', e)
+            if not savepoint:
+                raise
+            cur.execute('ROLLBACK TO SAVEPOINT pgcli_batch')
+            return None
+        # Only the status of the last statement is returned by the server, so
+        # the others are summed up by their commands.
+        commands = OrderedDict()
+        for statement in batch:
+            command = statement.split(None, 1)[0].upper()
+            commands[command] = commands.get(command, 0) + 1
+        status = '%d statements (%s), last: %s' % (
+            len(batch),
+            ', '.join('%d %s' % (n, c) for c, n in commands.items()),
+            cur.statusmessage)
+        return None, None, None, status
+
+    def in_transaction(self):
+        """Returns True if a transaction is open (or has failed) on the
+        connection, e.g. after the user's BEGIN."""
+        return (self.conn.get_transaction_status() !=
+                ext.TRANSACTION_STATUS_IDLE)
+
+    def _rollback(self, savepoint=None):
+        try:
+            if savepoint is None:
+                self.conn.cursor().execute('ROLLBACK')
+            elif self.in_transaction():
+                self.conn.cursor().execute(
+                    'ROLLBACK TO SAVEPOINT %s; RELEASE SAVEPOINT %s'
+                    % (savepoint, savepoint))
+        except psycopg2.Error as e:
+            _logger.error('rollback failed, error: %r', e)
+
     def execute_normal_sql(self, split_sql):
         """Returns tuple (title, rows, headers, status)"""
         _logger.debug('Regular sql statement. sql: %r', split_sql)
+        if self._use_server_side_cursor(split_sql):
+            return self.execute_server_side_sql(split_sql)
+
         cur = self.conn.cursor()
-        cur.execute(split_sql)
+        self._register_text_typecaster(cur)
+        cur.execute(self._preview_sql(split_sql))
 
         # conn.notices persist between queies, we use pop to clear out the list
         title = ''
@@ -288,6 +906,121 @@ class PGExecute(object):
             _logger.debug('No rows in result.')
             return title, None, None, cur.statusmessage
 
+    def execute_server_side_sql(self, split_sql):
+        """Run a query through a server-side cursor.
+
+        Returns tuple (title, rows, headers, status), where rows is a
+        ServerCursorRows object that fetches the result in batches.
+        """
+        _logger.debug('Server-side cursor statement. sql: %r', split_sql)
+        # WITH HOLD is required to use a named cursor outside of a transaction
+        cur = self.conn.cursor(name=next(self.cursor_names), withhold=True)
+        cur.itersize = self.cursor_itersize
+        self._register_text_typecaster(cur)
+        cur.execute(self._preview_sql(split_sql))
+        rows = ServerCursorRows(cur)
+
+        title = ''
+        while len(self.conn.notices) > 0:
+            title = title + self.conn.notices.pop()
+
+        headers = [x[0] for x in rows.description]
+        # The number of rows is only known once they've all been fetched, see
+        # ServerCursorRows.statusmessage.
+        return title, rows, headers, rows.statusmessage
+
+    def _preview_sql(self, sql):
+        """Returns sql, rewritten to cut large values short if preview_length
+        is set (see preview_sql)."""
+        if (self.preview_length and self.cursor_statement_regex.match(sql)
+                and not self.in_transaction()):
+            return self.preview_sql(sql, self.preview_length) or sql
+        return sql
+
+    def preview_sql(self, sql, length):
+        """Returns a query which selects the same as sql, but with values of
+        the types in preview_type_oids cut short to length characters, and a
+        note of their full length added. Returns None if sql doesn't return
+        any such columns or can't be used as a subquery.
+
+        This costs a round trip to find out the types of sql's columns.
+        Failing statements abort the transaction they are in, so it shouldn't
+        be called in one.
+        """
+        with self.conn.cursor() as cur:
+            try:
+                cur.execute('SELECT * FROM (%s\n) q LIMIT 0' % sql)
+            except psycopg2.Error as e:
+                _logger.debug('Cannot preview sql: %r, error: %r', sql, e)
+                return None
+            description = cur.description
+
+        names = [column[0] for column in description]
+        if not any(column[1] in self.preview_type_oids
+                   for column in description) or len(set(names)) < len(names):
+            return None
+
+        columns = []
+        for name, column in zip(names, description):
+            quoted = 'q."%s"' % name.replace('"', '""')
+            if column[1] in self.preview_type_oids:
+                columns.append('%s AS "%s"' % (
+                    self.preview_expression.format(quoted, int(length)),
+                    name.replace('"', '""')))
+            else:
+                columns.append(quoted)
+        return 'SELECT %s FROM (%s\n) q' % (', '.join(columns), sql)
+
+    def _new_text_typecaster(self):
+        """Returns a typecaster for the types of the connection which psycopg2
+        would convert, which returns them as text instead. It's built once per
+        connection, in connect, as the types only change when typecasters are
+        registered."""
+        oids = set(ext.string_types)
+        oids.update(self.conn.string_types)
+        oids.difference_update(self.converted_type_oids)
+        return ext.new_type(tuple(oids), 'DISPLAY_TEXT', ext.UNICODE)
+
+    def _register_text_typecaster(self, cur):
+        """Makes cur return the values of every type psycopg2 would convert
+        as text, if text_typecasting is set. Types without a typecaster are
+        returned as text anyway."""
+        if self.text_typecasting:
+            ext.register_type(self._text_typecaster, cur)
+
+    def _use_server_side_cursor(self, sql):
+        """Decide whether the result of sql should be fetched in batches.
+
+        Inside a transaction, they never are: a statement which can't be
+        declared as a cursor, or explained, would abort the transaction.
+        """
+        mode = self.server_side_cursors
+        if (mode == 'never' or not self.cursor_statement_regex.match(sql)
+                or self.no_cursor_regex.search(sql)
+                or self.in_transaction()):
+            return False
+        if mode == 'always':
+            return True
+
+        estimate = self.estimate_rows(sql)
+        return estimate is not None and estimate > self.cursor_threshold
+
+    def estimate_rows(self, sql):
+        """Returns the number of rows the planner expects sql to return, or
+        None if the statement can't be explained.
+
+        A statement which can't be explained aborts the transaction it's in,
+        so this shouldn't be called in one.
+        """
+        with self.conn.cursor() as cur:
+            try:
+                cur.execute('EXPLAIN ' + sql)
+            except psycopg2.ProgrammingError:
+                return None
+            plan = cur.fetchone()
+        match = plan and self.plan_rows_regex.search(plan[0])
+        return int(match.group(1)) if match else None
+
     def search_path(self):
         """Returns the current search path as a list of schema names"""
 
@@ -312,69 +1045,86 @@ class PGExecute(object):
             cur.execute(self.schemata_query)
             return [x[0] for x in cur.fetchall()]
 
-    def _relations(self, kinds=('r', 'v', 'm')):
+    def _relations(self, kinds=('r', 'v', 'm'), schemas=None, names=None):
         """Get table or view name metadata
 
         :param kinds: list of postgres relkind filters:
                 'r' - table
                 'v' - view
                 'm' - materialized view
+        :param schemas: only list relations in these schemas
+        :param names: only list relations with these names
         :return: (schema_name, rel_name) tuples
         """
 
         with self.conn.cursor() as cur:
-            sql = cur.mogrify(self.tables_query, [kinds])
+            sql = cur.mogrify(self.tables_query, [kinds, schemas, names])
             _logger.debug('Tables Query. sql: %r', sql)
             cur.execute(sql)
             for row in cur:
                 yield row
 
-    def tables(self):
+    def tables(self, schemas=None, names=None):
         """Yields (schema_name, table_name) tuples"""
-        for row in self._relations(kinds=['r']):
+        for row in self._relations(kinds=['r'], schemas=schemas, names=names):
             yield row
 
-    def views(self):
+    def views(self, schemas=None, names=None):
         """Yields (schema_name, view_name) tuples.
 
             Includes both views and and materialized views
         """
-        for row in self._relations(kinds=['v', 'm']):
+        for row in self._relations(kinds=['v', 'm'], schemas=schemas,
+                                   names=names):
             yield row
 
-    def _columns(self, kinds=('r', 'v', 'm')):
+    def _columns(self, kinds=('r', 'v', 'm'), schemas=None, names=None):
         """Get column metadata for tables and views
 
         :param kinds: kinds: list of postgres relkind filters:
                 'r' - table
                 'v' - view
                 'm' - materialized view
+        :param schemas: only list the columns of relations in these schemas
+        :param names: only list the columns of relations with these names
         :return: list of (schema_name, relation_name, column_name) tuples
         """
 
         with self.conn.cursor() as cur:
-            sql = cur.mogrify(self.columns_query, [kinds])
+            sql = cur.mogrify(self.columns_query, [kinds, schemas, names])
             _logger.debug('Columns Query. sql: %r', sql)
             cur.execute(sql)
             for row in cur:
                 yield row
 
-    def table_columns(self):
-        for row in self._columns(kinds=['r']):
+    def table_columns(self, schemas=None, names=None):
+        for row in self._columns(kinds=['r'], schemas=schemas, names=names):
             yield row
 
-    def view_columns(self):
-        for row in self._columns(kinds=['v', 'm']):
+    def view_columns(self, schemas=None, names=None):
+        for row in self._columns(kinds=['v', 'm'], schemas=schemas,
+                                 names=names):
             yield row
 
+    def catalog_fingerprint(self):
+        """Returns a tuple which changes when the objects in the database (or
+        the databases on the server) change, to tell if the completions need
+        to be refreshed."""
+        with self.conn.cursor() as cur:
+            _logger.debug('Catalog fingerprint Query. sql: %r',
+                          self.catalog_fingerprint_query)
+            cur.execute(self.catalog_fingerprint_query)
+            return tuple(cur.fetchone())
+
     def databases(self):
         with self.conn.cursor() as cur:
             _logger.debug('Databases Query. sql: %r', self.databases_query)
             cur.execute(self.databases_query)
             return [x[0] for x in cur.fetchall()]
 
-    def functions(self):
-        """Yields FunctionMetadata named tuples"""
+    def functions(self, schemas=None):
+        """Yields FunctionMetadata named tuples, for the functions in schemas
+        or in every schema"""
 
         with self.conn.cursor() as cur:
             if self.conn.server_version > 90000:
@@ -389,10 +1139,11 @@ class PGExecute(object):
                     FROM pg_catalog.pg_proc p
                             INNER JOIN pg_catalog.pg_namespace n
                                 ON n.oid = p.pronamespace
+                    WHERE n.nspname = ANY(COALESCE(%s::name[], ARRAY[n.nspname]))
                     ORDER BY 1, 2
                     '''
                 _logger.debug('Functions Query. sql: %r', query)
-                cur.execute(query)
+                cur.execute(query, [schemas])
                 for row in cur:
                     yield FunctionMetadata(*row)
             else:
@@ -410,10 +1161,11 @@ class PGExecute(object):
                     ON n.oid = p.pronamespace
                     INNER JOIN pg_catalog.pg_type t
                     ON p.prorettype = t.oid
+                    WHERE n.nspname = ANY(COALESCE(%s::name[], ARRAY[n.nspname]))
                     ORDER BY 1, 2
                     '''
                 _logger.debug('Functions Query. sql: %r', query)
-                cur.execute(query)
+                cur.execute(query, [schemas])
                 for row in cur:
                     names = row[2] if row[2] is not None else []
                     args = itertools.izip_longest(names, row[3].split(', '), '')
@@ -423,8 +1175,9 @@ class PGExecute(object):
                     _logger.debug(arg_list)
                     yield FunctionMetadata(row[0], row[1], arg_list, row[4], row[5], row[6], row[7])
 
-    def datatypes(self):
-        """Yields tuples of (schema_name, type_name)"""
+    def datatypes(self, schemas=None):
+        """Yields tuples of (schema_name, type_name), for the types in schemas
+        or in every schema"""
 
         with self.conn.cursor() as cur:
             if self.conn.server_version > 90000:
@@ -448,6 +1201,8 @@ class PGExecute(object):
                               )
                           AND n.nspname <> 'pg_catalog'
                           AND n.nspname <> 'information_schema'
+                          AND n.nspname = ANY(COALESCE(%s::name[],
+                                                       ARRAY[n.nspname]))
                     ORDER BY 1, 2;
                     '''
             else:
@@ -461,10 +1216,11 @@ class PGExecute(object):
                           AND n.nspname <> 'pg_catalog'
                           AND n.nspname <> 'information_schema'
                       AND pg_catalog.pg_type_is_visible(t.oid)
+                      AND n.nspname = ANY(COALESCE(%s::name[], ARRAY[n.nspname]))
                     ORDER BY 1, 2;
                 '''
             _logger.debug('Datatypes Query. sql: %r', query)
-            cur.execute(query)
+            cur.execute(query, [schemas])
             for row in cur:
                 yield row
 
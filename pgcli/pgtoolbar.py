@@ -38,3 +38,41 @@ def create_toolbar_tokens_func(get_vi_mode_enabled, get_is_refreshing):
 
         return result
     return get_toolbar_tokens
+
+
+def create_progress_tokens_func(get_progress):
+    """
+    Return a function that generates the tokens of the progress line, which
+    is shown in place of the toolbar while a command runs.
+    """
+    assert callable(get_progress)
+
+    token = Token.Toolbar
+
+    def get_progress_tokens(cli):
+        progress = get_progress()
+        result = []
+        result.append((token, ' Running: %.1fs  ' % progress.elapsed))
+
+        if progress.statements:
+            result.append((token, '%d statements  ' % progress.statements))
+
+        if progress.bytes_total:
+            result.append((token, '%.1f of %.1f MB (%d%%)  ' % (
+                progress.bytes_done / 1e6, progress.bytes_total / 1e6,
+                100 * progress.bytes_done // progress.bytes_total)))
+        elif progress.bytes_done:
+            result.append((token, '%.1f MB  ' % (progress.bytes_done / 1e6)))
+
+        # Rows are counted as they are read or written by \copy, \import
+        # and \export. A query's rows are only fetched once it has finished.
+        if progress.rows:
+            result.append((token, '%d rows  ' % progress.rows))
+
+        if progress.cancelled:
+            result.append((token.Off, 'Cancelling...  '))
+        else:
+            result.append((token.On, '[Ctrl+C] Cancel  '))
+
+        return result
+    return get_progress_tokens
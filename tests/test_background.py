@@ -0,0 +1,80 @@
+import time
+import threading
+import pytest
+from mock import Mock, patch
+
+from pgcli.background import run_in_background, background_iter
+
+
+def test_result_is_returned():
+    assert run_in_background(lambda: 42) == 42
+
+
+def test_exceptions_are_raised_in_the_caller():
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        run_in_background(fail)
+
+
+def test_progress_is_shown_while_waiting():
+    on_tick = Mock()
+    run_in_background(lambda: time.sleep(0.3), on_tick=on_tick,
+                      interval=0.05)
+    assert on_tick.call_count >= 2
+
+
+@pytest.mark.parametrize('batch_size', [1, 3, 100])
+def test_background_iter_yields_all_items(batch_size):
+    assert list(background_iter(range(10), batch_size)) == list(range(10))
+
+
+def test_background_iter_raises_after_the_items_before_the_error():
+    def items():
+        yield 1
+        yield 2
+        raise ValueError('boom')
+
+    result = []
+    with pytest.raises(ValueError):
+        for item in background_iter(items(), batch_size=10):
+            result.append(item)
+    assert result == [1, 2]
+
+
+def test_background_iter_stops_worker_when_closed():
+    produced = []
+
+    def items():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    it = background_iter(items(), batch_size=1, queue_size=1)
+    assert next(it) == 0
+    it.close()
+    assert len(produced) < 10
+    assert not [t for t in threading.enumerate()
+                if t.name == 'background_iter']
+
+
+def test_background_iter_interrupt_is_handled_before_stopping():
+    cancelled = threading.Event()
+    calls = []
+
+    def items():
+        # e.g. a FETCH, which only returns once it's cancelled.
+        cancelled.wait(5)
+        calls.append('worker done')
+        yield 1
+
+    def on_interrupt():
+        calls.append('interrupted')
+        cancelled.set()
+
+    with patch('pgcli.background.queue.Queue.get',
+               side_effect=KeyboardInterrupt):
+        with pytest.raises(KeyboardInterrupt):
+            list(background_iter(items(), on_interrupt=on_interrupt))
+    assert calls == ['interrupted', 'worker done']
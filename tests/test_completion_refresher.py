@@ -1,6 +1,14 @@
 import time
+import threading
 import pytest
+import psycopg2
+import psycopg2.extensions
+from collections import OrderedDict
 from mock import Mock, patch
+from pgcli.completion_refresher import (ddl_changes, DDLChange,
+                                       CompletionCache, ColumnLoader)
+from pgcli.packages.function_metadata import FunctionMetadata
+from pgcli.pgcompleter import PGCompleter
 
 
 @pytest.fixture
@@ -38,7 +46,8 @@ def test_refresh_called_once(refresher):
         assert len(actual) == 1
         assert len(actual[0]) == 4
         assert actual[0][3] == 'Auto-completion refresh started in the background.'
-        bg_refresh.assert_called_with(pgexecute, special, callbacks, None)
+        bg_refresh.assert_called_with(pgexecute, special, callbacks, None,
+                                      False)
 
 
 def test_refresh_called_twice(refresher):
@@ -86,3 +95,281 @@ def test_refresh_with_callbacks(refresher):
         refresher.refresh(pgexecute, special, callbacks)
         time.sleep(1)  # Wait for the thread to work.
         assert (callbacks[0].call_count == 1)
+
+
+def test_refreshers_replayed_in_order(refresher):
+    """
+    Refreshers run concurrently, but their results are applied to the
+    completer in the order of the refreshers.
+    """
+    calls = []
+
+    def slow(completer, executor):
+        time.sleep(0.2)
+        completer.extend_schemata(iter(['slow']))
+
+    def fast(completer, executor):
+        completer.extend_schemata(['fast'])
+
+    completer = Mock()
+    completer.extend_schemata.side_effect = lambda names: calls.append(names)
+    callbacks = [Mock()]
+
+    with patch('pgcli.completion_refresher.PGExecute') as pgexecute_class, \
+            patch('pgcli.completion_refresher.PGCompleter',
+                  return_value=completer):
+        refresher.refreshers = OrderedDict([('slow', slow), ('fast', fast)])
+        refresher._bg_refresh(Mock(), Mock(), callbacks)
+
+    assert calls == [['slow'], ['fast']]
+    assert pgexecute_class.call_count == 2
+    assert pgexecute_class.return_value.close.call_count == 2
+    callbacks[0].assert_called_once_with(completer)
+
+
+def test_failed_refresh_is_logged(refresher):
+    def fail(completer, executor):
+        raise psycopg2.OperationalError('gone')
+
+    refresh = Mock()
+    refresher.refreshers = OrderedDict([('fail', fail), ('tables', refresh)])
+    refresher.jobs = 1
+    callbacks = [Mock()]
+
+    with patch('pgcli.completion_refresher.PGExecute') as pgexecute_class, \
+            patch('pgcli.completion_refresher._logger') as logger:
+        refresher._bg_refresh(Mock(), Mock(), callbacks)
+
+    assert logger.error.called
+    assert not refresh.called
+    assert refresher.fingerprint is None
+    assert pgexecute_class.return_value.close.called
+    callbacks[0].assert_called_once_with(None)
+
+
+@pytest.mark.parametrize('sql, changes', [
+    ('create temp table x (a int)', [DDLChange('relations', None, ('x',))]),
+    ('CREATE OR REPLACE VIEW s."My View" AS SELECT 1',
+     [DDLChange('relations', 's', ('My View',))]),
+    ('drop table if exists a, s.b',
+     [DDLChange('relations', None, ('a',)),
+      DDLChange('relations', 's', ('b',))]),
+    ('alter table only t add column c int',
+     [DDLChange('relations', None, ('t',))]),
+    ('alter table s.t rename to u',
+     [DDLChange('relations', 's', ('t',)), DDLChange('relations', 's', ('u',))]),
+    ('drop function s.f(int, text), g()',
+     [DDLChange('functions', 's', None), DDLChange('functions', None, None)]),
+    ('create domain d as int', [DDLChange('datatypes', None, None)]),
+    ('create schema if not exists s', [DDLChange('schemata', None, ('s',))]),
+    ('create database d', [DDLChange('databases', None, None)]),
+    ('create unique index on t (a)', []),
+    ('create table a (x int);\ncreate index on a (x)',
+     [DDLChange('relations', None, ('a',))]),
+    ('drop table t cascade', None),
+    ('alter table t set schema s', None),
+    ('create extension hstore', None),
+    ('create schema authorization joe', None),
+])
+def test_ddl_changes(sql, changes):
+    assert ddl_changes(sql) == changes
+
+
+def test_refresh_changes(refresher):
+    executor = Mock()
+    executor.search_path.return_value = ['pg_catalog', 'public']
+    executor.tables.return_value = iter([('public', 'x')])
+    executor.table_columns.return_value = iter([('public', 'x', 'a')])
+    executor.views.return_value = iter([])
+    executor.view_columns.return_value = iter([])
+
+    completer = PGCompleter()
+    completer.extend_schemata(['public'])
+    completer.extend_relations([('public', 'x'), ('public', 'y')], 'tables')
+    completer.extend_columns([('public', 'x', 'old')], 'tables')
+
+    recorder = refresher.refresh_changes(
+        executor, ddl_changes('alter table x rename old to a'))
+    recorder.replay(completer)
+
+    executor.tables.assert_called_once_with(['public'], ('x',))
+    assert completer.dbmetadata['tables']['public'] == {
+        'x': ['*', 'a'], 'y': ['*']}
+    assert 'a' in completer.all_completions
+    assert 'old' not in completer.all_completions
+
+
+def test_dropped_schema_names_are_not_completed():
+    completer = PGCompleter()
+    completer.extend_schemata(['public', 's'])
+    completer.extend_relations([('public', 'x'), ('s', 'x'), ('s', 'y')],
+                               'tables')
+    completer.drop_schemata(['s'])
+    assert 's' not in completer.all_completions
+    assert 'y' not in completer.all_completions
+    assert 'x' in completer.all_completions
+
+
+def test_refresh_skipped_when_catalog_unchanged(refresher):
+    refresh = Mock()
+    refresher.refreshers = OrderedDict([('tables', refresh)])
+    callbacks = [Mock()]
+    pgexecute = Mock()
+    pgexecute.catalog_fingerprint.return_value = ('db', 1)
+
+    with patch('pgcli.completion_refresher.PGExecute',
+               return_value=pgexecute) as pgexecute_class:
+        refresher._bg_refresh(Mock(), Mock(), callbacks)
+        assert refresh.call_count == 1
+        assert refresher.is_current(pgexecute)
+
+        # Only the connection for the probe is opened.
+        pgexecute_class.reset_mock()
+        refresher._bg_refresh(Mock(), Mock(), callbacks)
+        assert refresh.call_count == 1
+        assert pgexecute_class.call_count == 1
+        callbacks[0].assert_called_with(None)
+
+        # An explicit refresh reads the catalog anyway.
+        refresher._bg_refresh(Mock(), Mock(), callbacks, force=True)
+        assert refresh.call_count == 2
+        refresh.reset_mock()
+
+        pgexecute.catalog_fingerprint.return_value = ('db', 2)
+        assert not refresher.is_current(pgexecute)
+        refresher._bg_refresh(Mock(), Mock(), callbacks)
+        assert refresh.call_count == 1
+
+
+def test_completion_cache_round_trip(tmpdir):
+    executor = Mock(user='u', host='h', port=5432, dbname='d')
+    completer = PGCompleter()
+    completer.extend_schemata(['public'])
+    completer.extend_relations([('public', 'users')], 'tables')
+    completer.extend_columns([('public', 'users', 'id')], 'tables')
+    completer.extend_functions([FunctionMetadata(
+        'public', 'f', 'x integer', 'integer', False, False, False)])
+    completer.extend_database_names(['d'])
+    completer.set_search_path(['public'])
+
+    cache = CompletionCache(str(tmpdir.join('completions')))
+    assert cache.load(executor, None) == (None, None)
+    cache.save(executor, completer, ('d', '1 2'))
+    loaded, fingerprint = cache.load(executor, None)
+
+    assert fingerprint == ('d', '1 2')
+    assert loaded.dbmetadata == completer.dbmetadata
+    assert loaded.databases == ['d']
+    assert loaded.search_path == ['public']
+    assert loaded.all_completions == completer.all_completions
+
+    other = Mock(user='u', host='h', port=5432, dbname='other')
+    assert cache.load(other, None) == (None, None)
+
+
+def test_load_cached_sets_fingerprint(refresher, tmpdir):
+    executor = Mock(user='u', host='h', port=5432, dbname='d')
+    with patch.object(refresher, 'cache',
+                      CompletionCache(str(tmpdir))) as cache:
+        assert refresher.load_cached(executor, None) is None
+        cache.save(executor, PGCompleter(), ['d', '1 2'])
+        assert refresher.load_cached(executor, None, ['select 1'])
+    assert refresher.fingerprint == ('d', '1 2')
+
+
+def test_lazy_refresh_skips_columns():
+    from pgcli.completion_refresher import (CompletionRecorder,
+                                            refresh_tables)
+    executor = Mock()
+    refresh_tables(CompletionRecorder(column_loader=Mock()), executor)
+    assert executor.tables.called
+    assert not executor.table_columns.called
+
+
+def connected_column_loader():
+    """A ColumnLoader which has opened its side connection, so it waits for
+    the fetches."""
+    loader = ColumnLoader(Mock())
+    loader._executor = Mock()
+    return loader
+
+
+def test_column_loader_keeps_recently_used():
+    loader = connected_column_loader()
+    loader.cache_size = 2
+    with patch.object(loader, '_fetch',
+                      side_effect=lambda kind, schema, rel: [rel + '_id']) \
+            as fetch:
+        assert loader.columns('tables', 'public', 'a') == ['a_id']
+        loader.columns('tables', 'public', 'b')
+        loader.columns('tables', 'public', 'a')
+        loader.columns('tables', 'public', 'c')  # evicts b
+        assert fetch.call_count == 3
+        loader.columns('tables', 'public', 'a')
+        assert fetch.call_count == 3
+        loader.columns('tables', 'public', 'b')
+        assert fetch.call_count == 4
+
+        loader.forget(['public'], ['b'])
+        loader.columns('tables', 'public', 'b')
+        assert fetch.call_count == 5
+
+
+def test_column_loader_gives_up_on_errors():
+    loader = connected_column_loader()
+    with patch.object(loader, '_fetch',
+                      side_effect=psycopg2.extensions.QueryCanceledError) \
+            as fetch:
+        assert loader.columns('tables', 'public', 'a') == []
+        # Not retried straight away.
+        assert loader.columns('tables', 'public', 'a') == []
+        assert fetch.call_count == 1
+
+        loader.retry_after = 0
+        assert loader.columns('tables', 'public', 'a') == []
+        assert fetch.call_count == 2
+
+
+def test_column_loader_waits_for_timeout_only():
+    loader = connected_column_loader()
+    loader.timeout = 0.05
+    done = threading.Event()
+
+    def slow_fetch(kind, schema, relname):
+        # e.g. a query waiting for a lock
+        done.wait(5)
+        return ['id']
+
+    with patch.object(loader, '_fetch', side_effect=slow_fetch) as fetch:
+        assert loader.columns('tables', 'public', 'a') == []
+        assert loader.columns('tables', 'public', 'a') == []
+        done.set()
+        for _ in range(100):
+            if loader.columns('tables', 'public', 'a'):
+                break
+            time.sleep(0.01)
+        assert loader.columns('tables', 'public', 'a') == ['id']
+        assert fetch.call_count == 1
+
+
+def test_column_loader_keeps_its_connection():
+    loader = ColumnLoader(Mock())
+    with patch('pgcli.completion_refresher.PGExecute') as pgexecute_class:
+        executor = pgexecute_class.return_value
+        executor.conn.closed = False
+        executor.table_columns.side_effect = lambda schemas, names: iter(
+            [(schemas[0], names[0], names[0] + '_id')])
+        # Connecting isn't waited for.
+        loader.columns('tables', 'public', 'a')
+        for _ in range(100):
+            if loader.columns('tables', 'public', 'a'):
+                break
+            time.sleep(0.01)
+        assert loader.columns('tables', 'public', 'a') == ['a_id']
+        # Connected, so the query is waited for.
+        assert loader.columns('tables', 'public', 'b') == ['b_id']
+        assert pgexecute_class.call_count == 1
+        assert not executor.close.called
+
+        loader.close()
+        executor.close.assert_called_once_with()
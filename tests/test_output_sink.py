@@ -0,0 +1,81 @@
+# coding=UTF-8
+import io
+import mock
+import pytest
+
+from pgcli.output_sink import PagerSink, FileSink, PipeSink
+
+
+@pytest.yield_fixture
+def tty():
+    with mock.patch('pgcli.output_sink.sys') as sys:
+        sys.stdout.isatty.return_value = True
+        sys.stdin.isatty.return_value = True
+        sys.stdout.encoding = 'utf-8'
+        yield sys
+
+
+def test_pager_sink_pipes_lines_to_pager(tmpdir, tty):
+    outfile = tmpdir.join('out')
+    sink = PagerSink(pager='cat > %s' % outfile)
+    assert sink.write(u'first')
+    assert sink.write(u'second é')
+    sink.close()
+    with io.open(str(outfile), encoding='utf-8') as f:
+        assert f.read() == u'first\nsecond é\n'
+    assert not sink.write(u'third')
+
+
+def test_pager_sink_stops_when_pager_quits(tmpdir, tty):
+    outfile = tmpdir.join('out')
+    sink = PagerSink(pager='head -n 1 > %s' % outfile)
+    sink.flush_interval = 0
+    for i in range(100000):
+        if not sink.write(u'line %d' % i):
+            break
+    sink.close()
+    assert sink.closed
+    assert i < 99999
+    assert outfile.read() == 'line 0\n'
+
+
+def test_pager_sink_echoes_without_terminal(capsys):
+    sink = PagerSink(pager='false')
+    sink.write(u'abc')
+    sink.close()
+    out, _ = capsys.readouterr()
+    assert out == 'abc\n'
+
+
+def test_file_sink_appends_and_stays_open(tmpdir):
+    outfile = tmpdir.join('out')
+    outfile.write('before\n')
+    sink = FileSink(str(outfile))
+    assert sink.write(u'first é')
+    sink.flush()
+    assert outfile.read_binary().decode('utf-8') == u'before\nfirst é\n'
+    assert sink.write(u'second')
+    sink.close()
+    assert outfile.read_binary().decode('utf-8') == \
+        u'before\nfirst é\nsecond\n'
+    assert not sink.write(u'third')
+
+
+def test_pipe_sink_keeps_command_running(tmpdir):
+    outfile = tmpdir.join('out')
+    sink = PipeSink('cat > %s' % outfile)
+    assert sink.write(u'first')
+    sink.flush()
+    assert sink.write(u'second é')
+    sink.close()
+    assert outfile.read_binary().decode('utf-8') == u'first\nsecond é\n'
+    assert not sink.write(u'third')
+
+
+def test_pipe_sink_stops_when_command_exits():
+    sink = PipeSink('true')
+    sink.process.wait()
+    for i in range(10000):
+        if not sink.write(u'x' * 100):
+            break
+    assert sink.closed
@@ -0,0 +1,283 @@
+# coding=UTF-8
+import io
+import pytest
+import psycopg2
+from mock import Mock
+from pgcli.background import QueryProgress
+from pgcli.pgcopy import (parse_copy_command, copy, CopyCommand, CopyReader,
+                          CopyWriter, parse_export_command, ExportCommand,
+                          ParallelExport, parse_import_command, ImportCommand,
+                          ParallelImport, MappedRangeReader, split_lines)
+from utils import dbtest
+
+
+@pytest.mark.parametrize('pattern, command', [
+    ("foo from 'data.csv' with csv",
+     CopyCommand('COPY foo FROM STDIN with csv', 'from', 'data.csv')),
+    ("foo (a, b) to '/tmp/it''s.txt'",
+     CopyCommand('COPY foo (a, b) TO STDOUT', 'to', "/tmp/it's.txt")),
+    ('(select 1 from t) to out.txt',
+     CopyCommand('COPY (select 1 from t) TO STDOUT', 'to', 'out.txt')),
+    ('"From" from stdin',
+     CopyCommand('COPY "From" FROM STDIN', 'from', None)),
+    ('foo TO pstdout (format csv)',
+     CopyCommand('COPY foo TO STDOUT (format csv)', 'to', None)),
+])
+def test_parse_copy_command(pattern, command):
+    assert parse_copy_command(pattern) == command
+
+
+@pytest.mark.parametrize('pattern', ['', 'foo', 'foo from',
+                                     "foo to program 'gzip > x'"])
+def test_parse_copy_command_errors(pattern):
+    with pytest.raises(ValueError):
+        parse_copy_command(pattern)
+
+
+def test_no_wait_callback():
+    """copy_expert can't be used with an asynchronous wait callback."""
+    import pgcli.pgexecute
+    assert psycopg2.extensions.get_wait_callback() is None
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_copy_reader_counts_progress(tmpdir, use_mmap):
+    path = tmpdir.join('data.txt')
+    path.write_binary(b'1\ta\n2\tb\n3\tc\n')
+    progress = QueryProgress()
+    reader = CopyReader(io.open(str(path), 'rb'), progress, use_mmap=use_mmap)
+    chunks = list(iter(lambda: reader.read(5), b''))
+    reader.close()
+    assert b''.join(chunks) == b'1\ta\n2\tb\n3\tc\n'
+    assert progress.bytes_done == 12
+    assert progress.rows == 3
+
+
+def test_copy_writer_counts_progress():
+    progress = QueryProgress()
+    f = io.BytesIO()
+    writer = CopyWriter(f, progress)
+    writer.write(b'1\ta\n')
+    writer.write(b'2\tb\n')
+    assert f.getvalue() == b'1\ta\n2\tb\n'
+    assert (progress.rows, progress.bytes_done) == (2, 8)
+
+
+@dbtest
+def test_copy_round_trip(executor, tmpdir):
+    path = str(tmpdir.join('data.csv'))
+    with io.open(path, 'wb') as f:
+        f.write(u'1,日本語\n2,b\n'.encode('utf-8'))
+    cur = executor.conn.cursor()
+    cur.execute('create table test(a int, b text)')
+
+    progress = QueryProgress()
+    assert copy(cur, "test from '%s' csv" % path, progress) == 'COPY 2'
+    assert progress.rows == 2
+
+    out = str(tmpdir.join('out.csv'))
+    assert copy(cur, "(select * from test order by a) to '%s' csv" % out,
+                QueryProgress()) == 'COPY 2'
+    with io.open(out, 'rb') as f:
+        assert f.read().decode('utf-8') == u'1,日本語\n2,b\n'
+
+
+@pytest.mark.parametrize('pattern, command', [
+    ("foo 'out.csv'", ExportCommand('foo', 'out.csv', '', 4, False)),
+    ('-j 8 -p public.foo out.txt csv header',
+     ExportCommand('public.foo', 'out.txt', 'csv header', 8, True)),
+    ('"My Schema"."My Table" out (format csv)',
+     ExportCommand('"My Schema"."My Table"', 'out', '(format csv)', 4,
+                   False)),
+])
+def test_parse_export_command(pattern, command):
+    assert parse_export_command(pattern, jobs=4) == command
+
+
+@pytest.mark.parametrize('pattern', ['', 'foo', '-j foo out', '-j 0 foo out',
+                                     'foo (a) out'])
+def test_parse_export_command_errors(pattern):
+    with pytest.raises(ValueError):
+        parse_export_command(pattern)
+
+
+def test_export_ranges_are_open_ended():
+    export = ParallelExport(None, None, None)
+    assert export._where('id', [10, 20], str) == [
+        'id < 10', 'id >= 10 AND id < 20', 'id >= 20']
+
+
+@dbtest
+@pytest.mark.parametrize('parts', [False, True])
+def test_parallel_export(executor, tmpdir, parts):
+    cur = executor.conn.cursor()
+    cur.execute('create table test(a int primary key)')
+    cur.execute('insert into test select generate_series(1, 1000)')
+    cur.execute('analyze test')
+
+    out = str(tmpdir.join('out.txt'))
+    command = parse_export_command('-j 3 test %s' % out)
+    if parts:
+        command = command._replace(parts=True)
+    assert ParallelExport(executor, command, QueryProgress()).run() == \
+        'COPY 1000'
+
+    if parts:
+        data = b''.join(f.read_binary() for f in sorted(
+            tmpdir.listdir(lambda p: p.basename.startswith('out.txt.'))))
+    else:
+        data = tmpdir.join('out.txt').read_binary()
+    assert sorted(int(row) for row in data.split()) == list(range(1, 1001))
+
+
+@dbtest
+def test_parallel_export_writes_one_header(executor, tmpdir):
+    cur = executor.conn.cursor()
+    cur.execute('create table test(a int primary key, b text)')
+    cur.execute("insert into test select i, 'x' || i "
+                "from generate_series(1, 1000) i")
+    cur.execute('analyze test')
+
+    out = tmpdir.join('out.csv')
+    command = parse_export_command('-j 3 test %s csv header' % out)
+    assert ParallelExport(executor, command, QueryProgress()).run() == \
+        'COPY 1000'
+    lines = out.read_binary().splitlines()
+    assert lines.count(b'a,b') == 1 and lines[0] == b'a,b'
+
+    cur.execute('create table copy(a int, b text)')
+    command = parse_import_command('-j 3 copy %s csv header' % out)
+    assert ParallelImport(executor, command, QueryProgress()).run() == \
+        'COPY 1000'
+    cur.execute('select count(*), sum(a) from copy')
+    assert cur.fetchone() == (1000, 500500)
+
+
+@pytest.mark.parametrize('pattern, command', [
+    ("-1 foo 'in.csv' csv header",
+     ImportCommand('foo', 'in.csv', 'csv header', 4, True)),
+    ('-j 2 s.foo (a, "B") in.txt',
+     ImportCommand('s.foo (a, "B")', 'in.txt', '', 2, False)),
+])
+def test_parse_import_command(pattern, command):
+    assert parse_import_command(pattern, jobs=4) == command
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 10])
+def test_split_lines(count):
+    data = b'1\n22\n333\n4444\n55555\n'
+    pieces = split_lines(data, count)
+    assert b''.join(data[start:end] for start, end in pieces) == data
+    assert all(data[end - 1:end] == b'\n' for _, end in pieces)
+    assert 0 < len(pieces) <= count
+
+
+@pytest.mark.parametrize('count', [2, 3, 10])
+def test_split_lines_keeps_quoted_newlines(count):
+    data = b'1,"a\nb"\n2,"c""\n"\n3,x\n4,"\n\n\n"\n'
+    pieces = split_lines(data, count, quote=b'"')
+    assert b''.join(data[start:end] for start, end in pieces) == data
+    assert all(data[:end].count(b'"') % 2 == 0 for _, end in pieces)
+
+
+def test_mapped_range_reader_sends_header_first():
+    data = b'a,b\n1,2\n3,4\n5,6\n'
+    progress = QueryProgress()
+    reader = MappedRangeReader(data, 8, 16, progress, header=b'a,b\n')
+    assert b''.join(iter(lambda: reader.read(3), b'')) == b'a,b\n3,4\n5,6\n'
+    assert (progress.rows, progress.bytes_done) == (2, 8)
+
+
+@dbtest
+@pytest.mark.parametrize('options', ['', '-1'])
+def test_parallel_import(executor, tmpdir, options):
+    path = tmpdir.join('data.csv')
+    path.write_binary(b'a\n' + b''.join(b'%d\n' % i for i in range(1, 1001)))
+    cur = executor.conn.cursor()
+    cur.execute('create table test(a int)')
+
+    command = parse_import_command('%s -j 3 test %s csv header' % (
+        options, path))
+    assert ParallelImport(executor, command, QueryProgress()).run() == \
+        'COPY 1000'
+    cur.execute('select count(*), sum(a) from test')
+    assert cur.fetchone() == (1000, 500500)
+
+
+@dbtest
+def test_parallel_import_csv_with_newlines(executor, tmpdir):
+    path = tmpdir.join('data.csv')
+    path.write_binary(b''.join(b'%d,"line\n%d"\n' % (i, i)
+                               for i in range(1, 1001)))
+    cur = executor.conn.cursor()
+    cur.execute('create table test(a int, b text)')
+
+    command = parse_import_command('-j 3 test %s csv' % path)
+    assert ParallelImport(executor, command, QueryProgress()).run() == \
+        'COPY 1000'
+    cur.execute("select count(*) from test where b = 'line\n' || a")
+    assert cur.fetchone() == (1000,)
+
+
+@dbtest
+def test_parallel_import_rolls_back_all_pieces(executor, tmpdir):
+    path = tmpdir.join('data.txt')
+    path.write_binary(b''.join(b'%d\n' % i for i in range(1, 1001)) + b'x\n')
+    cur = executor.conn.cursor()
+    cur.execute('create table test(a int)')
+
+    importer = ParallelImport(executor, parse_import_command(
+        '-1 -j 3 test %s' % path), QueryProgress())
+    with pytest.raises(psycopg2.DataError):
+        importer.run()
+    assert importer.failed_line == 1001
+    cur.execute('select count(*) from test')
+    assert cur.fetchone() == (0,)
+
+
+@dbtest
+def test_parallel_import_reports_the_failing_line(executor, tmpdir):
+    path = tmpdir.join('data.csv')
+    lines = [b'%d' % i for i in range(1, 1001)]
+    lines[600] = b'x'
+    path.write_binary(b'a\n' + b'\n'.join(lines) + b'\n')
+    executor.conn.cursor().execute('create table test(a int)')
+
+    importer = ParallelImport(executor, parse_import_command(
+        '-j 3 test %s csv header' % path), QueryProgress())
+    with pytest.raises(psycopg2.DataError):
+        importer.run()
+    assert importer.failed_line == 602
+
+
+def prepared_worker(fail=None):
+    executor = Mock()
+    executor.conn.closed = False
+    executor.in_transaction.return_value = True
+
+    def execute(sql, *args):
+        if fail and sql.startswith(fail):
+            raise psycopg2.OperationalError(fail)
+
+    executor.conn.cursor.return_value.execute.side_effect = execute
+    return executor
+
+
+@pytest.mark.parametrize('fail', [None, 'PREPARE'])
+def test_two_phase_commit_is_all_or_nothing(fail):
+    importer = ParallelImport(Mock(), parse_import_command('-1 t f'),
+                              QueryProgress())
+    importer.two_phase = True
+    workers = [prepared_worker(), prepared_worker(fail)]
+    importer._workers = workers
+    if fail:
+        with pytest.raises(psycopg2.OperationalError):
+            importer._finish(commit=True)
+    else:
+        importer._finish(commit=True)
+
+    first = [c[0][0] for c in
+             workers[0].conn.cursor.return_value.execute.call_args_list]
+    assert first == ['PREPARE TRANSACTION %s',
+                     'ROLLBACK PREPARED %s' if fail else 'COMMIT PREPARED %s']
+    assert all(w.close.called for w in workers)
@@ -1,9 +1,14 @@
 # coding=UTF-8
 
+import time
+import threading
 import pytest
 import psycopg2
+import psycopg2.extensions as ext
+from mock import Mock, patch
 from pgspecial.main import PGSpecial
 from pgcli.packages.function_metadata import FunctionMetadata
+from pgcli.pgexecute import PGExecute, TypeOidCache, ConnectionPool
 from textwrap import dedent
 from utils import run, dbtest, requires_json, requires_jsonb
 
@@ -63,6 +68,26 @@ def test_schemata_table_views_and_columns_query(executor):
     assert set(executor.view_columns()) >= set([
         ('public', 'd', 'e')])
 
+@dbtest
+def test_relations_queries_filter_by_schema_and_name(executor):
+    run(executor, "create table a(x text)")
+    run(executor, "create table b(z text)")
+    run(executor, "create schema schema1")
+    run(executor, "create table schema1.a (w text)")
+
+    assert list(executor.tables(['schema1'])) == [('schema1', 'a')]
+    assert list(executor.tables(['public', 'schema1'], ['a'])) == [
+        ('public', 'a'), ('schema1', 'a')]
+    assert list(executor.table_columns(['public'], ['a'])) == [
+        ('public', 'a', 'x')]
+
+@dbtest
+def test_catalog_fingerprint(executor):
+    fingerprint = executor.catalog_fingerprint()
+    assert executor.catalog_fingerprint() == fingerprint
+    run(executor, "create table a(x text)")
+    assert executor.catalog_fingerprint() != fingerprint
+
 @dbtest
 def test_functions_query(executor):
     run(executor, '''create function func1() returns int
@@ -266,3 +291,354 @@ def test_on_error_stop(executor, exception_formatter):
     result = list(executor.run(sql, on_error_resume=False,
                                exception_formatter=exception_formatter))
     assert len(result) == 2
+
+
+@dbtest
+@pytest.mark.parametrize('mode', ['always', 'auto'])
+def test_server_side_cursor_streams_rows(executor, mode):
+    executor.server_side_cursors = mode
+    executor.cursor_itersize = 10
+    executor.cursor_threshold = 0
+    title, rows, headers, status = executor.execute_normal_sql(
+        'select generate_series(1, 25) as n')
+    assert headers == ['n']
+    assert not isinstance(rows, list)
+    assert [r[0] for r in rows] == list(range(1, 25 + 1))
+    assert rows.cursor.closed
+    assert rows.statusmessage == 'SELECT 25'
+
+
+@dbtest
+def test_server_side_cursor_falls_back_for_select_into(executor):
+    executor.server_side_cursors = 'always'
+    result = run(executor, 'select 1 as x into newtable')
+    assert result == ['SELECT 1']
+    assert run(executor, 'select x from newtable', join=True).endswith(
+        'SELECT 1')
+
+
+@dbtest
+def test_server_side_cursor_failure_is_not_retried(executor):
+    executor.server_side_cursors = 'always'
+    run(executor, 'create sequence calls')
+    run(executor, """create function fails() returns int as $$
+                     begin
+                         perform nextval('calls');
+                         execute 'select * from missing_table';
+                         return 1;
+                     end $$ language plpgsql""")
+    with pytest.raises(psycopg2.ProgrammingError):
+        run(executor, 'select fails()')
+    cur = executor.conn.cursor()
+    cur.execute('select last_value from calls')
+    assert cur.fetchone() == (1,)
+
+
+@dbtest
+@pytest.mark.parametrize('mode', ['always', 'auto'])
+def test_server_side_cursor_not_used_in_transaction(executor, mode):
+    executor.server_side_cursors = mode
+    executor.cursor_threshold = 0
+    run(executor, 'begin')
+    run(executor, 'select 1 as x into newtable')
+    title, rows, headers, status = executor.execute_normal_sql(
+        'select x from newtable')
+    assert list(rows) == [(1,)]
+    assert status == 'SELECT 1'
+    run(executor, 'commit')
+
+
+@dbtest
+def test_server_side_cursor_not_used_for_small_results(executor):
+    executor.server_side_cursors = 'auto'
+    executor.cursor_threshold = 1000
+    title, rows, headers, status = executor.execute_normal_sql('select 1')
+    assert status == 'SELECT 1'
+
+
+@dbtest
+def test_cancel_keeps_the_session(executor):
+    run(executor, 'create temp table cancel_test (x int)')
+    run(executor, "set application_name = 'cancel_test'")
+    executor.cancel()
+    assert run(executor, 'select count(*) from cancel_test', join=True)
+    assert 'cancel_test' in run(executor, 'show application_name', join=True)
+
+
+@dbtest
+def test_cancel_from_another_thread(executor):
+    errors = []
+
+    def sleep():
+        try:
+            run(executor, 'select pg_sleep(10)')
+        except psycopg2.extensions.QueryCanceledError as e:
+            errors.append(e)
+
+    worker = threading.Thread(target=sleep)
+    worker.start()
+    time.sleep(0.3)
+    executor.cancel()
+    worker.join(5)
+    assert not worker.is_alive()
+    assert errors
+    assert run(executor, 'select 1', join=True)
+
+
+@dbtest
+def test_text_typecasting(executor):
+    executor.text_typecasting = True
+    title, cur, headers, status = executor.execute_normal_sql(
+        "select 1.50::numeric, array[1, 2], interval '1 day', true")
+    assert cur.fetchone() == ('1.50', '{1,2}', '1 day', True)
+    typecaster = executor._text_typecaster
+    title, cur, headers, status = executor.execute_normal_sql(
+        "select 0.5::float8")
+    assert cur.fetchone() == ('0.5',)
+    assert executor._text_typecaster is typecaster
+
+
+@dbtest
+def test_large_values_are_previewed_by_the_server(executor):
+    executor.preview_length = 5
+    title, cur, headers, status = executor.execute_normal_sql(
+        "select repeat('x', 100) as t, 42 as n, 'abc'::text as s")
+    assert headers == ['t', 'n', 's']
+    assert cur.fetchone() == ('xxxxx... (100 characters)', 42, 'abc')
+
+
+def test_type_oid_cache_is_saved(tmpdir):
+    filename = str(tmpdir.join('type_oids.json'))
+    TypeOidCache(filename).set('localhost:5432:90500', {'date': [1082]})
+    assert TypeOidCache(filename).get('localhost:5432:90500') == {
+        'date': [1082]}
+
+
+def test_type_oid_cache_without_file(tmpdir):
+    cache = TypeOidCache(str(tmpdir.join('missing.json')))
+    assert cache.get('localhost:5432:90500') is None
+
+
+@dbtest
+def test_type_oids_are_cached(executor):
+    [oids] = [v for k, v in PGExecute.type_oid_cache._entries.items()
+              if k.endswith(':%d' % executor.conn.server_version)]
+    assert len(oids['date']) == 3
+    assert '_test_db' in oids['hstore']
+
+
+@dbtest
+def test_type_oid_cache_per_executor(executor, tmpdir):
+    assert PGExecute.type_oid_cache.filename is None
+    cache = TypeOidCache(str(tmpdir.join('type_oids.json')))
+    # Pooled connections don't look up the oids.
+    PGExecute.pool.close()
+    e = PGExecute(executor.dbname, executor.user, None, executor.host, None,
+                  None, cache)
+    spawned = e.spawn()
+    assert spawned.type_oid_cache is cache
+    spawned.close()
+    e.close()
+    [key] = TypeOidCache(cache.filename)._load()
+    assert key.startswith(executor.user + '@')
+
+
+def idle_connection():
+    conn = Mock(closed=0)
+    conn.get_transaction_status.return_value = ext.TRANSACTION_STATUS_IDLE
+    return conn
+
+
+def test_pool_reuses_idle_connections():
+    pool = ConnectionPool()
+    conn = idle_connection()
+    pool.put('key', conn, 'info')
+    assert pool.get('other key') is None
+    assert pool.get('key') == (conn, 'info')
+    assert pool.get('key') is None
+
+
+def test_pool_closes_connections_in_a_transaction():
+    pool = ConnectionPool()
+    conn = idle_connection()
+    conn.get_transaction_status.return_value = ext.TRANSACTION_STATUS_INTRANS
+    pool.put('key', conn)
+    assert conn.close.called
+    assert pool.get('key') is None
+
+
+def test_pool_closes_expired_connections():
+    pool = ConnectionPool()
+    conn = idle_connection()
+    with patch('pgcli.pgexecute.time', return_value=1000):
+        pool.put('key', conn)
+    with patch('pgcli.pgexecute.time', return_value=1000 + 301):
+        assert pool.get('key') is None
+    assert conn.close.called
+
+
+def test_pool_reaps_expired_connections():
+    pool = ConnectionPool()
+    pool.idle_timeout = 0.05
+    conn = idle_connection()
+    pool.put('key', conn)
+    for _ in range(100):
+        if conn.close.called:
+            break
+        time.sleep(0.01)
+    assert conn.close.called
+    assert pool._reaper is None
+
+
+@dbtest
+def test_connect_discards_the_session_before_pooling(executor):
+    run(executor, 'create temp table session_test (x int)')
+    run(executor, "set application_name = 'session_test'")
+    first_conn = executor.conn
+    executor.connect(database='postgres')
+    executor.connect(database='_test_db')
+    assert executor.conn is first_conn
+    assert 'session_test' not in run(executor, 'show application_name',
+                                     join=True)
+    assert 'SELECT 0' in run(executor, """select * from pg_class
+                                         where relname = 'session_test'""",
+                             join=True)
+    assert run(executor, "select 'ü'", join=True)
+
+
+@dbtest
+def test_connect_reuses_pooled_connection(executor):
+    first_conn = executor.conn
+    executor.connect(database='postgres')
+    assert executor.dbname == 'postgres'
+    executor.connect(database='_test_db')
+    assert executor.conn is first_conn
+    assert executor.dbname == '_test_db'
+
+
+@dbtest
+def test_statements_are_batched(executor, exception_formatter):
+    run(executor, 'create table test(a int)')
+    statements = ['insert into test values (%d)' % i for i in range(5)]
+    statements += ['select count(*) from test']
+    results = list(executor.run_statements(
+        statements, exception_formatter=exception_formatter, batch_size=3))
+    statuses = [r[3] for r in results]
+    assert statuses == ['3 statements (3 INSERT), last: INSERT 0 1',
+                        '2 statements (2 INSERT), last: INSERT 0 1',
+                        'SELECT 1']
+
+
+@dbtest
+def test_returning_statements_are_not_batched(executor, exception_formatter):
+    run(executor, 'create table test(a int)')
+    statements = ['insert into test values (1) returning a',
+                  'insert into test values (2)',
+                  'update test set a = a + 1 returning a',
+                  'call nonexistent_procedure()']
+    assert [executor.can_batch(sql) for sql in statements] == [
+        False, True, False, False]
+    results = list(executor.run_statements(
+        statements[:3], exception_formatter=exception_formatter,
+        batch_size=10))
+    assert [list(r[1]) for r in results if r[1] is not None] == [
+        [(1,)], [(2,), (3,)]]
+
+
+@dbtest
+def test_interactive_statements_are_not_savepointed(executor,
+                                                    exception_formatter):
+    run(executor, 'create table test(a int)')
+    sql = ('begin; insert into test values (1); select 1/0; '
+           'insert into test values (2); commit')
+    result = list(executor.run(sql, exception_formatter=exception_formatter,
+                               on_error_resume=True))
+    assert 'current transaction is aborted' in result[3][3]
+    assert result[4][3] == 'ROLLBACK'
+    assert 'SELECT 0' in run(executor, 'select * from test', join=True)
+
+
+@dbtest
+def test_script_statements_are_savepointed(executor, exception_formatter):
+    run(executor, 'create table test(a int)')
+    statements = ['begin', 'insert into test values (1)', 'select 1/0',
+                  'insert into test values (2)', 'commit']
+    list(executor.run_statements(
+        statements, exception_formatter=exception_formatter,
+        on_error_resume=True, statement_savepoints=True))
+    assert 'SELECT 2' in run(executor, 'select * from test', join=True)
+
+
+@dbtest
+def test_failed_batch_reports_the_failing_statement(executor,
+                                                    exception_formatter):
+    run(executor, 'create table test(a int unique)')
+    statements = ['begin', 'insert into test values (1)',
+                  'insert into test values (2)', 'insert into test values (1)',
+                  'insert into test values (3)']
+    results = list(executor.run_statements(
+        statements, exception_formatter=exception_formatter, batch_size=10))
+    assert [r[4] for r in results] == statements[:4]
+    assert 'duplicate key' in results[-1][3]
+    run(executor, 'rollback')
+
+
+@dbtest
+def test_failed_batch_outside_a_transaction_is_not_rerun(executor,
+                                                         exception_formatter):
+    run(executor, 'create table test(a serial unique)')
+    statements = ['insert into test default values',
+                  'insert into test values (1)']
+    results = list(executor.run_statements(
+        statements, exception_formatter=exception_formatter, batch_size=10))
+    assert len(results) == 1
+    assert results[0][4] == ';\n'.join(statements)
+    assert results[0][5] is False
+    assert 'duplicate key' in results[0][3]
+    cur = executor.conn.cursor()
+    cur.execute('select last_value from test_a_seq')
+    assert cur.fetchone() == (1,)
+
+
+@dbtest
+def test_single_transaction_is_rolled_back_on_error(executor,
+                                                    exception_formatter):
+    run(executor, 'create table test(a int unique)')
+    statements = ['insert into test values (1)', 'insert into test values (1)']
+    list(executor.run_statements(
+        statements, exception_formatter=exception_formatter,
+        single_transaction=True))
+    assert 'SELECT 0' in run(executor, 'select * from test', join=True)
+
+
+@dbtest
+def test_single_transaction_resumes_after_savepoint(executor,
+                                                    exception_formatter):
+    run(executor, 'create table test(a int unique)')
+    statements = ['insert into test values (1)', 'insert into test values (1)',
+                  'insert into test values (2)']
+    results = list(executor.run_statements(
+        statements, exception_formatter=exception_formatter,
+        on_error_resume=True, single_transaction=True))
+    assert [r[5] for r in results] == [True, False, True]
+    assert 'SELECT 2' in run(executor, 'select * from test', join=True)
+
+
+@dbtest
+def test_single_transaction_keeps_an_open_transaction(executor,
+                                                      exception_formatter):
+    run(executor, 'create table test(a int unique)')
+    run(executor, 'begin')
+    run(executor, 'insert into test values (1)')
+    list(executor.run_statements(
+        ['insert into test values (2)', 'insert into test values (1)'],
+        exception_formatter=exception_formatter, single_transaction=True))
+    assert executor.in_transaction()
+    list(executor.run_statements(
+        ['insert into test values (3)'],
+        exception_formatter=exception_formatter, single_transaction=True))
+    assert executor.in_transaction()
+    run(executor, 'commit')
+    cur = executor.conn.cursor()
+    cur.execute('select a from test order by a')
+    assert cur.fetchall() == [(1,), (3,)]
@@ -621,3 +621,22 @@ def test_wildcard_column_expansion_with_two_tables_and_parent(completer, complet
                           display='*', display_meta='columns')]
 
     assert expected == completions
+
+
+def test_lazy_columns_are_loaded_when_needed(completer, complete_event):
+    from mock import Mock
+    completer.extend_relations([('public', 'lazy')], kind='tables')
+    completer.column_loader = Mock()
+    completer.column_loader.columns.return_value = ['id', 'Name']
+
+    text = 'SELECT  from lazy'
+    position = len('SELECT ')
+    result = set(completer.get_completions(
+        Document(text=text, cursor_position=position),
+        complete_event))
+    completer.column_loader.columns.assert_called_once_with(
+        'tables', 'public', 'lazy')
+    assert Completion(text='id', start_position=0,
+                      display_meta='column') in result
+    assert Completion(text='"Name"', start_position=0,
+                      display_meta='column') in result
@@ -0,0 +1,74 @@
+# coding=UTF-8
+import pytest
+from pgcli.packages.sqlsplit import split, split_stream
+
+
+def test_empty_string():
+    assert split('') == []
+
+
+@pytest.mark.parametrize('sql, statements', [
+    ('select 1; select 2', ['select 1;', 'select 2']),
+    ("select 'a;b'; select 2;", ["select 'a;b';", 'select 2;']),
+    ("select 'it''s;'; select 2", ["select 'it''s;';", 'select 2']),
+    ("select E'\\';'; select 2", ["select E'\\';';", 'select 2']),
+    ("select e'\\\\'; select 2", ["select e'\\\\';", 'select 2']),
+    ('select "a;b" from t; select 2', ['select "a;b" from t;', 'select 2']),
+    ('select $$a;b$$; select 2', ['select $$a;b$$;', 'select 2']),
+    ('select $f$ $$; $f$; select 2', ['select $f$ $$; $f$;', 'select 2']),
+    ('select $1, a$b; select 2', ['select $1, a$b;', 'select 2']),
+    ('select 1 -- a; comment\n; select 2',
+     ['select 1 -- a; comment\n;', 'select 2']),
+    ('select 1 /* a; /* nested; */ comment; */; select 2',
+     ['select 1 /* a; /* nested; */ comment; */;', 'select 2']),
+    ('create rule r as on insert to t do (delete from x; delete from y); '
+     'select 2',
+     ['create rule r as on insert to t do (delete from x; delete from y);',
+      'select 2']),
+    (u"SELECT '日本語' AS japanese;", [u"SELECT '日本語' AS japanese;"]),
+])
+def test_split(sql, statements):
+    assert split(sql) == statements
+
+
+def test_function_body_is_not_split():
+    sql = ('create function f() returns int as $body$ begin return 1; end '
+           '$body$ language plpgsql; select f()')
+    assert split(sql) == [sql[:-len(' select f()')], 'select f()']
+
+
+def test_leading_comments_are_dropped():
+    assert split('-- first\n/* second */ select 1;') == ['select 1;']
+
+
+def test_empty_statements_are_skipped():
+    assert split('select 1;; ;\n-- just a comment\n') == ['select 1;']
+
+
+@pytest.mark.parametrize('sql, statements', [
+    ('\\dt\nselect 1;', ['\\dt', 'select 1;']),
+    ("select 'foo'; \\d", ["select 'foo';", '\\d']),
+    ('\\d foo; select 1', ['\\d foo;', 'select 1']),
+    ('-- describe\n\\d foo', ['\\d foo']),
+])
+def test_backslash_commands(sql, statements):
+    assert split(sql) == statements
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7])
+def test_split_stream_matches_split(chunk_size):
+    sql = ("select 'it''s;', E'\\'; x', \"a;b\" from t; -- comment;\n"
+           "select $tag$ ; $$ $tag$ /* x; */ ; \\dt\n"
+           "create rule r as on insert to t do (delete from x; delete from y);"
+           "select 2")
+    chunks = [sql[i:i + chunk_size] for i in range(0, len(sql), chunk_size)]
+    assert list(split_stream(chunks)) == split(sql)
+    assert len(split(sql)) == 5
+
+
+def test_split_stream_is_lazy():
+    def chunks():
+        yield 'select 1; sel'
+        raise AssertionError('read too far')
+
+    assert next(split_stream(chunks())) == 'select 1;'
@@ -1,5 +1,6 @@
-from pgcli.packages.tabulate import tabulate
+from pgcli.packages.tabulate import tabulate, tabulate_iter
 from textwrap import dedent
+from decimal import Decimal
 
 
 def test_dont_strip_leading_whitespace():
@@ -12,3 +13,42 @@ def test_dont_strip_leading_whitespace():
         |---------|
         |     abc |
         +---------+ ''').strip()
+
+
+def test_tabulate_iter_matches_tabulate():
+    data = [['abc', 1, None], ['de', 2.5, 'xyz'], ['f', None, '']]
+    headers = ['one', 'two', 'three']
+    tbl, _ = tabulate(data, headers, tablefmt='psql', missingval='<null>')
+    lines = tabulate_iter(iter(data), headers, tablefmt='psql',
+                          missingval='<null>')
+    assert '\n'.join(lines) == tbl
+
+
+def test_tabulate_iter_fixes_widths_from_sample():
+    data = [['a'], ['bb'], ['cccccc']]
+    lines = list(tabulate_iter(iter(data), ['x'], tablefmt='psql',
+                               sample_size=2))
+    assert lines == [
+        '+-----+',
+        '| x   |',
+        '|-----|',
+        '| a   |',
+        '| bb  |',
+        '| cccccc |',
+        '+-----+']
+
+
+def test_tabulate_uses_known_column_types():
+    data = [['1', '1.50', '007'], ['10', '12.5', '42']]
+    tbl, _ = tabulate(data, ['i', 'n', 's'], tablefmt='psql',
+                      coltypes=[int, Decimal, str])
+    assert tbl == dedent('''
+        +-----+-------+-----+
+        |   i |     n | s   |
+        |-----+-------+-----|
+        |   1 |  1.50 | 007 |
+        |  10 | 12.5  | 42  |
+        +-----+-------+-----+''').strip()
+    lines = tabulate_iter(iter(data), ['i', 'n', 's'], tablefmt='psql',
+                          coltypes=[int, Decimal, str])
+    assert '\n'.join(lines) == tbl